@@ -1,9 +1,28 @@
 import numpy as np
+import os
 import zlib
+from concurrent.futures import ThreadPoolExecutor
 from tifffile import PREDICTOR
 import imagecodecs
 from enum import IntEnum
 
+COMPRESSION_WORKERS = min(8, os.cpu_count() or 1)  # threads to compress the tiles of an image
+
+# numpy types of the integer data types of TIFF tags
+TIFF_INT_TYPES = {
+    1: np.uint8,  # BYTE
+    3: np.uint16,  # SHORT
+    4: np.uint32,  # LONG
+    6: np.int8,  # SBYTE
+    7: np.uint8,  # UNDEFINED
+    8: np.int16,  # SSHORT
+    9: np.int32,  # SLONG
+    13: np.uint32,  # IFD
+    16: np.uint64,  # LONG8
+    17: np.int64,  # SLONG8
+    18: np.uint64,  # IFD8
+}
+
 
 class COMPRESSION(IntEnum):
     """
@@ -67,7 +86,7 @@ def lzw_encode(seq: bytes) -> bytes:
     return imagecodecs._imcd.lzw_encode(seq)
 
 
-def int_to_bytes(number: int, length=-1, is_big_endian=True) -> bytes:
+def int_to_bytes(number: int, length=-1, is_big_endian=True, signed=False) -> bytes:
     """ Convert an integer number to bytes
 
        Parameters:
@@ -77,15 +96,20 @@ def int_to_bytes(number: int, length=-1, is_big_endian=True) -> bytes:
                 size of output bytes
             is_big_endian:
                 endian byte order (True: big, False: little)
+            signed:
+                two's complement, TIFF offsets and counts are unsigned (a LONG holds offsets up to 4 GB)
     """
 
     byteorder = 'big' if is_big_endian is True else 'little'
     if length == -1:
-        length = (8 + (number + (number < 0)).bit_length()) // 8
-    return number.to_bytes(length=length, byteorder=byteorder, signed=True)
+        if signed:
+            length = (8 + (number + (number < 0)).bit_length()) // 8
+        else:
+            length = max(1, (number.bit_length() + 7) // 8)
+    return number.to_bytes(length=length, byteorder=byteorder, signed=signed)
 
 
-def int_from_bytes(bytes_data: bytes, is_big_endian=True):
+def int_from_bytes(bytes_data: bytes, is_big_endian=True, signed=False):
     """ Convert bytes to an integer number
 
        Parameters:
@@ -93,9 +117,53 @@ def int_from_bytes(bytes_data: bytes, is_big_endian=True):
                 bytes value
             is_big_endian:
                 endian byte order (True: big, False: little)
+            signed:
+                two's complement
     """
     byteorder = 'big' if is_big_endian is True else 'little'
-    return int.from_bytes(bytes_data, byteorder=byteorder, signed=True)
+    return int.from_bytes(bytes_data, byteorder=byteorder, signed=signed)
+
+
+def ints_to_bytes(values, tiff_type=4, is_big_endian=True) -> bytes:
+    """ Convert an array of integers (e.g. StripOffsets, TileByteCounts) to one buffer
+
+       Parameters:
+            values:
+                list or numpy.array of integers
+            tiff_type:
+                TIFF data type of the values (TIFF_INT_TYPES), e.g. 3: SHORT, 4: LONG, 16: LONG8
+            is_big_endian:
+                endian byte order (True: big, False: little)
+    """
+    dtype = np.dtype(TIFF_INT_TYPES[tiff_type]).newbyteorder(">" if is_big_endian else "<")
+    if len(values) == 0:
+        return b""
+
+    array = np.asarray(values)
+    if array.dtype.kind not in "iu":
+        # e.g. integers, which do not fit into 64 bits
+        raise OverflowError(f"Values can not be converted to {dtype.name}")
+
+    info = np.iinfo(dtype)
+    if int(array.min()) < info.min or int(array.max()) > info.max:
+        raise OverflowError(f"Values do not fit into {dtype.name}")
+
+    return array.astype(dtype).tobytes()
+
+
+def ints_from_bytes(bytes_data: bytes, tiff_type=4, is_big_endian=True) -> list:
+    """ Convert a buffer to an array of integers (see ints_to_bytes)
+
+       Parameters:
+            bytes_data:
+                bytes value, the size is a multiple of the size of the data type
+            tiff_type:
+                TIFF data type of the values (TIFF_INT_TYPES)
+            is_big_endian:
+                endian byte order (True: big, False: little)
+    """
+    dtype = np.dtype(TIFF_INT_TYPES[tiff_type]).newbyteorder(">" if is_big_endian else "<")
+    return np.frombuffer(bytes_data, dtype=dtype).tolist()
 
 
 def compression_image(img, rows_per_strip, predictor=PREDICTOR.NONE,
@@ -143,11 +211,7 @@ def compression_image(img, rows_per_strip, predictor=PREDICTOR.NONE,
         tile = tile.reshape(size)
 
         # perform compression
-        match compression:
-            case COMPRESSION.ADOBE_DEFLATE:
-                tile = zlib.compress(tile)
-            case COMPRESSION.LZW:
-                tile = lzw_encode(tile)
+        tile = compress_chunk(tile, compression)
 
         # add the strip into result
         rs.append(IMGTile(i, tile))
@@ -155,6 +219,61 @@ def compression_image(img, rows_per_strip, predictor=PREDICTOR.NONE,
     return rs
 
 
+def compression_image_tiled(img, tile_width, tile_length, predictor=PREDICTOR.NONE,
+                            compression=COMPRESSION.NONE, max_workers=COMPRESSION_WORKERS):
+    """ Perform compression for a tiled image,
+        the tiles are compressed in parallel (zlib and imagecodecs release the GIL)
+
+        Parameters:
+            img:
+                image data: numpy.array
+            tile_width, tile_length:
+                size of a tile, the tiles at the right and bottom edges are padded with zeros.
+                TilesPerImage = TilesAcross * TilesDown, in row-major order
+            max_workers:
+                number of threads
+    """
+    height, width, samples_per_pixel = img.shape
+    tiles_across = (width + tile_width - 1) // tile_width
+    tiles_down = (height + tile_length - 1) // tile_length
+
+    predictor_codec = predictor_encode_codec(predictor) if predictor != 1 else None
+
+    def compress_tile(index):
+        row, column = divmod(index, tiles_across)
+        part = img[row * tile_length: (row + 1) * tile_length, column * tile_width: (column + 1) * tile_width]
+
+        tile = np.zeros((tile_length, tile_width, samples_per_pixel), dtype=img.dtype)
+        tile[:part.shape[0], :part.shape[1]] = part
+
+        # the predictor is applied to each tile (the first column of a tile is not predicted)
+        if predictor_codec is not None:
+            tile = predictor_codec(tile, axis=-2, out=tile)
+
+        return IMGTile(index, compress_chunk(tile.reshape(tile.size), compression))
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(compress_tile, range(tiles_across * tiles_down)))
+
+
+def compress_chunk(chunk, compression=COMPRESSION.NONE):
+    """ Compress a strip or a tile
+
+        Parameters:
+            chunk:
+                image data of the strip/tile: numpy.array (1 dimension)
+            compression:
+                COMPRESSION
+    """
+    match compression:
+        case COMPRESSION.ADOBE_DEFLATE:
+            return zlib.compress(chunk)
+        case COMPRESSION.LZW:
+            return lzw_encode(chunk)
+
+    return chunk
+
+
 def predictor_encode_codec(key):
     try:
         match key:
@@ -1,6 +1,8 @@
+from collections import Counter
 from typing import TypeVar, Generic, Type, List
 from sqlalchemy.orm import Session, selectinload
 from sqlalchemy.future import select
+from sqlalchemy import update
 from db.model import Case, Patient, Study, WSI
 
 T = TypeVar("T")
@@ -83,6 +85,34 @@ class WSIDAO(DAO):
     def __init__(self, db_session: Session, auto_commit=True):
         super().__init__(WSI, db_session, auto_commit)
 
+    async def get_store_names(self) -> Counter:
+        """ names of the records in the store used by slides, with the number of slides using each one """
+        q = await self.session.execute(select(WSI.pseudo_label_name, WSI.pseudo_macro_name, WSI.pseudo_metadata_name))
+        return Counter(name for row in q.all() for name in row if name is not None)
+
+    async def get_batch_after(self, last_id, limit) -> List[WSI]:
+        """ slides ordered by id, after the slide "last_id" (keyset pagination, "" for the first batch) """
+        q = await self.session.execute(select(WSI).where(WSI.id > last_id).order_by(WSI.id).limit(limit))
+        return q.scalars().all()
+
+    async def replace_store_records(self, wsi_id, old_values: dict, new_values: dict) -> bool:
+        """ replace the names and keys of records in the store of a slide,
+            only if the slide still has the old values (it was not changed in the meantime) """
+        conditions = [getattr(WSI, column) == value for column, value in old_values.items()]
+        q = await self.session.execute(update(WSI).where(WSI.id == wsi_id, *conditions).values(**new_values))
+        return q.rowcount == 1
+
+    async def stream_store_records(self, batch_size=1000):
+        """ name and key of every record in the store used by a slide,
+            the rows are fetched in batches with a server-side cursor (the table can have millions of slides) """
+        result = await self.session.stream(
+            select(WSI.pseudo_label_name, WSI.pseudo_label_key, WSI.pseudo_macro_name, WSI.pseudo_macro_key,
+                   WSI.pseudo_metadata_name, WSI.pseudo_metadata_key).execution_options(yield_per=batch_size))
+        async for row in result:
+            for name, key in zip(row[::2], row[1::2]):
+                if name is not None:
+                    yield name, key
+
 
 class CaseDAO(DAO):
 
@@ -0,0 +1,489 @@
+import errno
+import io
+import mmap
+import os
+import shutil
+import time
+from contextlib import contextmanager
+from enum import Enum
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+try:
+    import msvcrt
+except ImportError:  # not Windows
+    msvcrt = None
+
+try:
+    import ctypes
+
+    _fallocate = ctypes.CDLL(None, use_errno=True).fallocate
+    _fallocate.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_int64, ctypes.c_int64]
+    _fallocate.restype = ctypes.c_int
+except (ImportError, OSError, AttributeError, TypeError):  # not Linux
+    _fallocate = None
+
+FICLONE = 0x40049409  # ioctl request of Linux to share the extents of a file (_IOW(0x94, 9, int))
+COPY_BUFFER_SIZE = 8 * 1024 * 1024  # buffer size of the user-space copy
+COPY_CHUNK_SIZE = 1024 * 1024 * 1024  # max bytes for a single copy_file_range/sendfile call
+ZERO_CHUNK_SIZE = 1024 * 1024  # max size of the buffer used to write zeros
+FALLOC_FL_KEEP_SIZE = 0x01
+FALLOC_FL_PUNCH_HOLE = 0x02
+
+try:
+    IOV_MAX = os.sysconf("SC_IOV_MAX")  # max number of buffers of a single pwritev call
+except (AttributeError, ValueError, OSError):
+    IOV_MAX = 1024
+if IOV_MAX <= 0:
+    IOV_MAX = 1024
+
+# errors meaning "this strategy is not possible here", so the next strategy will be tried
+FALLBACK_ERRNOS = {errno.EOPNOTSUPP, errno.ENOTSUP, errno.EXDEV, errno.EINVAL, errno.ENOSYS,
+                   errno.ENOTTY, errno.EBADF, errno.EPERM}
+
+
+class CloneStrategy(Enum):
+    """
+        Strategies to clone a file, from the cheapest to the most expensive one
+    """
+    REFLINK = "reflink"  # copy-on-write clone, no data is copied (btrfs, xfs, ...)
+    SPARSE = "sparse"  # copy only the data extents of a sparse file, holes stay holes
+    COPY_FILE_RANGE = "copy_file_range"  # copy inside the kernel (can use server-side copy on NFS/SMB)
+    SENDFILE = "sendfile"  # copy inside the kernel
+    BUFFERED = "buffered"  # copy in user-space
+
+
+def _reflink(src_fd, dest_fd, size):
+    """
+        clone all extents of the source file into the destination file
+    """
+    if fcntl is None:
+        raise OSError(errno.ENOSYS, "ioctl is not available")
+
+    fcntl.ioctl(dest_fd, FICLONE, src_fd)
+
+
+def _sparse_copy(src_fd, dest_fd, size):
+    """
+        copy only the data extents of a sparse file (e.g. with punched holes), the holes are not written
+    """
+    if not hasattr(os, "SEEK_DATA") or os.fstat(src_fd).st_blocks * 512 >= size:
+        # the file has no holes, a full copy is cheaper
+        raise OSError(errno.ENOTSUP, "File is not sparse")
+
+    for start, end in data_extents(src_fd, 0, size):
+        _copy_fd_range(src_fd, dest_fd, start, end - start)
+
+    # a hole at the end of the file
+    os.ftruncate(dest_fd, size)
+
+
+def _copy_fd_range(src_fd, dest_fd, offset, length):
+    """
+        copy a range of a file into the same range of another file (inside the kernel if possible)
+    """
+    copied = 0
+    if hasattr(os, "copy_file_range"):
+        try:
+            while copied < length:
+                done = os.copy_file_range(src_fd, dest_fd, min(COPY_CHUNK_SIZE, length - copied),
+                                          offset + copied, offset + copied)
+                if done == 0:
+                    raise OSError(errno.EIO, "Source file is shorter than expected")
+                copied += done
+            return
+        except OSError as ex:
+            if ex.errno not in FALLBACK_ERRNOS:
+                raise
+
+    while copied < length:
+        data = os.pread(src_fd, min(COPY_BUFFER_SIZE, length - copied), offset + copied)
+        if not data:
+            raise OSError(errno.EIO, "Source file is shorter than expected")
+        os.pwrite(dest_fd, data, offset + copied)
+        copied += len(data)
+
+
+def _copy_file_range(src_fd, dest_fd, size):
+    """
+        copy the file inside the kernel by using copy_file_range
+    """
+    if not hasattr(os, "copy_file_range"):
+        raise OSError(errno.ENOSYS, "copy_file_range is not available")
+
+    offset = 0
+    while offset < size:
+        copied = os.copy_file_range(src_fd, dest_fd, min(COPY_CHUNK_SIZE, size - offset), offset, offset)
+        if copied == 0:
+            raise OSError(errno.EIO, "Source file is shorter than expected")
+        offset += copied
+
+
+def _sendfile(src_fd, dest_fd, size):
+    """
+        copy the file inside the kernel by using sendfile
+    """
+    if not hasattr(os, "sendfile"):
+        raise OSError(errno.ENOSYS, "sendfile is not available")
+
+    offset = 0
+    while offset < size:
+        sent = os.sendfile(dest_fd, src_fd, offset, min(COPY_CHUNK_SIZE, size - offset))
+        if sent == 0:
+            raise OSError(errno.EIO, "Source file is shorter than expected")
+        offset += sent
+
+
+def _buffered_copy(src_fd, dest_fd, size):
+    """
+        copy the file in user-space by using a reusable buffer
+    """
+    buffer = bytearray(COPY_BUFFER_SIZE)
+    view = memoryview(buffer)
+
+    with io.FileIO(src_fd, "rb", closefd=False) as src, io.FileIO(dest_fd, "wb", closefd=False) as dest:
+        src.seek(0)
+        dest.seek(0)
+        while True:
+            read = src.readinto(buffer)
+            if not read:
+                break
+
+            written = 0
+            while written < read:
+                written += dest.write(view[written:read])
+
+
+CLONE_STRATEGIES = [
+    (CloneStrategy.REFLINK, _reflink),
+    (CloneStrategy.SPARSE, _sparse_copy),
+    (CloneStrategy.COPY_FILE_RANGE, _copy_file_range),
+    (CloneStrategy.SENDFILE, _sendfile),
+    (CloneStrategy.BUFFERED, _buffered_copy),
+]
+
+
+def clone_file(src_path, dest_path) -> CloneStrategy:
+    """
+        Clone a file like shutil.copy2, but try the cheapest strategy first:
+        reflink -> sparse copy (only for files with holes) -> copy_file_range -> sendfile -> buffered copy.
+        If a strategy is not supported by the OS/filesystem, the destination is reset and the next one is tried.
+        :param src_path: path of the source file
+        :param dest_path: path of the clone (must not exist)
+        :return: strategy that was used (CloneStrategy)
+    """
+    src_fd = os.open(src_path, os.O_RDONLY | getattr(os, "O_BINARY", 0))
+    dest_fd = None
+    try:
+        dest_fd = os.open(dest_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, "O_BINARY", 0), 0o644)
+        size = os.fstat(src_fd).st_size
+        used_strategy = None
+
+        for strategy, copy_function in CLONE_STRATEGIES:
+            try:
+                copy_function(src_fd, dest_fd, size)
+                used_strategy = strategy
+                break
+            except OSError as ex:
+                if strategy is CloneStrategy.BUFFERED or ex.errno not in FALLBACK_ERRNOS:
+                    raise
+
+                # strategy is not supported, reset the clone and try the next one
+                os.ftruncate(dest_fd, 0)
+
+        if os.fstat(dest_fd).st_size != size:
+            raise OSError(errno.EIO, "Size of the clone does not match the source file")
+    except Exception:
+        # remove the incomplete clone (only if it was created here)
+        if dest_fd is not None:
+            os.close(dest_fd)
+            dest_fd = None
+            os.unlink(dest_path)
+        raise
+    finally:
+        if dest_fd is not None:
+            os.close(dest_fd)
+        os.close(src_fd)
+
+    # copy permission bits and timestamps like shutil.copy2
+    shutil.copystat(src_path, dest_path)
+
+    return used_strategy
+
+
+def copy_range(src, dest, offset, length, buffer=None):
+    """
+        Copy a range of a file into the same range of another file.
+        The copy is done inside the kernel (copy_file_range) if possible, otherwise in user-space.
+        Holes of the source are skipped, so they stay holes in the destination
+        (the caller has to set the final size of the destination, if it ends with a hole).
+        :param src: source file object
+        :param dest: destination file object
+        :param offset: offset of the range (same in both files)
+        :param length: length of the range
+        :param buffer: reusable buffer (bytearray) for the user-space copy
+    """
+    if length <= 0:
+        return
+
+    for start, end in data_extents(src.fileno(), offset, length):
+        _copy_extent(src, dest, start, end - start, buffer)
+
+
+def _copy_extent(src, dest, offset, length, buffer=None):
+    if hasattr(os, "copy_file_range"):
+        try:
+            dest.flush()
+            copied = 0
+            while copied < length:
+                done = os.copy_file_range(src.fileno(), dest.fileno(), min(COPY_CHUNK_SIZE, length - copied),
+                                          offset + copied, offset + copied)
+                if done == 0:
+                    raise OSError(errno.EIO, "Source file is shorter than expected")
+                copied += done
+            return
+        except OSError as ex:
+            if ex.errno not in FALLBACK_ERRNOS:
+                raise
+
+    if buffer is None:
+        buffer = bytearray(min(COPY_BUFFER_SIZE, length))
+    view = memoryview(buffer)
+
+    src.seek(offset)
+    dest.seek(offset)
+    remaining = length
+    while remaining > 0:
+        read = src.readinto(view[:min(len(buffer), remaining)])
+        if not read:
+            raise OSError(errno.EIO, "Source file is shorter than expected")
+        dest.write(view[:read])
+        remaining -= read
+
+
+def data_extents(fd, offset, length):
+    """
+        Find the ranges of a file, which contain data (not holes), by using SEEK_DATA/SEEK_HOLE.
+        If it is not supported, the whole range is returned.
+        The position of the file descriptor is not changed.
+        :param fd: file descriptor
+        :param offset: start of the range
+        :param length: length of the range
+        :return: generator of (start, end)
+    """
+    end = offset + length
+    if not hasattr(os, "SEEK_DATA"):
+        yield offset, end
+        return
+
+    position = offset
+    while position < end:
+        current = os.lseek(fd, 0, os.SEEK_CUR)
+        try:
+            data_start = os.lseek(fd, position, os.SEEK_DATA)
+            data_end = min(end, os.lseek(fd, data_start, os.SEEK_HOLE))
+        except OSError as ex:
+            if ex.errno == errno.ENXIO:  # only a hole until the end of the file
+                return
+            if ex.errno not in FALLBACK_ERRNOS:
+                raise
+            data_start, data_end = position, end
+        finally:
+            os.lseek(fd, current, os.SEEK_SET)
+
+        if data_start >= end:
+            return
+
+        yield data_start, data_end
+        position = data_end
+
+
+def punch_hole(fd, offset, length):
+    """
+        Deallocate a range of a file (the range reads as zeros, the size of the file is not changed).
+        Raises OSError if it is not supported by the OS/filesystem.
+        :param fd: file descriptor
+        :param offset: start of the range
+        :param length: length of the range
+    """
+    if _fallocate is None:
+        raise OSError(errno.ENOSYS, "fallocate is not available")
+
+    if _fallocate(fd, FALLOC_FL_PUNCH_HOLE | FALLOC_FL_KEEP_SIZE, offset, length) != 0:
+        error = ctypes.get_errno()
+        raise OSError(error, os.strerror(error))
+
+
+def zero_range(f, offset, length):
+    """
+        Overwrite a range of a file with zeros. The whole blocks inside the range are deallocated
+        (punch_hole) if the filesystem supports it, only the partial blocks at the edges are written.
+        :param f: file object opened for writing
+        :param offset: start of the range
+        :param length: length of the range
+    """
+    end = offset + length
+    block_size = os.fstat(f.fileno()).st_blksize or 4096
+    head_end = min(end, -(-offset // block_size) * block_size)
+    tail_start = max(head_end, end // block_size * block_size)
+
+    _write_zeros(f, offset, head_end)
+
+    if tail_start > head_end:
+        f.flush()
+        size = os.fstat(f.fileno()).st_size
+        punch_end = min(tail_start, size)
+        if punch_end > head_end:
+            try:
+                punch_hole(f.fileno(), head_end, punch_end - head_end)
+            except OSError as ex:
+                if ex.errno not in FALLBACK_ERRNOS:
+                    raise
+                _write_zeros(f, head_end, punch_end)
+
+        if tail_start > size:
+            # the range is after the end of the file, extending the file leaves a hole
+            os.ftruncate(f.fileno(), tail_start)
+
+    _write_zeros(f, tail_start, end)
+
+
+def _write_zeros(f, start, end):
+    if end <= start:
+        return
+
+    zeros = memoryview(bytes(min(ZERO_CHUNK_SIZE, end - start)))
+    f.seek(start)
+    while start < end:
+        start += f.write(zeros[:end - start])
+
+
+def write_vectored(fd, buffers, offset):
+    """
+        Write a list of buffers into a contiguous range of a file with as few syscalls as possible (pwritev).
+        If pwritev is not available (e.g. Windows), the joined buffers are written at once.
+        :param fd: file descriptor
+        :param buffers: list of bytes-like objects, written one after the other
+        :param offset: start of the range
+        :return: number of write syscalls
+    """
+    views = [memoryview(buffer).cast("B") for buffer in buffers if len(buffer) > 0]
+    syscalls = 0
+
+    if not hasattr(os, "pwritev"):
+        data = memoryview(b"".join(views))
+        os.lseek(fd, offset, os.SEEK_SET)
+        while len(data) > 0:
+            written = os.write(fd, data)
+            if written == 0:
+                raise OSError(errno.EIO, "Nothing was written")
+            data = data[written:]
+            syscalls += 1
+        return syscalls
+
+    index = 0
+    while index < len(views):
+        written = os.pwritev(fd, views[index:index + IOV_MAX], offset)
+        if written == 0:
+            raise OSError(errno.EIO, "Nothing was written")
+        syscalls += 1
+        offset += written
+
+        # skip the written buffers, a partial write continues in the middle of a buffer
+        while index < len(views) and written >= len(views[index]):
+            written -= len(views[index])
+            index += 1
+        if written > 0:
+            views[index] = views[index][written:]
+
+    return syscalls
+
+
+def read_ranges(f, offsets, lengths, use_mmap=False):
+    """
+        Read ranges of a file into one preallocated buffer, one after the other in the given order.
+        The ranges do not need to be contiguous in the file, adjacent ranges are read at once.
+        :param f: file object opened for reading
+        :param offsets: start offsets of the ranges
+        :param lengths: lengths of the ranges
+        :param use_mmap: copy the ranges from a memory map of the file instead of reading them
+        :return: bytearray of sum(lengths) bytes
+    """
+    buffer = bytearray(sum(lengths))
+    view = memoryview(buffer)
+    size = os.fstat(f.fileno()).st_size
+
+    # merge the ranges, which follow each other in the file
+    runs = []  # (offset in file, offset in buffer, length)
+    position = 0
+    for offset, length in zip(offsets, lengths):
+        if offset + length > size:
+            raise OSError(errno.EIO, f"Range at offset {offset} is after the end of the file")
+        if runs and runs[-1][0] + runs[-1][2] == offset:
+            runs[-1] = (runs[-1][0], runs[-1][1], runs[-1][2] + length)
+        else:
+            runs.append((offset, position, length))
+        position += length
+
+    if use_mmap and len(buffer) > 0:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped, memoryview(mapped) as source:
+            for offset, position, length in runs:
+                view[position:position + length] = source[offset:offset + length]
+        return buffer
+
+    for offset, position, length in runs:
+        f.seek(offset)
+        read = f.readinto(view[position:position + length])
+        if read != length:
+            raise OSError(errno.EIO, "File is shorter than expected")
+
+    return buffer
+
+
+def fsync_directory(path):
+    """
+        Flush the entries of a directory (e.g. after creating or renaming a file) to the disk.
+        Not supported on Windows, so nothing is done there.
+        :param path: path of the directory
+    """
+    if not hasattr(os, "O_DIRECTORY"):
+        return
+
+    fd = os.open(path, os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+@contextmanager
+def locked_file(f):
+    """
+        Hold an exclusive lock of an open file, it is shared by all processes (e.g. of the same store),
+        wait until the lock is free. The lock is not re-entrant, do not lock the same file twice.
+        :param f: file object (opened for writing)
+    """
+    if fcntl is not None:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+        return
+
+    # Windows: lock the first byte of the file
+    f.seek(0)
+    while True:
+        try:
+            msvcrt.locking(f.fileno(), msvcrt.LK_NBLCK, 1)
+            break
+        except OSError:
+            time.sleep(0.01)
+    try:
+        yield
+    finally:
+        f.seek(0)
+        msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
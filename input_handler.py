@@ -2,7 +2,13 @@ import jsonschema
 import pathlib
 import json
 import os
+import sqlite3
+import struct
 import tifffile
+from contextlib import contextmanager
+import file_utils as fu
+import patch_utils as pa
+import compression_utils as cu
 from enum import IntEnum, Enum
 
 
@@ -10,6 +16,42 @@ abs_path_to_wsi_schema = './jsonschema/wsi.json'
 abs_path_to_case_schema = './jsonschema/case.json'
 abs_path_to_study_schema = './jsonschema/study.json'
 
+IFD_READ_SIZE = 64 * 1024  # size of a read while walking the IFD chain (IFD entries and small values)
+IFD_CACHE_PATH = "data/cache/ifd_index.sqlite"  # persistent cache of parsed IFD chains
+IFD_CACHE_VERSION = 3  # version of the binary format of a cached IFD chain
+# the only values of tags, which are cached: the numeric structure of the images (size, compression, strips/tiles,
+# SourceLens of NDPI). Never ASCII values, e.g. the ImageDescription contains the personal data, which are removed
+IFD_CACHE_VALUE_TAGS = (254, 256, 257, 258, 259, 262, 273, 277, 278, 279, 284, 317, 322, 323, 324, 325, 65421)
+IFD_CACHE_UNKNOWN = 255  # a fact derived from the descriptions, which was not known when the chain was cached
+# byte order, is BigTIFF, file size, first IFD offset, number of IFDs, is SVS (0, 1 or IFD_CACHE_UNKNOWN)
+IFD_CACHE_HEADER = struct.Struct("<BBQQIB")
+# offset of IFD, number of tags, type of associated image (0: none, SubImageType or IFD_CACHE_UNKNOWN)
+IFD_CACHE_IFD = struct.Struct("<QIB")
+IFD_CACHE_TAG = struct.Struct("<HHQQQq")  # code, dtype, count, offset, value offset, length of value (-1: not read)
+
+# TIFF data type: (struct format of an item, number of items of a value, size of a value)
+TIFF_DATA_TYPES = {
+    1: ("B", 1, 1),  # BYTE
+    2: ("s", 1, 1),  # ASCII
+    3: ("H", 1, 2),  # SHORT
+    4: ("I", 1, 4),  # LONG
+    5: ("I", 2, 8),  # RATIONAL
+    6: ("b", 1, 1),  # SBYTE
+    7: ("B", 1, 1),  # UNDEFINED
+    8: ("h", 1, 2),  # SSHORT
+    9: ("i", 1, 4),  # SLONG
+    10: ("i", 2, 8),  # SRATIONAL
+    11: ("f", 1, 4),  # FLOAT
+    12: ("d", 1, 8),  # DOUBLE
+    13: ("I", 1, 4),  # IFD
+    16: ("Q", 1, 8),  # LONG8
+    17: ("q", 1, 8),  # SLONG8
+    18: ("Q", 1, 8),  # IFD8
+}
+
+# tags, whose value is always a tuple (even with only one item)
+TIFF_TUPLE_TAGS = {273, 279, 324, 325}
+
 class Vendor(Enum):
     """
         The library can read slides in the following formats:
@@ -38,6 +80,636 @@ class SubImageType(IntEnum):
     MACRO = 2
 
 
+class TiffTag:
+    """ Tag of an image file directory (IFD)
+        the value is only read and decoded when it is used
+
+        :parameter
+            chain: the IFD chain of the file (TiffIfdChain)
+            code: tag code
+            dtype: TIFF data type
+            count: number of values
+            offset: position of the tag entry in the file
+            valueoffset: position of the value in the file (inside the entry, if the value fits into it)
+            raw: bytes of the value, if they are already read
+    """
+    def __init__(self, chain, code, dtype, count, offset, valueoffset, raw=None):
+        self.chain = chain
+        self.code = code
+        self.dtype = dtype
+        self.count = count
+        self.offset = offset
+        self.valueoffset = valueoffset
+        self._raw = raw
+        self._value = None
+
+    @property
+    def value_size(self):
+        return TIFF_DATA_TYPES[self.dtype][2] * self.count
+
+    @property
+    def count_offset(self):
+        """
+            position of the count field of the tag entry
+        """
+        return self.offset + 4
+
+    @property
+    def value_field_offset(self):
+        """
+            position of the value/offset field of the tag entry (4 bytes in TIFF, 8 bytes in BigTIFF)
+        """
+        return self.offset + 4 + self.chain.offset_size
+
+    def pack_values(self, values):
+        """
+            encode integer values with the data type and the byte order of the tag
+            :param values: list of int
+            :return: bytes
+        """
+        if self.dtype not in cu.TIFF_INT_TYPES:
+            raise Exception(f"Tag {self.code} does not contain integers")
+
+        try:
+            return cu.ints_to_bytes(values, self.dtype, is_big_endian=self.chain.byte_order == ">")
+        except OverflowError:
+            raise Exception(f"Values do not fit into the data type of tag {self.code}"
+                            f"{'' if self.chain.is_bigtiff else ' (classic TIFF is limited to 4 GB)'}") from None
+
+    @property
+    def value(self):
+        if self._value is None:
+            if self._raw is None:
+                self._raw = self.chain.read(self.valueoffset, self.value_size)
+            self._value = self._decode(self._raw)
+
+        return self._value
+
+    def _decode(self, raw):
+        if self.dtype == 2:  # ASCII, can contain multiple strings terminated with NUL
+            raw = raw.rstrip(b"\x00").strip()
+            try:
+                return raw.decode("utf-8")
+            except UnicodeDecodeError:
+                return raw.decode("cp1252")
+
+        if self.dtype in (1, 7):  # BYTE, UNDEFINED
+            return raw
+
+        item_format, items, _ = TIFF_DATA_TYPES[self.dtype]
+        if self.dtype in cu.TIFF_INT_TYPES:
+            value = tuple(cu.ints_from_bytes(raw, self.dtype, is_big_endian=self.chain.byte_order == ">"))
+        else:
+            value = struct.unpack(f"{self.chain.byte_order}{self.count * items}{item_format}", raw)
+
+        if items == 2:  # RATIONAL, SRATIONAL
+            value = tuple(zip(value[0::2], value[1::2]))
+
+        if len(value) == 1 and self.code not in TIFF_TUPLE_TAGS:
+            return value[0]
+
+        return value
+
+
+class TiffIfd:
+    """ Image file directory (IFD)
+        contains only the properties that are needed to find and patch the associated images and the metadata,
+        the names are the same as tifffile.TiffPage
+
+        :parameter
+            chain: the IFD chain of the file (TiffIfdChain)
+            index: index of the IFD in the chain
+            offset: position of the IFD in the file
+            tags: dict of tag code and TiffTag
+    """
+    def __init__(self, chain, index, offset, tags, image_type=None):
+        self.chain = chain
+        self.index = index
+        self.offset = offset
+        self.tags = tags
+        self._image_type = image_type  # None: not known yet, 0: no associated image
+
+    def value_of(self, code, default=None):
+        tag = self.tags.get(code)
+        return default if tag is None else tag.value
+
+    def enum_of(self, code, enum_type, default=None):
+        """
+            value of a tag as an enum of tifffile (e.g. tifffile.COMPRESSION), unknown values stay int
+        """
+        value = self.value_of(code, default)
+        try:
+            return enum_type(value)
+        except ValueError:
+            return value
+
+    @property
+    def imagewidth(self):
+        return self.value_of(256, 0)
+
+    @property
+    def imagelength(self):
+        return self.value_of(257, 0)
+
+    @property
+    def bitspersample(self):
+        value = self.value_of(258, 1)
+        return value[0] if isinstance(value, tuple) else value
+
+    @property
+    def compression(self):
+        return self.enum_of(259, tifffile.COMPRESSION, 1)
+
+    @property
+    def photometric(self):
+        return self.enum_of(262, tifffile.PHOTOMETRIC)
+
+    @property
+    def description(self):
+        value = self.value_of(270, "")
+        return value if isinstance(value, str) else ""
+
+    @property
+    def image_type(self):
+        """
+            type of the associated image, found in the description (Aperio)
+            :return: SubImageType, None if the IFD is not a label or a macro
+        """
+        if self._image_type is None:
+            description = self.description.lower()
+            if "label" in description:
+                self._image_type = SubImageType.LABEL
+            elif "macro" in description:
+                self._image_type = SubImageType.MACRO
+            else:
+                self._image_type = 0
+        return SubImageType(self._image_type) if self._image_type else None
+
+    @property
+    def samplesperpixel(self):
+        return self.value_of(277, 1)
+
+    @property
+    def rowsperstrip(self):
+        if self.is_tiled:
+            return 0
+        return min(self.value_of(278, 2 ** 32 - 1), self.imagelength)
+
+    @property
+    def planarconfig(self):
+        return self.value_of(284, 1)
+
+    @property
+    def predictor(self):
+        return self.enum_of(317, tifffile.PREDICTOR, 1)
+
+    @property
+    def is_tiled(self):
+        return 322 in self.tags
+
+    @property
+    def tilewidth(self):
+        return self.value_of(322, 0)
+
+    @property
+    def tilelength(self):
+        return self.value_of(323, 0)
+
+    @property
+    def dataoffsets(self):
+        return self.value_of(324 if self.is_tiled else 273, ())
+
+    @property
+    def databytecounts(self):
+        return self.value_of(325 if self.is_tiled else 279, ())
+
+    @property
+    def shape(self):
+        """
+            shape of the image like tifffile.TiffPage.shape
+        """
+        if self.samplesperpixel == 1:
+            return self.imagelength, self.imagewidth
+        if self.planarconfig == 2:  # separate
+            return self.samplesperpixel, self.imagelength, self.imagewidth
+        return self.imagelength, self.imagewidth, self.samplesperpixel
+
+
+class TiffIfdChain:
+    """ Minimal reader of the IFD chain of a TIFF/BigTIFF file
+        only the header and the IFD entries are read (with a few large reads), the values of the tags
+        are read when they are used. Much cheaper than tifffile.TiffFile, which also builds series and levels.
+
+        :parameter
+            path: path of the file
+            filehandle: opened file (e.g. of a SlideHandle), it is not closed by the chain.
+                If it is None, the chain opens the file itself
+    """
+    def __init__(self, path, filehandle=None):
+        self.path = path
+        self.own_filehandle = filehandle is None
+        self.filehandle = open(path, "rb") if filehandle is None else filehandle
+        self.file_size = os.fstat(self.filehandle.fileno()).st_size
+        self._window_offset = 0
+        self._window = b""
+        self._is_svs = None
+        self.ifds = []
+
+        try:
+            self._read_header()
+            self._read_ifds()
+        except Exception:
+            self.close()
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        if self.own_filehandle and self.filehandle is not None:
+            self.filehandle.close()
+        self.detach()
+
+    def attach(self, filehandle):
+        """
+            read the values of the tags from an opened file (of a SlideHandle)
+        """
+        self.filehandle = filehandle
+        self.own_filehandle = False
+        self._window = b""
+
+    def detach(self):
+        """
+            forget the opened file, values that are still not read are read with a short-lived handle
+        """
+        self.filehandle = None
+        self._window = b""
+
+    @property
+    def is_svs(self):
+        if self._is_svs is None:
+            self._is_svs = len(self.ifds) > 0 and self.ifds[0].description[:7] == "Aperio "
+        return self._is_svs
+
+    @property
+    def is_ndpi(self):
+        return len(self.ifds) > 0 and 65420 in self.ifds[0].tags and 271 in self.ifds[0].tags
+
+    @property
+    def flags(self):
+        """
+            available extensions of the file (like tifffile.TiffFile.flags)
+        """
+        flags = set()
+        if self.is_svs:
+            flags.add("svs")
+        if self.is_ndpi:
+            flags.add("ndpi")
+        return flags
+
+    def pack_offset(self, value):
+        """
+            encode a count or an offset of an IFD entry (4 bytes in TIFF, 8 bytes in BigTIFF)
+            :param value: int
+            :return: bytes
+        """
+        try:
+            return struct.pack(f"{self.byte_order}{'Q' if self.is_bigtiff else 'I'}", value)
+        except struct.error:
+            raise Exception(f"{value} does not fit into an IFD entry "
+                            f"{'' if self.is_bigtiff else '(classic TIFF is limited to 4 GB)'}") from None
+
+    def to_bytes(self):
+        """
+            serialise the structure of the IFD chain for IfdIndexCache: the tag entries, only the numeric values,
+            which were already read (see IFD_CACHE_VALUE_TAGS), and the facts found in the descriptions
+            (SVS, label and macro), so a cached slide is parsed without reading the file
+            :return: bytes
+        """
+        is_svs = IFD_CACHE_UNKNOWN if self._is_svs is None else int(self._is_svs)
+        data = [IFD_CACHE_HEADER.pack(1 if self.byte_order == ">" else 0, self.is_bigtiff, self.file_size,
+                                      self.first_ifd_offset, len(self.ifds), is_svs)]
+        for ifd in self.ifds:
+            image_type = IFD_CACHE_UNKNOWN if ifd._image_type is None else int(ifd._image_type)
+            data.append(IFD_CACHE_IFD.pack(ifd.offset, len(ifd.tags), image_type))
+            for tag in ifd.tags.values():
+                raw = tag._raw if tag.code in IFD_CACHE_VALUE_TAGS and tag.dtype != 2 else None
+                data.append(IFD_CACHE_TAG.pack(tag.code, tag.dtype, tag.count, tag.offset, tag.valueoffset,
+                                               -1 if raw is None else len(raw)))
+                if raw is not None:
+                    data.append(raw)
+
+        return b"".join(data)
+
+    @staticmethod
+    def from_bytes(path, data):
+        """
+            create an IFD chain from serialised data (see to_bytes), the file is not opened.
+            Values that are not in the data are read from the file when they are used
+            :param path: path of the file
+            :param data: bytes
+            :return: TiffIfdChain
+        """
+        chain = TiffIfdChain.__new__(TiffIfdChain)
+        chain.path = path
+        chain.own_filehandle = False
+        chain.filehandle = None
+        chain._window_offset = 0
+        chain._window = b""
+        chain.ifds = []
+
+        byte_order, is_bigtiff, chain.file_size, chain.first_ifd_offset, ifd_count, is_svs = \
+            IFD_CACHE_HEADER.unpack_from(data, 0)
+        chain._is_svs = None if is_svs == IFD_CACHE_UNKNOWN else bool(is_svs)
+        chain.byte_order = ">" if byte_order == 1 else "<"
+        chain.is_bigtiff = bool(is_bigtiff)
+        chain.offset_size = 8 if chain.is_bigtiff else 4
+        position = IFD_CACHE_HEADER.size
+
+        for index in range(ifd_count):
+            ifd_offset, tag_count, image_type = IFD_CACHE_IFD.unpack_from(data, position)
+            position += IFD_CACHE_IFD.size
+
+            tags = {}
+            for _ in range(tag_count):
+                code, dtype, count, offset, valueoffset, raw_size = IFD_CACHE_TAG.unpack_from(data, position)
+                position += IFD_CACHE_TAG.size
+                raw = None
+                if raw_size >= 0:
+                    raw = bytes(data[position:position + raw_size])
+                    position += raw_size
+                tags[code] = TiffTag(chain, code, dtype, count, offset, valueoffset, raw)
+
+            chain.ifds.append(TiffIfd(chain, index, ifd_offset, tags,
+                                      None if image_type == IFD_CACHE_UNKNOWN else image_type))
+
+        return chain
+
+    def read(self, offset, size):
+        """
+            read bytes of the file, small reads are served from a window of IFD_READ_SIZE bytes
+            :param offset: position in the file
+            :param size: number of bytes
+            :return: bytes
+        """
+        if self._window_offset <= offset and offset + size <= self._window_offset + len(self._window):
+            start = offset - self._window_offset
+            return self._window[start:start + size]
+
+        if self.filehandle is None:
+            # the slide is not opened anymore, it is opened for this read (the window serves the next reads)
+            with open(self.path, "rb") as f:
+                return self._read_file(f, offset, size)
+
+        return self._read_file(self.filehandle, offset, size)
+
+    def _read_file(self, f, offset, size):
+        f.seek(offset)
+        if size > IFD_READ_SIZE:
+            data = f.read(size)
+        else:
+            self._window_offset = offset
+            self._window = f.read(IFD_READ_SIZE)
+            data = self._window[:size]
+
+        if len(data) != size:
+            raise Exception("Unexpected end of the file")
+        return data
+
+    def _read_header(self):
+        header = self.read(0, 16 if self.file_size >= 16 else 8)
+        if header[:2] == b"II":
+            self.byte_order = "<"
+        elif header[:2] == b"MM":
+            self.byte_order = ">"
+        else:
+            raise Exception("Not a TIFF file")
+
+        version = struct.unpack(f"{self.byte_order}H", header[2:4])[0]
+        if version == 42:
+            self.is_bigtiff = False
+            self.offset_size = 4
+            self.first_ifd_offset = struct.unpack(f"{self.byte_order}I", header[4:8])[0]
+        elif version == 43:
+            self.is_bigtiff = True
+            self.offset_size = 8
+            self.first_ifd_offset = struct.unpack(f"{self.byte_order}Q", header[8:16])[0]
+        else:
+            raise Exception("Not a TIFF file")
+
+    def _read_ifds(self):
+        if self.is_bigtiff:
+            count_format, count_size, entry_format, entry_size = "Q", 8, "HHQ8s", 20
+            offset_format = "Q"
+        else:
+            count_format, count_size, entry_format, entry_size = "H", 2, "HHI4s", 12
+            offset_format = "I"
+
+        entry_struct = struct.Struct(self.byte_order + entry_format)
+        value_size = self.offset_size
+
+        visited = set()
+        ifd_offset = self.first_ifd_offset
+        while ifd_offset != 0 and ifd_offset not in visited:
+            if ifd_offset + count_size > self.file_size:
+                raise Exception(f"Invalid offset of IFD: {ifd_offset}")
+            visited.add(ifd_offset)
+
+            entry_count = struct.unpack(self.byte_order + count_format, self.read(ifd_offset, count_size))[0]
+            entries_offset = ifd_offset + count_size
+            entries = self.read(entries_offset, entry_count * entry_size + self.offset_size)
+
+            tags = {}
+            for idx, (code, dtype, count, value) in enumerate(
+                    entry_struct.iter_unpack(entries[:entry_count * entry_size])):
+                if dtype not in TIFF_DATA_TYPES:
+                    continue  # unknown data type
+
+                tag_offset = entries_offset + idx * entry_size
+                size = TIFF_DATA_TYPES[dtype][2] * count
+                if size <= value_size:
+                    # the value fits into the entry
+                    tag = TiffTag(self, code, dtype, count, tag_offset, tag_offset + 4 + value_size, value[:size])
+                else:
+                    valueoffset = struct.unpack(self.byte_order + offset_format, value)[0]
+                    tag = TiffTag(self, code, dtype, count, tag_offset, valueoffset)
+
+                # the first tag with a code wins (like tifffile)
+                tags.setdefault(code, tag)
+
+            self.ifds.append(TiffIfd(self, len(self.ifds), ifd_offset, tags))
+            ifd_offset = struct.unpack(self.byte_order + offset_format, entries[entry_count * entry_size:])[0]
+
+
+class IfdIndexCache:
+    """ Persistent cache of parsed IFD chains (SQLite)
+        an entry is only used while the file has the same identity (size, mtime, inode, device),
+        so a slide that was already validated can be parsed again without reading its TIFF headers
+
+        :parameter
+            path: path of the SQLite database
+    """
+    def __init__(self, path=IFD_CACHE_PATH):
+        directory = os.path.dirname(path)
+        if directory != "":
+            os.makedirs(directory, exist_ok=True)
+
+        self.connection = sqlite3.connect(path)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS ifd_index ("
+                                "path TEXT PRIMARY KEY, size INTEGER NOT NULL, mtime_ns INTEGER NOT NULL, "
+                                "inode INTEGER NOT NULL, device INTEGER NOT NULL, version INTEGER NOT NULL, "
+                                "data BLOB NOT NULL)")
+
+        # entries of older versions can contain values of tags with personal data
+        with self.connection:
+            self.connection.execute("DELETE FROM ifd_index WHERE version != ?", (IFD_CACHE_VERSION,))
+
+    @staticmethod
+    def file_identity(path):
+        """
+            :param path: path of file
+            :return: resolved path, (size, mtime in ns, inode, device)
+        """
+        full_path = str(pathlib.Path(path).resolve())
+        st = os.stat(full_path)
+        return full_path, (st.st_size, st.st_mtime_ns, st.st_ino, st.st_dev)
+
+    def get(self, path):
+        """
+            get the cached IFD chain of a file
+            :param path: path of file
+            :return: TiffIfdChain, None if it is not cached or the file was changed
+        """
+        try:
+            full_path, identity = self.file_identity(path)
+            row = self.connection.execute("SELECT size, mtime_ns, inode, device, version, data FROM ifd_index "
+                                          "WHERE path = ?", (full_path,)).fetchone()
+            if row is None or tuple(row[:4]) != identity or row[4] != IFD_CACHE_VERSION:
+                return None
+
+            return TiffIfdChain.from_bytes(path, row[5])
+        except (OSError, sqlite3.Error, struct.error):
+            return None
+
+    def put(self, path, tiff: TiffIfdChain):
+        """
+            cache the IFD chain of a file (committed by close)
+            :param path: path of file
+            :param tiff: parsed IFD chain of the file
+        """
+        try:
+            full_path, identity = self.file_identity(path)
+            self.connection.execute("INSERT OR REPLACE INTO ifd_index VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                    (full_path, *identity, IFD_CACHE_VERSION, tiff.to_bytes()))
+        except (OSError, sqlite3.Error):
+            pass
+
+    def delete(self, path):
+        """
+            remove the cached IFD chain of a file (e.g. after it was pseudonymised)
+            :param path: path of file
+        """
+        try:
+            full_path = str(pathlib.Path(path).resolve())
+            self.connection.execute("DELETE FROM ifd_index WHERE path = ?", (full_path,))
+        except (OSError, sqlite3.Error):
+            pass
+
+    def close(self):
+        try:
+            self.connection.commit()
+        finally:
+            self.connection.close()
+
+
+def forget_cached_slide(path, cache_path=IFD_CACHE_PATH):
+    """
+        remove a slide from the persistent cache of parsed slides (IfdIndexCache), if the cache exists
+        :param path: path of slide
+        :param cache_path: path of the cache
+    """
+    if not os.path.exists(cache_path):
+        return
+
+    try:
+        cache = IfdIndexCache(cache_path)
+    except (OSError, sqlite3.Error):
+        return
+    cache.delete(path)
+    cache.close()
+
+
+class SlideHandle:
+    """ Open slide
+        owns one file descriptor and one parsed IFD model for the lifetime of a slide's job,
+        it is shared by the parsing, the reading of the associated images and the patching of the slide.
+        Use it with "with" (or call close), so the file descriptor is not leaked.
+
+        :parameter
+            path: path of slide
+            writable: open the file for patching
+            tiff: IFD model, which was already parsed from the file (TiffIfdChain), it is reused
+            stats: counter of the writes to the slide (patch_utils.WriteStats), e.g. of the slide's job
+    """
+    def __init__(self, path, writable=False, tiff: TiffIfdChain = None, stats: pa.WriteStats = None):
+        self.path = path
+        self.writable = writable
+        self.write_stats = pa.WriteStats() if stats is None else stats
+        self.file = open(path, "r+b" if writable else "rb")
+
+        try:
+            if tiff is None:
+                tiff = TiffIfdChain(path, filehandle=self.file)
+            else:
+                tiff.attach(self.file)
+        except Exception:
+            self.file.close()
+            raise
+
+        self.tiff = tiff
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def apply(self, plan: pa.PatchPlan):
+        """
+            patch the slide, then parse the IFDs again (the patches can change them)
+            :param plan: patch plan of the slide
+        """
+        plan.apply(self.file, stats=self.write_stats)
+        self.tiff.detach()
+        self.tiff = TiffIfdChain(self.path, filehandle=self.file)
+
+    def close(self):
+        if not self.file.closed:
+            self.tiff.detach()
+            self.file.close()
+
+
+@contextmanager
+def slide_handle(slide, writable=False):
+    """
+        use an open slide or open it (it is closed at the end)
+        :param slide: SlideHandle or path of slide
+        :param writable: open the file for patching
+        :return: SlideHandle
+    """
+    if isinstance(slide, SlideHandle):
+        if writable and not slide.writable:
+            raise Exception("Slide is not opened for writing")
+        yield slide
+        return
+
+    with SlideHandle(slide, writable=writable) as handle:
+        yield handle
+
+
 class Slide:
     """ Virtual Slide(WSI) class
                 contains all data of the slide
@@ -50,12 +722,12 @@ class Slide:
             contains data of metadata of the image
 
             :parameter
-                ifd: image file directory of the image (tifffile.TiffPage)
+                ifd: image file directory of the image (TiffIfd)
 
                 img_type: image type (SubImageType)
         """
 
-        def __init__(self, slide, ifd: tifffile.TiffPage, img_type: SubImageType):
+        def __init__(self, slide, ifd: TiffIfd, img_type: SubImageType):
             self.type = img_type
             self.height = ifd.imagelength
             self.width = ifd.imagewidth
@@ -64,30 +736,56 @@ class Slide:
             self.compression = ifd.compression
             self.data_byte_counts = ifd.databytecounts
             self.data_offsets = ifd.dataoffsets
-            self.description = ifd.description
             self.photometric = ifd.photometric
             self.ifd = ifd
             self.parent = slide
+            self._image_data = None
+
+        @property
+        def description(self):
+            # read when it is used, it is not in the cache of parsed slides (IfdIndexCache)
+            return self.ifd.description
+
+        def get_image_data(self, handle: SlideHandle = None, use_mmap=False):
+            """ Get image data of all strips/tiles, in the order of the strips/tiles
+                every strip is read at its own offset (the strips do not need to be contiguous) into one buffer,
+                the data is kept, because the slide can be patched (in place) after it was read
+                :param handle: open slide (SlideHandle), default the slide is opened for the reading
+                :param use_mmap: copy the strips from a memory map of the slide instead of reading them
+                :return
+                    bytearray
+            """
+            if self._image_data is None:
+                with slide_handle(self.parent.path if handle is None else handle) as h:
+                    self._image_data = fu.read_ranges(h.file, self.data_offsets, self.data_byte_counts,
+                                                      use_mmap=use_mmap)
 
-        def get_image_data(self):
-            """ Get image data in tiles
+            return self._image_data
+
+        def get_strips(self, handle: SlideHandle = None, use_mmap=False):
+            """ Get the data of every strip/tile as a view of the buffer of get_image_data (nothing is copied)
+                :param handle: open slide (SlideHandle), default the slide is opened for the reading
+                :param use_mmap: see get_image_data
                 :return
-                    numpy array
+                    list of memoryview
             """
-            data = b""
-            with open(self.parent.path, "rb") as f:
-                f.seek(self.data_offsets[0])
-                for count in self.data_byte_counts:
-                    data += f.read(count)
+            data = memoryview(self.get_image_data(handle, use_mmap=use_mmap))
+            strips = []
+            position = 0
+            for count in self.data_byte_counts:
+                strips.append(data[position:position + count])
+                position += count
 
-            return data
+            return strips
 
         def get_image(self):
             """ Get image
                 :return
                     numpy array
             """
-            return self.ifd.asarray()
+            # decoding the image needs tifffile
+            with tifffile.TiffFile(self.parent.path) as tif:
+                return tif.pages[self.ifd.index].asarray()
 
 
     class SlideMetadata:
@@ -95,7 +793,7 @@ class Slide:
            contains data of metadata of the slide
 
            :parameter
-               slide: the instance of slide (tifffile.TiffFile)
+               slide: IFD chain of the slide (TiffIfdChain)
        """
         class ImageInfo:
             """ Image short-info class
@@ -112,7 +810,7 @@ class Slide:
                 self.num_levels = len(series.levels)
                 self.levels = series.levels
 
-        def __init__(self, slide: tifffile.TiffFile):
+        def __init__(self, slide: TiffIfdChain):
 
             self.vendor = Vendor.UNKNOWN
 
@@ -123,17 +821,38 @@ class Slide:
 
             self.extension = slide.flags.pop() if (len(slide.flags) > 0) else ""
             self.is_bigtiff = slide.is_bigtiff
-            self.images = []
+            self.path = slide.path
+            self._images = None
 
-            for series in slide.series:
-                self.images.append(self.ImageInfo(series))
+        @property
+        def images(self):
+            """
+                short-info of all images in the slide,
+                the series and levels are only built with tifffile when they are used (expensive)
+            """
+            if self._images is None:
+                with tifffile.TiffFile(self.path) as tif:
+                    self._images = [self.ImageInfo(series) for series in tif.series]
+
+            return self._images
 
-    def __init__(self, path):
+    def __init__(self, path, handle: SlideHandle = None, tiff: TiffIfdChain = None):
         if check_path_exist(path) is False:
             return None
         self.path = path
-        self.slide = tifffile.TiffFile(self.path)
-        if len(self.slide.pages) == 0:
+
+        if tiff is not None:
+            # already parsed (e.g. IfdIndexCache), the file is not opened
+            self.parse(tiff)
+            return
+
+        # the file is only opened while the slide is parsed (or it is the handle of the caller)
+        with slide_handle(self.path if handle is None else handle) as h:
+            self.parse(h.tiff)
+
+    def parse(self, tiff: TiffIfdChain):
+        self.slide = tiff
+        if len(self.slide.ifds) == 0:
             raise Exception("Can not find any Image File Directory")
 
         self.metadata = self.SlideMetadata(self.slide)
@@ -145,27 +864,29 @@ class Slide:
         elif self.slide.is_ndpi is True:
             self.get_data_hamamatsu()
 
-    def get_data_aperio(self):
-        for ifd in self.slide.pages:
-            try:
-                img_description_tag = ifd.tags["ImageDescription"]
-            except IndexError:
-                continue
+    def open(self, writable=False):
+        """
+            open the slide for a job, the parsed IFDs of the slide are reused
+            :param writable: open the file for patching
+            :return: SlideHandle
+        """
+        return SlideHandle(self.path, writable=writable, tiff=self.slide)
 
-            if "label" in img_description_tag.value.lower():
+    def get_data_aperio(self):
+        for ifd in self.slide.ifds:
+            if ifd.image_type is SubImageType.LABEL:
                 self.label = self.SubImage(self, ifd, img_type=SubImageType.LABEL)
-            elif "macro" in img_description_tag.value.lower():
+            elif ifd.image_type is SubImageType.MACRO:
                 self.macro = self.SubImage(self, ifd, img_type=SubImageType.MACRO)
 
     def get_data_hamamatsu(self):
-        for ifd in self.slide.pages:
-            try:
-                source_lens_tag = ifd.tags.get(65421)
-            except IndexError:
+        for ifd in self.slide.ifds:
+            source_lens_tag = ifd.tags.get(65421)
+            if source_lens_tag is None:
                 continue
             # SourceLens of -1 in NDPI means the macro image
             if source_lens_tag.value == -1:
-                self.macro = self.SubImage(ifd, img_type=SubImageType.MACRO)
+                self.macro = self.SubImage(self, ifd, img_type=SubImageType.MACRO)
 
 
 class InputType(object):
@@ -191,23 +912,28 @@ def check_path_exist(path):
         return False
 
 
-def check_format_support(path):
+def check_format_support(path, tiff: TiffIfdChain = None):
     """
         check whether file type is supported or not
         :param path:
+        :param tiff: IFDs of the file, if they are already parsed (TiffIfdChain)
         :return: Boolean (True: be supported)
     """
-    full_path = pathlib.Path(path).resolve()
-    try:
-        slide = tifffile.TiffFile(full_path)
-    except Exception:
-        return False
+    if tiff is not None:
+        flags = tiff.flags
+    else:
+        full_path = pathlib.Path(path).resolve()
+        try:
+            with TiffIfdChain(full_path) as slide:
+                flags = slide.flags
+        except Exception:
+            return False
 
     # get list of current supported extensions
     support_types = [e.value for e in SupportFileType]
 
     # the property flags contain the available extensions of the file
-    for t in slide.flags:
+    for t in flags:
         if t in support_types:
             return True
 
@@ -223,8 +949,10 @@ class InputData:
         :parameter
             json_path: path of the json input
 
+            ifd_cache_path: path of the persistent cache of parsed slides (IfdIndexCache), None: no cache
+
     """
-    def __init__(self, json_path):
+    def __init__(self, json_path, ifd_cache_path=IFD_CACHE_PATH):
 
         # check path
         json_path = pathlib.Path(json_path).resolve()
@@ -257,7 +985,20 @@ class InputData:
 
         # validate input format
         self.error_messages = []
-        self.validate()
+        self.slides = {}  # slides parsed during the validation (path: Slide)
+        self.ifd_cache = None
+        if ifd_cache_path is not None:
+            try:
+                self.ifd_cache = IfdIndexCache(ifd_cache_path)
+            except (OSError, sqlite3.Error) as e:
+                print(f"Can not open the cache of slides: {str(e)}")
+
+        try:
+            self.validate()
+        finally:
+            if self.ifd_cache is not None:
+                self.ifd_cache.close()
+                self.ifd_cache = None
 
         # if input is invalid
         if self.has_errors():
@@ -285,20 +1026,55 @@ class InputData:
                         if self.has_errors() is False:
                             self.json_data["patients"][pa_idx]["slides"][idx]["slide_data"] = s
 
+    def load_slide(self, slide_path):
+        """
+            parse a slide during the validation, it is reused by get_slide
+            :param slide_path: path of slide
+            :return: Slide, None if the format is not supported
+        """
+        tiff = None if self.ifd_cache is None else self.ifd_cache.get(slide_path)
+        try:
+            s = Slide(slide_path, tiff=tiff)
+        except Exception:
+            return None
+
+        if check_format_support(slide_path, s.slide) is False:
+            return None
+
+        if self.ifd_cache is not None and tiff is None:
+            self.ifd_cache.put(slide_path, s.slide)
+
+        self.slides[slide_path] = s
+        return s
+
     def get_slide(self, slide_path, obj_path):
-        s = Slide(slide_path)
+        s = self.slides.get(slide_path)
+        if s is None:
+            s = Slide(slide_path)
 
         if s.metadata.vendor is Vendor.UNKNOWN:
             self.error_messages.append(f'{obj_path}: Data type is still not supported: {slide_path}')
 
-        elif s.metadata.is_bigtiff is True:
-            self.error_messages.append(f'{obj_path}: BigTIFF format is still not supported: {slide_path}')
-
         elif s.label is None and s.macro is None:
             self.error_messages.append(f'{obj_path}: Label and Macro Images can not be found in slide: {slide_path}')
 
         return s
 
+    def get_slide_paths(self):
+        """
+            get paths of all slides in the json input
+            :return: list of path
+        """
+        match self.type:
+            case InputType.SINGLE_WSI:
+                return [self.json_data["path"]]
+            case InputType.CASE:
+                return [slide["path"] for slide in self.json_data["slides"]]
+            case InputType.STUDY:
+                return [slide["path"] for patient in self.json_data["patients"] for slide in patient["slides"]]
+
+        return []
+
     def has_errors(self):
         return len(self.error_messages) > 0
 
@@ -349,6 +1125,14 @@ class InputData:
             return
 
         try:
+            # finish or undo in-place pseudonymisations, which were interrupted (e.g. by a crash)
+            for s_path in self.get_slide_paths():
+                recovered = pa.recover_journal(s_path)
+                if recovered is pa.JournalState.COMMITTED:
+                    print(f'{s_path}: interrupted in-place pseudonymisation was finished')
+                elif recovered is pa.JournalState.PREPARED:
+                    print(f'{s_path}: interrupted in-place pseudonymisation was rolled back')
+
             # check path, format-support of all slides exist or not
             match self.type:
                 case InputType.SINGLE_WSI:
@@ -356,7 +1140,7 @@ class InputData:
                     if check_path_exist(s_path) is False:
                         self.error_messages.append(f'{s_path}, file not found')
                     else:
-                        if check_format_support(s_path) is False:
+                        if self.load_slide(s_path) is None:
                             self.error_messages.append(f'{s_path}, file format is not supported')
                 case InputType.CASE:
                     slides = self.json_data["slides"]
@@ -365,7 +1149,7 @@ class InputData:
                         if check_path_exist(s_path) is False:
                             self.error_messages.append(f'$.slides[{idx}]: {s_path}, file not found')
                         else:
-                            if check_format_support(s_path) is False:
+                            if self.load_slide(s_path) is None:
                                 self.error_messages.append(f'$.slides[{idx}]: {s_path}, file format is not supported')
                 case InputType.STUDY:
                     patients = self.json_data["patients"]
@@ -377,7 +1161,7 @@ class InputData:
                                 self.error_messages.append(f'$.patients[{p_idx}].slides[{s_idx}]: {s_path}, file not '
                                                            f'found')
                             else:
-                                if check_format_support(s_path) is False:
+                                if self.load_slide(s_path) is None:
                                     self.error_messages.append(f'$.patients[{p_idx}].slides[{s_idx}]: {s_path}, file '
                                                                f'format is not supported')
         except Exception as e:
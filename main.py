@@ -1,16 +1,20 @@
 import json
+import os
 from input_handler import InputData
-from pseudonymisation import Pseudonymization
+from pseudonymisation import Pseudonymization, WriteMode
 import asyncio
 import platform
 
+# how the pseudo-files are written: clone, stream, overlay or in_place (see pseudonymisation.WriteMode)
+WRITE_MODE = WriteMode(os.environ.get("WSI_WRITE_MODE") or WriteMode.CLONE.value)
+
 # Windows has a problem with EventLoopPolicy
 # It can make an async function "Asyncio Event Loop is Closed" when getting loop
 if platform.system() == 'Windows':
     asyncio.set_event_loop_policy(asyncio.WindowsSelectorEventLoopPolicy())
 
 
-async def pseudonymisation(json_path, debug=True) -> list:
+async def pseudonymisation(json_path, debug=True, write_mode=WRITE_MODE) -> list:
     """ Perform Pseudonymisation
         used to create pseudonyms for WSI files based on 3 structures of 3 objects: Study, Case and single WSI.
         This means that the structure of the JSON object in the input file has to be correct
@@ -21,6 +25,8 @@ async def pseudonymisation(json_path, debug=True) -> list:
                 path of JSON input file.
             debug:
                 if True, processing messages will be displayed
+            write_mode:
+                how the pseudo-files are written (WriteMode)
         :return
             JSON: contains pseudo-data
             None: failed
@@ -51,13 +57,18 @@ async def pseudonymisation(json_path, debug=True) -> list:
             if pseudo_factory.pseudo_data is not None:
 
                 # perform pseudonym
-                pseudo_json = await pseudo_factory.perform_pseudonym()
+                pseudo_json = await pseudo_factory.perform_pseudonym(write_mode=write_mode)
 
                 # if successful
                 if pseudo_json is not None:
                     print("Done")
                     return pseudo_json
 
+            # the rollback of the failed pseudonymisation could not undo everything
+            if pseudo_factory.has_errors():
+                print("Rollback is not complete:")
+                pseudo_factory.print_errors()
+
         # pseudonym process has been failed
         print("Failed. Can not perform pseudonym")
     except Exception as e:
@@ -0,0 +1,772 @@
+import base64
+import bisect
+import io
+import json
+import os
+import struct
+import zlib
+from contextlib import nullcontext
+from enum import IntEnum
+
+import file_utils as fu
+
+FILL_CHUNK_SIZE = 1024 * 1024  # max size of the buffer used to write a filled range
+CLASSIC_TIFF_MAX_SIZE = 2 ** 32  # offsets of classic TIFF are 4 bytes
+OVERLAY_SUFFIX = ".overlay"  # suffix of the sidecar file of an overlay
+OVERLAY_VERSION = 1  # version of the sidecar format
+JOURNAL_SUFFIX = ".journal"  # suffix of the write-ahead journal of a file patched in place
+JOURNAL_MAGIC = b"WSIPJRNL"
+JOURNAL_HEADER = struct.Struct("<8sBII")  # magic, state, length of the header, crc32 of header + blobs
+
+
+class PatchKind(IntEnum):
+    """
+        Kind of patch
+    """
+    WRITE = 0  # replace a range with new bytes
+    FILL = 1  # replace a range with a repeated byte (e.g. wipe data)
+
+
+class JournalState(IntEnum):
+    """
+        State of a write-ahead journal
+    """
+    PREPARED = 1  # journal is durable, the file may be (partially) patched => roll back
+    COMMITTED = 2  # pseudonymisation is committed => roll forward
+
+
+class Patch:
+    """
+        A range of bytes in a file that will be replaced
+
+        :parameter
+            offset: start offset in the file
+            data: new bytes (PatchKind.WRITE)
+            length: length of the range (PatchKind.FILL)
+            fill: repeated byte of the range (PatchKind.FILL)
+    """
+
+    def __init__(self, offset, data=None, length=None, fill=b"\x00"):
+        self.offset = offset
+        if data is not None:
+            self.kind = PatchKind.WRITE
+            self.data = bytes(data)
+            self.length = len(self.data)
+        else:
+            self.kind = PatchKind.FILL
+            self.data = None
+            self.length = length
+        self.fill = fill
+
+    @property
+    def end(self):
+        return self.offset + self.length
+
+    def slice(self, start, end):
+        """
+            get a part of the patch
+            :param start: start offset in the file (inside the patch)
+            :param end: end offset in the file (inside the patch)
+            :return: Patch
+        """
+        if self.kind is PatchKind.WRITE:
+            return Patch(start, data=self.data[start - self.offset: end - self.offset])
+
+        return Patch(start, length=end - start, fill=self.fill)
+
+    def get_bytes(self, start=None, end=None):
+        """
+            get new bytes of the patch in the range [start, end)
+            :param start: start offset in the file, default is the start of the patch
+            :param end: end offset in the file, default is the end of the patch
+            :return: bytes
+        """
+        start = self.offset if start is None else start
+        end = self.end if end is None else end
+
+        if self.kind is PatchKind.WRITE:
+            return self.data[start - self.offset: end - self.offset]
+
+        return self.fill * (end - start)
+
+    def __repr__(self):
+        return f"Patch({self.kind.name}, offset={self.offset}, length={self.length})"
+
+
+class WriteStats:
+    """
+        Counter of the writes issued to patch a slide (e.g. to see the round trips on NFS/SMB)
+    """
+
+    def __init__(self):
+        self.syscalls = 0  # write syscalls (pwritev)
+        self.ranges = 0  # contiguous ranges, after sorting and merging the writes
+        self.bytes_written = 0
+        self.bytes_wiped = 0  # filled ranges (zeros are deallocated instead of written if possible)
+
+    def add(self, syscalls, bytes_written):
+        self.syscalls += syscalls
+        self.ranges += 1
+        self.bytes_written += bytes_written
+
+    def __str__(self):
+        return (f"{self.syscalls} write calls for {self.ranges} ranges, {self.bytes_written} bytes written, "
+                f"{self.bytes_wiped} bytes wiped")
+
+
+class PatchBatch:
+    """
+        Collects writes at random offsets of a file and flushes them at once:
+        the writes are sorted by offset, adjacent writes are merged into one contiguous range,
+        and every range is written with a single vectored write (pwritev), instead of a seek and a write per value.
+
+        :parameter
+            stats: WriteStats, which counts the issued writes
+    """
+
+    def __init__(self, stats: WriteStats = None):
+        self.writes = []  # (offset, data)
+        self.stats = WriteStats() if stats is None else stats
+
+    def add(self, offset, data):
+        """
+            add a write, the writes of a batch must not overlap
+        """
+        if len(data) > 0:
+            self.writes.append((offset, data))
+
+    def ranges(self):
+        """
+            sort and merge the writes
+            :return: list of (offset, list of buffers), the buffers of a range are contiguous
+        """
+        ranges = []
+        end = None
+        for offset, data in sorted(self.writes, key=lambda write: write[0]):
+            if end is not None and offset < end:
+                raise Exception(f"Writes of the batch overlap at offset {offset}")
+
+            if offset == end:
+                ranges[-1][1].append(data)
+            else:
+                ranges.append((offset, [data]))
+            end = offset + len(data)
+
+        return ranges
+
+    def flush(self, f):
+        """
+            write all collected writes into an opened file
+            :param f: file object opened with "r+b"
+        """
+        f.flush()  # buffered writes of the file object go first
+        for offset, buffers in self.ranges():
+            syscalls = fu.write_vectored(f.fileno(), buffers, offset)
+            self.stats.add(syscalls, sum(len(data) for data in buffers))
+
+        # the writes bypass the file object, so its read buffer is discarded (it can contain the old bytes)
+        f.seek(0, io.SEEK_END)
+        self.writes = []
+
+
+class PatchPlan:
+    """
+        All changes of a file, computed before anything is written.
+        Patches are kept in the order they were added, a later patch wins over an earlier one when they overlap.
+        Appended data is written after the end of the original file.
+
+        :parameter
+            file_size: size of the original file
+            big_endian: byte order of the TIFF file
+            max_file_size: the patched file can not be larger (offsets of classic TIFF are 4 bytes), None: no limit
+    """
+
+    def __init__(self, file_size, big_endian=False, max_file_size=None):
+        self.file_size = file_size
+        self.big_endian = big_endian
+        self.max_file_size = max_file_size
+        self.patches = []
+        self.appended_size = 0
+        self.free_ranges = []  # sorted, non-overlapping (start, end) of wiped ranges, which can be reused
+
+    @staticmethod
+    def for_file(f):
+        """
+            create an empty plan for an opened TIFF file
+            :param f: file object (binary)
+            :return: PatchPlan
+        """
+        f.seek(0)
+        header = f.read(4)
+        big_endian = True if header[:2] == b"MM" else False  # b"II" is litle-endian
+        bigtiff = header[2:4] in (b"\x00\x2b", b"\x2b\x00")  # version 43
+        file_size = os.fstat(f.fileno()).st_size
+        return PatchPlan(file_size, big_endian, max_file_size=None if bigtiff else CLASSIC_TIFF_MAX_SIZE)
+
+    @property
+    def end_of_file(self):
+        """
+            size of the file after all patches are applied
+        """
+        return self.file_size + self.appended_size
+
+    def write(self, offset, data):
+        """
+            replace bytes at offset with data
+        """
+        self._reserve(offset, offset + len(data))
+        self.patches.append(Patch(offset, data=data))
+
+    def wipe(self, offset, length, fill=b"\x00", reusable=True):
+        """
+            replace a range of the file with a repeated byte
+            :param reusable: the wiped range can be reused by allocate
+        """
+        self.patches.append(Patch(offset, length=length, fill=fill))
+        if reusable:
+            self._free(offset, offset + length)
+
+    def append(self, data, alignment=1):
+        """
+            add data at the end of the file
+            :param alignment: offset of the data will be a multiple of alignment (padding with zero)
+            :return: offset of the data in the patched file
+        """
+        padding = -self.end_of_file % alignment
+        if self.max_file_size is not None and self.end_of_file + padding + len(data) > self.max_file_size:
+            raise Exception("The patched file would be larger than 4 GB, "
+                            "which is not possible in classic TIFF (BigTIFF is needed)")
+
+        if padding > 0:
+            self.patches.append(Patch(self.end_of_file, data=b"\x00" * padding))
+            self.appended_size += padding
+
+        offset = self.end_of_file
+        self.patches.append(Patch(offset, data=data))
+        self.appended_size += len(data)
+        return offset
+
+    def allocate(self, data, alignment=2):
+        """
+            place data into a wiped range, which is large enough (first-fit),
+            the data is only added at the end of the file, if it does not fit anywhere
+            :param data: bytes
+            :param alignment: offset of the data will be a multiple of alignment (TIFF offsets are word-aligned)
+            :return: offset of the data in the patched file
+        """
+        size = len(data)
+        for start, end in self.free_ranges:
+            offset = start + (-start % alignment)
+            if offset + size <= end:
+                self.write(offset, data)
+                return offset
+
+        return self.append(data, alignment=alignment)
+
+    def _free(self, start, end):
+        """
+            add a range to the free-range map (merged with overlapping/adjacent ranges)
+        """
+        kept = []
+        for free_start, free_end in self.free_ranges:
+            if free_end < start or free_start > end:
+                kept.append((free_start, free_end))
+            else:
+                start, end = min(start, free_start), max(end, free_end)
+        kept.append((start, end))
+        self.free_ranges = sorted(kept)
+
+    def _reserve(self, start, end):
+        """
+            remove a range from the free-range map
+        """
+        kept = []
+        for free_start, free_end in self.free_ranges:
+            if free_end <= start or free_start >= end:
+                kept.append((free_start, free_end))
+                continue
+            if free_start < start:
+                kept.append((free_start, start))
+            if free_end > end:
+                kept.append((end, free_end))
+        self.free_ranges = kept
+
+    def segments(self):
+        """
+            resolve the overlapping patches
+            :return: list of non-overlapping patches, sorted by offset
+        """
+        segments = []
+        for patch in self.patches:
+            if patch.length == 0:
+                continue
+
+            kept = []
+            for segment in segments:
+                if segment.end <= patch.offset or segment.offset >= patch.end:
+                    kept.append(segment)
+                    continue
+
+                # keep parts of the older segment, which are not covered by the new patch
+                if segment.offset < patch.offset:
+                    kept.append(segment.slice(segment.offset, patch.offset))
+                if segment.end > patch.end:
+                    kept.append(segment.slice(patch.end, segment.end))
+
+            kept.append(patch)
+            segments = kept
+
+        return sorted(segments, key=lambda s: s.offset)
+
+    def apply(self, f, stats: WriteStats = None):
+        """
+            write all patches into an opened file (random access),
+            the new bytes are written in a single batch (see PatchBatch), then the filled ranges
+            :param f: file object opened with "r+b"
+            :param stats: WriteStats, which counts the issued writes
+        """
+        batch = PatchBatch(stats)
+        fills = []
+        for segment in self.segments():
+            if segment.kind is PatchKind.WRITE:
+                batch.add(segment.offset, segment.data)
+            else:
+                fills.append(segment)
+
+        batch.flush(f)
+
+        for segment in fills:
+            write_segment(f, segment)
+            batch.stats.bytes_wiped += segment.length
+
+        f.flush()
+
+
+def write_segment(f, segment: Patch, start=None, end=None):
+    """
+        write a (part of a) patch into a file at the offset of the patch
+        :param f: file object
+        :param segment: Patch
+        :param start: start offset in the file, default is the start of the patch
+        :param end: end offset in the file, default is the end of the patch
+    """
+    start = segment.offset if start is None else start
+    end = segment.end if end is None else end
+
+    if segment.kind is PatchKind.FILL and segment.fill == b"\x00":
+        # whole blocks of zeros are deallocated instead of written
+        fu.zero_range(f, start, end - start)
+        return
+
+    f.seek(start)
+    if segment.kind is PatchKind.WRITE:
+        f.write(segment.get_bytes(start, end))
+        return
+
+    # write filled ranges in chunks to avoid allocating a buffer of the whole range
+    position = start
+    while position < end:
+        chunk_end = min(end, position + FILL_CHUNK_SIZE)
+        f.write(segment.get_bytes(position, chunk_end))
+        position = chunk_end
+
+
+def write_patched_copy(src_path, dest_path, plan: PatchPlan, src_file=None):
+    """
+        copy a file and apply a patch plan in a single sequential pass.
+        Unchanged ranges are copied from the source, patched ranges are written from the plan,
+        so every byte of the output is written exactly once.
+        :param src_path: path of the original file
+        :param dest_path: path of the output file (must not exist)
+        :param plan: PatchPlan computed for the original file
+        :param src_file: opened original file (e.g. of a SlideHandle), it is not closed here
+    """
+    segments = plan.segments()
+
+    try:
+        with (open(src_path, "rb") if src_file is None else nullcontext(src_file)) as src, \
+                open(dest_path, "xb") as dest:
+            if os.fstat(src.fileno()).st_size != plan.file_size:
+                raise Exception("Size of the file does not match the patch plan")
+
+            buffer = bytearray(fu.COPY_BUFFER_SIZE)
+            position = 0
+
+            for segment in segments:
+                if segment.offset > plan.file_size and segment.offset > position:
+                    raise Exception("Patch plan has a gap after the end of the file")
+
+                # copy unchanged bytes before the patch
+                if segment.offset > position:
+                    fu.copy_range(src, dest, position, segment.offset - position, buffer)
+
+                write_segment(dest, segment)
+                position = max(position, segment.end)
+
+            # copy the rest of the source
+            if position < plan.file_size:
+                fu.copy_range(src, dest, position, plan.file_size - position, buffer)
+
+            # holes of the source are not copied, the file can end with a hole
+            dest.truncate(plan.end_of_file)
+            dest.flush()
+    except FileExistsError:
+        raise
+    except Exception:
+        if os.path.exists(dest_path):
+            os.unlink(dest_path)
+        raise
+
+
+class PatchOverlay(io.RawIOBase):
+    """
+        Read-only, seekable view of a patched file without writing the patched file.
+        Reads go through to the original file, patched ranges are served from the plan.
+
+        :parameter
+            path: path of the original file
+            plan: PatchPlan computed for the original file
+    """
+
+    def __init__(self, path, plan: PatchPlan):
+        super().__init__()
+        self.name = str(path)
+        self.plan = plan
+        self.segments = plan.segments()
+        self.segment_starts = [segment.offset for segment in self.segments]
+        self.size = plan.end_of_file
+        self.position = 0
+        self.source = open(path, "rb")
+
+        if os.fstat(self.source.fileno()).st_size != plan.file_size:
+            self.source.close()
+            raise Exception("Size of the file does not match the patch plan")
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        match whence:
+            case io.SEEK_SET:
+                position = offset
+            case io.SEEK_CUR:
+                position = self.position + offset
+            case io.SEEK_END:
+                position = self.size + offset
+            case _:
+                raise ValueError(f"Invalid whence ({whence})")
+
+        if position < 0:
+            raise ValueError("Negative seek position")
+
+        self.position = position
+        return self.position
+
+    def readinto(self, buffer):
+        start = self.position
+        end = min(self.size, start + len(buffer))
+        if start >= end:
+            return 0
+
+        view = memoryview(buffer).cast("B")
+
+        # read through to the original file
+        source_end = min(end, self.plan.file_size)
+        if start < source_end:
+            self.source.seek(start)
+            read = self.source.readinto(view[:source_end - start])
+            if read != source_end - start:
+                raise OSError("Original file is shorter than expected")
+
+        # substitute the patched ranges
+        index = max(0, bisect.bisect_right(self.segment_starts, start) - 1)
+        while index < len(self.segments) and self.segments[index].offset < end:
+            segment = self.segments[index]
+            overlap_start, overlap_end = max(start, segment.offset), min(end, segment.end)
+            if overlap_start < overlap_end:
+                view[overlap_start - start: overlap_end - start] = segment.get_bytes(overlap_start, overlap_end)
+            index += 1
+
+        self.position = end
+        return end - start
+
+    def close(self):
+        if not self.closed:
+            self.source.close()
+        super().close()
+
+
+def save_overlay(sidecar_path, src_path, plan: PatchPlan):
+    """
+        persist a patch plan as a small sidecar file, which describes a patched view of the original file
+        :param sidecar_path: path of the sidecar file (must not exist)
+        :param src_path: path of the original file
+        :param plan: PatchPlan computed for the original file
+    """
+    stat = os.stat(src_path)
+    segments = []
+    for segment in plan.segments():
+        if segment.kind is PatchKind.WRITE:
+            segments.append({"offset": segment.offset,
+                             "data": base64.b64encode(segment.data).decode("ascii")})
+        else:
+            segments.append({"offset": segment.offset,
+                             "length": segment.length,
+                             "fill": segment.fill.hex()})
+
+    sidecar = {
+        "version": OVERLAY_VERSION,
+        "source": os.path.abspath(src_path),
+        "source_size": plan.file_size,
+        "source_mtime_ns": stat.st_mtime_ns,
+        "big_endian": plan.big_endian,
+        "segments": segments,
+    }
+
+    with open(sidecar_path, "x") as f:
+        json.dump(sidecar, f)
+
+
+def open_overlay(sidecar_path):
+    """
+        open the patched view of a file described by a sidecar file
+        e.g. tifffile.TiffFile(open_overlay(path))
+        :param sidecar_path: path of the sidecar file
+        :return: PatchOverlay
+    """
+    with open(sidecar_path, "r") as f:
+        sidecar = json.load(f)
+
+    if sidecar.get("version") != OVERLAY_VERSION:
+        raise Exception(f"Version of the overlay is not supported: {sidecar.get('version')}")
+
+    stat = os.stat(sidecar["source"])
+    if stat.st_size != sidecar["source_size"] or stat.st_mtime_ns != sidecar["source_mtime_ns"]:
+        raise Exception("Original file of the overlay has been changed")
+
+    plan = PatchPlan(sidecar["source_size"], sidecar["big_endian"])
+    for segment in sidecar["segments"]:
+        if "data" in segment:
+            plan.write(segment["offset"], base64.b64decode(segment["data"]))
+        else:
+            plan.wipe(segment["offset"], segment["length"], fill=bytes.fromhex(segment["fill"]))
+
+    # appended data is part of the segments
+    plan.appended_size = max([plan.file_size] + [p.end for p in plan.patches]) - plan.file_size
+
+    return PatchOverlay(sidecar["source"], plan)
+
+
+class PatchJournal:
+    """
+        Write-ahead journal to patch a file in place.
+        Before any write, the pre-image and the post-image of every range that will be overwritten are saved
+        in a journal next to the file. A crash in the middle of patching can be rolled back (state PREPARED)
+        or rolled forward (state COMMITTED) by recover_journal on the next start.
+
+        :parameter
+            path: path of the file, which will be patched in place
+    """
+
+    def __init__(self, path):
+        self.path = str(path)
+        self.journal_path = f"{self.path}{JOURNAL_SUFFIX}"
+        self.plan = None
+        self.pre_images = []  # (offset, bytes) of ranges inside the original file
+        self.rename_to = None
+        self.state = None
+
+    def prepare(self, plan: PatchPlan, rename_to=None):
+        """
+            save the journal of a patch plan durably, nothing is written to the file yet
+            :param plan: PatchPlan computed for the file
+            :param rename_to: new path of the file after the commit (optional)
+        """
+        if os.path.exists(self.journal_path):
+            raise Exception(f"An unfinished journal exists already: {self.journal_path}")
+
+        self.plan = plan
+        self.rename_to = None if rename_to is None else str(rename_to)
+
+        with open(self.path, "rb") as f:
+            if os.fstat(f.fileno()).st_size != plan.file_size:
+                raise Exception("Size of the file does not match the patch plan")
+
+            # read the pre-image of every range, which will be overwritten
+            self.pre_images = []
+            for segment in plan.segments():
+                if segment.offset >= plan.file_size:
+                    continue
+                end = min(segment.end, plan.file_size)
+                f.seek(segment.offset)
+                self.pre_images.append((segment.offset, f.read(end - segment.offset)))
+
+        self.state = JournalState.PREPARED
+        self._write(create=True)
+
+    def apply(self, stats: WriteStats = None):
+        """
+            patch the file in place (the journal has to be prepared)
+            :param stats: WriteStats, which counts the issued writes
+        """
+        if self.state is not JournalState.PREPARED:
+            raise Exception("Journal is not prepared")
+
+        with open(self.path, "r+b") as f:
+            self.plan.apply(f, stats=stats)
+            os.fsync(f.fileno())
+
+    def commit(self):
+        """
+            mark the patch as committed, then rename the file and remove the journal
+        """
+        self._set_state(JournalState.COMMITTED)
+        self._finish()
+
+    def rollback(self):
+        """
+            restore all pre-images, cut appended data and remove the journal
+        """
+        with open(self.path, "r+b") as f:
+            batch = PatchBatch()
+            for offset, data in self.pre_images:
+                batch.add(offset, data)
+            batch.flush(f)
+            f.truncate(self.plan.file_size)
+            f.flush()
+            os.fsync(f.fileno())
+
+        os.unlink(self.journal_path)
+        fu.fsync_directory(os.path.dirname(os.path.abspath(self.journal_path)))
+
+    def roll_forward(self):
+        """
+            apply the post-images again (idempotent), then finish the commit
+        """
+        if os.path.exists(self.path):
+            with open(self.path, "r+b") as f:
+                self.plan.apply(f)
+                f.truncate(self.plan.end_of_file)
+                os.fsync(f.fileno())
+
+        self._finish()
+
+    def _finish(self):
+        if self.rename_to is not None and os.path.exists(self.path):
+            if os.path.exists(self.rename_to):
+                raise Exception(f"Can not rename the patched file, {self.rename_to} already exists")
+            os.rename(self.path, self.rename_to)
+
+        os.unlink(self.journal_path)
+        fu.fsync_directory(os.path.dirname(os.path.abspath(self.journal_path)))
+
+    def _set_state(self, state: JournalState):
+        with open(self.journal_path, "r+b") as f:
+            f.seek(len(JOURNAL_MAGIC))
+            f.write(bytes([state]))
+            f.flush()
+            os.fsync(f.fileno())
+        self.state = state
+
+    def _write(self, create=False):
+        blobs = bytearray()
+        segments = []
+        for segment in self.plan.segments():
+            entry = {"offset": segment.offset, "length": segment.length}
+            if segment.kind is PatchKind.WRITE:
+                entry["post"] = len(blobs)
+                blobs += segment.data
+            else:
+                entry["fill"] = segment.fill.hex()
+            segments.append(entry)
+
+        pre_images = []
+        for offset, data in self.pre_images:
+            pre_images.append({"offset": offset, "length": len(data), "pre": len(blobs)})
+            blobs += data
+
+        header = json.dumps({
+            "path": self.path,
+            "rename_to": self.rename_to,
+            "file_size": self.plan.file_size,
+            "big_endian": self.plan.big_endian,
+            "segments": segments,
+            "pre_images": pre_images,
+        }).encode("utf-8")
+
+        checksum = zlib.crc32(blobs, zlib.crc32(header))
+        with open(self.journal_path, "xb" if create else "wb") as f:
+            f.write(JOURNAL_HEADER.pack(JOURNAL_MAGIC, self.state, len(header), checksum))
+            f.write(header)
+            f.write(blobs)
+            f.flush()
+            os.fsync(f.fileno())
+
+        fu.fsync_directory(os.path.dirname(os.path.abspath(self.journal_path)))
+
+    @staticmethod
+    def load(path):
+        """
+            load the journal of a file
+            :param path: path of the file (not of the journal)
+            :return: PatchJournal, None if the journal is incomplete (it was never applied)
+        """
+        journal = PatchJournal(path)
+        with open(journal.journal_path, "rb") as f:
+            data = f.read()
+
+        if len(data) < JOURNAL_HEADER.size:
+            return None
+
+        magic, state, header_length, checksum = JOURNAL_HEADER.unpack_from(data)
+        header = data[JOURNAL_HEADER.size: JOURNAL_HEADER.size + header_length]
+        blobs = memoryview(data)[JOURNAL_HEADER.size + header_length:]
+        if magic != JOURNAL_MAGIC or zlib.crc32(blobs, zlib.crc32(header)) != checksum:
+            return None
+
+        header = json.loads(header.decode("utf-8"))
+        plan = PatchPlan(header["file_size"], header["big_endian"])
+        for segment in header["segments"]:
+            if "post" in segment:
+                plan.write(segment["offset"], blobs[segment["post"]: segment["post"] + segment["length"]])
+            else:
+                plan.wipe(segment["offset"], segment["length"], fill=bytes.fromhex(segment["fill"]))
+        plan.appended_size = max([plan.file_size] + [p.end for p in plan.patches]) - plan.file_size
+
+        journal.plan = plan
+        journal.rename_to = header["rename_to"]
+        journal.state = JournalState(state)
+        journal.pre_images = [(p["offset"], bytes(blobs[p["pre"]: p["pre"] + p["length"]]))
+                              for p in header["pre_images"]]
+        return journal
+
+
+def recover_journal(path):
+    """
+        finish or undo an in-place patch of a file, which was interrupted (e.g. by a crash)
+        :param path: path of the file
+        :return: None if there was no journal, otherwise the JournalState that was recovered
+    """
+    journal_path = f"{path}{JOURNAL_SUFFIX}"
+    if not os.path.exists(journal_path):
+        return None
+
+    journal = PatchJournal.load(path)
+
+    if journal is None:
+        # the journal was not written completely, so the file has never been touched
+        os.unlink(journal_path)
+        return JournalState.PREPARED
+
+    if journal.state is JournalState.COMMITTED:
+        journal.roll_forward()
+    else:
+        journal.rollback()
+
+    return journal.state
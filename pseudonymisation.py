@@ -1,24 +1,29 @@
-import tifffile
-
-from input_handler import InputData, InputType, Vendor, Slide
+from input_handler import InputData, InputType, Vendor, Slide, SlideHandle, slide_handle, forget_cached_slide
 from faker import Faker
 from nanoid import generate
 import dateutil.parser
 import random
-import shutil
 from pathlib import Path
 import os
 import pseudonymisation_utils as pu
-import compression_utils as cu
+import file_utils as fu
+import patch_utils as pa
+import store_utils as su
 import db.db as db
 import db.model as model
-from enum import IntEnum
+from enum import IntEnum, Enum
 from cryptography.fernet import Fernet, InvalidToken
 import json
 import numpy as np
 
-STORE_PATH = "data/store/"  # store path
+STORE_PATH = "data/store/"  # store path, for StoreBackend.S3 an url: s3://bucket/prefix
 STORE_FILE_NAME_SIZE = 20  # length of filename in the store
+STORE_BACKEND = su.StoreBackend.FILES  # FILES: one file per record, PACK: records in large segment files, S3: objects
+STORE_S3_ENDPOINT = os.environ.get("WSI_STORE_S3_ENDPOINT") or None  # S3-compatible server (e.g. MinIO), None: AWS
+STORE_COMPACTION = False  # PACK: reclaim the space of deleted records in a background thread, when the store is opened
+STORE_INDEX_PATH = None  # local folder of the dedup index, None: STORE_PATH (it is required for StoreBackend.S3)
+RECORD_CACHE = su.RecordCache(su.RECORD_CACHE_SIZE)  # decrypted records, for repeated de-pseudonymisation
+STORE_DEDUP_SECRET = os.environ.get("WSI_STORE_DEDUP_SECRET") or None  # None: records in the store are not deduplicated
 DATE_FORMAT = "%d.%m.%Y"  # date format in JSON output
 DATETIME_FORMAT = "%I:%M%p %d.%m.%Y"  # datetime format in JSON output
 
@@ -187,28 +192,31 @@ async def get_object_by_pseudo_id(object_pseudo_id, db_model, get_children=False
             return await dao_instance.get_by_pseudo_id(object_pseudo_id)
 
 
-def create_file_path_in_store(store_folder_path):
+def create_name_in_store(store):
     """
-        create image path in the store
-        the filename of the image will be randomized. This makes it more secure
+        create a name of a record in the store
+        the name will be randomized. This makes it more secure
 
-        :param store_folder_path: store path (Path)
-        :return: filename, path string
+        :param store: store (store_utils.Store)
+        :return: name
     """
-    # generate uid as filename
-    fname = generate_id(size=STORE_FILE_NAME_SIZE)
+    while True:
+        # generate uid as name
+        fname = generate_id(size=STORE_FILE_NAME_SIZE)
 
-    # create store path
-    f_path = store_folder_path.joinpath(fname, '')
-    root, ext = os.path.splitext(f_path)
-    i = 0
+        # reserve the name (atomic), if the name already existed, generate another name
+        if store.reserve(fname):
+            return fname
 
-    # if the path already existed, add a number in suffix of filename
-    while os.path.exists(f_path):
-        i += 1
-        f_path = '%s_%i%s' % (root, i, ext)
 
-    return fname, f_path
+class WriteMode(Enum):
+    """
+        How the pseudonymised slide is written
+    """
+    CLONE = "clone"  # clone the slide, then patch the clone
+    STREAM = "stream"  # copy the slide and apply all patches in a single sequential pass
+    OVERLAY = "overlay"  # no copy, a sidecar describes the patches (read it with patch_utils.open_overlay)
+    IN_PLACE = "in_place"  # patch the original slide (journaled), it is renamed to the pseudo-ID after the commit
 
 
 class WSI:
@@ -235,6 +243,9 @@ class WSI:
         self.pseudo_macro_name = None
         self.pseudo_macro_key = None
         self.pseudo_file_path = None
+        self.clone_strategy = None  # strategy used to copy the clone of the slide (file_utils.CloneStrategy)
+        self.journal = None  # write-ahead journal, when the slide is pseudonymised in place (patch_utils.PatchJournal)
+        self.write_stats = pa.WriteStats()  # writes issued to patch the pseudo-file (or the restored file)
         self.fields_count = 1  # the number of fields will be written on label
         self.get_from_database = False  # flag to check, whether data will be taken from DB?
         self.need_to_be_updated = set()  # contains something new needs to be updated in DB
@@ -807,6 +818,7 @@ class Pseudonymization:
     """
 
     def __init__(self, input_data: InputData, is_de_pseudonym=False):
+        self.error_messages = []  # errors of a rollback, which could not undo everything
 
         if input_data.has_errors():
             input_data.print_errors()
@@ -817,6 +829,14 @@ class Pseudonymization:
         self.is_de_pseudonym = is_de_pseudonym
         self.gap_year = -1
         self.pseudo_data = None
+        self.store = None
+
+    def has_errors(self):
+        return len(self.error_messages) > 0
+
+    def print_errors(self):
+        for error in self.error_messages:
+            print(error)
 
     async def create(self):
         """
@@ -857,9 +877,10 @@ class Pseudonymization:
 
         return self
 
-    async def perform_pseudonym(self):
+    async def perform_pseudonym(self, write_mode=WriteMode.CLONE):
         """
             controller of perform pseudonymisation
+            :param write_mode: how the pseudo-files are written (WriteMode), default is CLONE
         """
 
         # if there is any error during generating pseudo-data
@@ -873,11 +894,11 @@ class Pseudonymization:
 
         match self.input_data.type:
             case InputType.SINGLE_WSI:
-                return await self.perform_single_wsi()
+                return await self.perform_single_wsi(write_mode=write_mode)
             case InputType.CASE:
-                return await self.perform_case()
+                return await self.perform_case(write_mode=write_mode)
             case InputType.STUDY:
-                return await self.perform_study()
+                return await self.perform_study(write_mode=write_mode)
 
         return None
 
@@ -907,20 +928,24 @@ class Pseudonymization:
 
     def check_store_path(self):
         """
-            Check store path valid
-            :return: path of store (Path)
+            Check store path valid and open the store (it is opened once for the instance)
+            :return: store (store_utils.Store)
         """
         if STORE_PATH is not None:
-            try:
-                os.makedirs(STORE_PATH)
-            except FileExistsError:
-                pass
-            except Exception as ex:
-                print(f"Store path is not valid:{str(ex)}")
-                return None
+            if self.store is None:
+                try:
+                    self.store = su.open_store(STORE_PATH, STORE_BACKEND, dedup_secret=STORE_DEDUP_SECRET,
+                                               endpoint_url=STORE_S3_ENDPOINT, index_folder=STORE_INDEX_PATH,
+                                               cache=RECORD_CACHE)
+                except Exception as ex:
+                    print(f"Store path is not valid:{str(ex)}")
+                    return None
+
+                if STORE_COMPACTION and isinstance(self.store, su.PackStore):
+                    # only the records deleted from the index, the records unused in DB: store_tool.py compact
+                    self.store.start_compaction()
 
-            store_folder = Path(STORE_PATH)
-            return store_folder
+            return self.store
         else:
             print("Store path is not None")
             return None
@@ -956,6 +981,34 @@ class Pseudonymization:
         if self.input_data.type is not input_type:
             return "Data is not valid"
 
+    def create_clone_path(self, slide, dest_folder: Path):
+        """
+            Create the path of a clone of the Slide "slide" in "dest_folder"
+            :param slide: WSI data
+            :param dest_folder: destination folder path
+            :return source file path, destination file path
+        """
+        if self.is_de_pseudonym:
+            start_path = Path(slide.pseudo_file_path)
+            slide_id = slide.id
+        else:
+            start_path = Path(slide.path)
+            slide_id = slide.pseudo_id
+
+        # create clone path (dest_path)
+        if dest_folder is None:
+            dest_path = start_path.with_stem(slide_id)
+        else:
+            dest_path = dest_folder.joinpath(f"{slide_id}{start_path.suffix}")
+        file_counter = 1
+
+        # if clone path already existed
+        while dest_path.exists():
+            dest_path = dest_path.with_stem(f"{slide_id}_{file_counter}")
+            file_counter += 1
+
+        return start_path, dest_path
+
     def copy_clone(self, slide, dest_folder: Path, prefix_error=""):
         """
             Copy a clone of the Slide "slide" into "dest_folder"
@@ -965,33 +1018,189 @@ class Pseudonymization:
             :return destination file path
         """
         try:
+            start_path, dest_path = self.create_clone_path(slide, dest_folder)
 
-            if self.is_de_pseudonym:
-                start_path = Path(slide.pseudo_file_path)
-                slide_id = slide.id
-            else:
-                start_path = Path(slide.path)
-                slide_id = slide.pseudo_id
+            # copy clone (reflink, kernel-side copy or buffered copy, whichever is supported)
+            slide.clone_strategy = fu.clone_file(start_path, dest_path)
+            print(f"{prefix_error}Cloned the Slide ({slide.clone_strategy.value})")
 
-            # create clone path (dest_path)
-            if dest_folder is None:
-                dest_path = start_path.with_stem(slide_id)
-            else:
-                dest_path = dest_folder.joinpath(slide_id, start_path.suffix)
-            file_counter = 1
+            return dest_path
+
+        except Exception as e:
+            raise Exception(f"{prefix_error}Can not copy clone of the Slide: {str(e)}") from None
 
-            # if clone path already existed
-            while dest_path.exists():
-                dest_path = dest_path.with_stem(f"{slide_id}_{file_counter}")
-                file_counter += 1
+    def plan_pseudonym_file(self, file_path, label: Slide.SubImage, pseudo_label, pseudo_metadata,
+                            prefix_error=""):
+        """
+            Compute all patches of the pseudo-file on the original slide, nothing is written
+            :param file_path: path of the original slide (or an open SlideHandle)
+            :param label: label of the slide
+            :param pseudo_label: pseudonym label (numpy array)
+            :param pseudo_metadata: new data of metadata contains fields that need to be replaced
+            :param prefix_error: prefix of message
+            :return: patch plan, original metadata
+        """
+        with slide_handle(file_path) as handle:
+            plan = pa.PatchPlan.for_file(handle.file)
+
+            try:
+                pu.plan_label_replacement_svs(plan, pseudo_label, label.ifd)
+            except Exception as e:
+                raise Exception(f"{prefix_error}Can not replace label with pseudo-label: {str(e)}") from None
 
-            # copy clone
-            shutil.copy2(start_path, dest_path)
+            origin_metadata = self.plan_metadata_replacement_svs(handle, pseudo_metadata, plan,
+                                                                 prefix_error=prefix_error)
 
-            return dest_path
+        return plan, origin_metadata
+
+    def write_pseudonym_file(self, slide: WSI, dest_folder: Path, pseudo_label, pseudo_metadata,
+                             write_mode=WriteMode.CLONE, prefix_error=""):
+        """
+            Write the pseudonymised Slide "slide" into "dest_folder":
+            the label is replaced with the pseudonym-label and the metadata with the pseudo metadata
+            :param slide: WSI data
+            :param dest_folder: destination folder path
+            :param pseudo_label: pseudonym label (numpy array)
+            :param pseudo_metadata: new data of metadata contains fields that need to be replaced
+            :param write_mode: how the pseudo-file is written (WriteMode)
+                with IN_PLACE the slide.journal has to be committed or rolled back by the caller
+            :param prefix_error: prefix of message
+            :return: path of pseudo-file, original metadata
+        """
+        label = slide.slide_data.label
+
+        # the original slide is opened once for the whole job, its parsed IFDs are reused
+        with slide.slide_data.open() as handle:
+            # read the original label before anything is written (it is saved in the store later)
+            label.get_image_data(handle)
+
+            pseudo_file_path, origin_metadata = self._write_pseudonym_file(handle, slide, dest_folder, label,
+                                                                           pseudo_label, pseudo_metadata,
+                                                                           write_mode, prefix_error)
+
+        return pseudo_file_path, origin_metadata
+
+    def _write_pseudonym_file(self, handle: SlideHandle, slide: WSI, dest_folder: Path, label: Slide.SubImage,
+                              pseudo_label, pseudo_metadata, write_mode, prefix_error):
+        """
+            Write the pseudo-file with the open original slide "handle" (see write_pseudonym_file)
+        """
+        match write_mode:
+            case WriteMode.CLONE:
+                # compute all patches on the original slide, then copy clone of slide and patch the clone
+                plan, origin_metadata = self.plan_pseudonym_file(handle, label, pseudo_label, pseudo_metadata,
+                                                                 prefix_error=prefix_error)
+                pseudo_file_path = self.copy_clone(slide, dest_folder, prefix_error=prefix_error)
+
+                try:
+                    with open(pseudo_file_path, "r+b") as f:
+                        plan.apply(f, stats=slide.write_stats)
+                except Exception as e:
+                    # remove clone file
+                    Path(pseudo_file_path).unlink()
+                    raise Exception(f"{prefix_error}Can not patch the clone of the Slide: {str(e)}") from None
+
+                print(f"{prefix_error}Patched the clone of the Slide ({slide.write_stats})")
+
+            case WriteMode.STREAM:
+                # compute all patches on the original slide, then copy and patch in one pass
+                start_path, pseudo_file_path = self.create_clone_path(slide, dest_folder)
+                plan, origin_metadata = self.plan_pseudonym_file(handle, label, pseudo_label, pseudo_metadata,
+                                                                 prefix_error=prefix_error)
+
+                try:
+                    pa.write_patched_copy(start_path, pseudo_file_path, plan, src_file=handle.file)
+                except Exception as e:
+                    raise Exception(f"{prefix_error}Can not write pseudo-file of the Slide: {str(e)}") from None
+
+                print(f"{prefix_error}Wrote the pseudo-file of the Slide in a single pass")
+
+            case WriteMode.OVERLAY:
+                # compute all patches on the original slide, only a sidecar describing the patches is written
+                start_path, clone_path = self.create_clone_path(slide, dest_folder)
+                pseudo_file_path = clone_path.with_name(f"{clone_path.name}{pa.OVERLAY_SUFFIX}")
+                plan, origin_metadata = self.plan_pseudonym_file(handle, label, pseudo_label, pseudo_metadata,
+                                                                 prefix_error=prefix_error)
+
+                try:
+                    pa.save_overlay(pseudo_file_path, start_path, plan)
+                except Exception as e:
+                    raise Exception(f"{prefix_error}Can not write overlay of the Slide: {str(e)}") from None
+
+                print(f"{prefix_error}Wrote the overlay of the Slide")
 
+            case WriteMode.IN_PLACE:
+                # patch the original slide, the pre-images are saved in a journal before any write
+                start_path, pseudo_file_path = self.create_clone_path(slide, None)
+                plan, origin_metadata = self.plan_pseudonym_file(handle, label, pseudo_label, pseudo_metadata,
+                                                                 prefix_error=prefix_error)
+
+                journal = pa.PatchJournal(start_path)
+                try:
+                    journal.prepare(plan, rename_to=pseudo_file_path)
+                except Exception as e:
+                    raise Exception(f"{prefix_error}Can not write journal of the Slide: {str(e)}") from None
+
+                try:
+                    journal.apply(stats=slide.write_stats)
+                except Exception as e:
+                    journal.rollback()
+                    raise Exception(f"{prefix_error}Can not patch the Slide in place: {str(e)}") from None
+
+                # the journal is committed (or rolled back) after the data is saved in DB
+                slide.journal = journal
+                print(f"{prefix_error}Patched the Slide in place ({slide.write_stats})")
+
+            case _:
+                raise Exception(f"{prefix_error}Write mode {write_mode} is not supported")
+
+        return pseudo_file_path, origin_metadata
+
+    def commit_pseudonym_file(self, slide: WSI, prefix_error=""):
+        """
+            Finish the pseudo-file of a slide after its data is saved in the store and DB
+            (in-place mode: commit the journal, rename the slide to its pseudo-ID)
+            :param slide: WSI data
+            :param prefix_error: prefix of message
+        """
+        # the structure of the original slide is not needed anymore
+        forget_cached_slide(slide.path)
+
+        if slide.journal is None:
+            return
+
+        try:
+            slide.journal.commit()
         except Exception as e:
-            raise Exception(f"{prefix_error}Can not copy clone of the Slide: {str(e)}") from None
+            # the journal is committed, the next start will finish it (patch_utils.recover_journal)
+            print(f"{prefix_error}Can not finish the in-place pseudonymisation: {str(e)}")
+
+        slide.journal = None
+
+    def remove_pseudonym_file(self, slide: WSI, pseudo_file_path):
+        """
+            Remove the pseudo-file of a slide during a rollback
+            (in-place mode: restore the original slide from the journal).
+            An error is added to error_messages, so the rollback of the other slides and of the store goes on
+            :param slide: WSI data
+            :param pseudo_file_path: path of the pseudo-file
+        """
+        journal = slide.journal
+        slide.journal = None
+        try:
+            if journal is not None:
+                journal.rollback()
+            else:
+                Path(pseudo_file_path).unlink(missing_ok=True)
+        except Exception as e:
+            if journal is not None:
+                # the journal is kept, InputData.validate of the next run on the slide finishes the rollback
+                error = f"Slide[id={slide.id}]: Can not restore the original slide, it is restored by the next run " \
+                        f"on the slide: {str(e)}"
+            else:
+                error = f"Slide[id={slide.id}]: Can not remove the pseudo-file {pseudo_file_path}: {str(e)}"
+            print(error)
+            self.error_messages.append(error)
 
     def create_pseudonym(self, slide: WSI, case: Case = None,
                          patient: Patient = None, study: Study = None, prefix_error=""):
@@ -1124,294 +1333,267 @@ class Pseudonymization:
         except Exception as e:
             raise Exception(f"Can not create pseudonym: {str(e)}") from None
 
-    def save_image_data_to_store(self, sub_image: Slide.SubImage, store_folder, prefix_error=""):
+    def save_image_data_to_store(self, sub_image: Slide.SubImage, store, prefix_error=""):
         """
             Save an associated image data to store
             :param sub_image: image data
-            :param store_folder: store folder path
+            :param store: store (store_utils.Store)
             :param prefix_error: prefix message
-            :return: path of label in the store, name, encrypt key
+            :return: name of label in the store, encrypt key
         """
         try:
-            # get image data
-            # we need following data to back up later
-            data = {
-                     "data_byte_counts": sub_image.data_byte_counts,
-                     "data_offsets": sub_image.data_offsets,
-                     "compression": sub_image.compression,
-                     "data": list(sub_image.get_image_data())
-                    }
-
-            data = json.dumps(data).encode('utf-8')
-
-            # create key
-            encrypted_img_key = Fernet.generate_key()
-
-            # create encrypt generator
-            fernet = Fernet(encrypted_img_key)
-
-            # encrypt data
-            encrypted_img_bytes = fernet.encrypt(data)
+            # uncompressed strips are compressed before the encryption, compressed strips are stored as they are
+            image_data = sub_image.get_image_data()
+            codec = su.choose_codec(image_data)
+
+            # write the image data encrypted in chunks to store (or reuse the record of an equal image)
+            # we need the offsets, byte counts and compression to back up later
+            encrypted_img_name, encrypted_img_key = store.write_record(
+                lambda f: su.write_image_record(f, sub_image.data_offsets, sub_image.data_byte_counts,
+                                                sub_image.compression, image_data),
+                codec=codec, create_name=lambda: create_name_in_store(store))
+
+            return encrypted_img_name, encrypted_img_key
+        except Exception as e:
+            raise Exception(f"{prefix_error}Can not save encrypted label in store: {str(e)}") from None
 
-            # generate a path of image in the store
-            encrypted_img_name, encrypted_img_path = create_file_path_in_store(store_folder)
+    def read_record_in_store(self, key, name, store):
+        """
+            Decrypt a record in store, the decrypted records are cached (see RECORD_CACHE)
+            :param key: key to decrypt
+            :param name: name of file in store
+            :param store: store (store_utils.Store)
+            :return: plaintext (bytearray)
+        """
+        plaintext = RECORD_CACHE.get(name, key)
+        if plaintext is not None:
+            return plaintext
+
+        # check exist record
+        if store.exists(name) is False:
+            raise Exception("Can not find the record in store")
+
+        with store.reader(name) as lif:
+            if su.is_encrypted_stream(lif):
+                # decrypt the record chunk by chunk
+                with su.StreamReader(lif, key) as reader:
+                    plaintext = su.read_all(reader)
+            else:
+                # get data of encrypted record (Fernet token of older versions)
+                data = lif.read()
 
-            # write encrypted data to store
-            with open(encrypted_img_path, "wb") as lif:
-                lif.write(encrypted_img_bytes)
+                fernet = Fernet(key)
+                try:
+                    # decrypt data to get origin data
+                    plaintext = bytearray(fernet.decrypt(data))
+                except InvalidToken:
+                    raise Exception("Key is invalid")
 
-            return encrypted_img_path, encrypted_img_name, encrypted_img_key
-        except Exception as e:
-            raise Exception(f"{prefix_error}Can not save encrypted label in store: {str(e)}") from None
+        RECORD_CACHE.put(name, key, plaintext)
+        return plaintext
 
-    def get_image_data_in_store(self, key, pseudo_image_data_name, store_folder, prefix_error=""):
+    def get_image_data_in_store(self, key, pseudo_image_data_name, store, prefix_error=""):
         """
             Decrypt an associated image data in store
             :param key: key to decrypt
             :param pseudo_image_data_name: name of file in store
-            :param store_folder: store folder path
+            :param store: store (store_utils.Store)
             :param prefix_error: prefix message
-            :return: path of label in the store, name, encrypt key
+            :return: image data (dict of data_byte_counts, data_offsets, compression and data)
         """
         try:
-            # get path of encrypted data in the store
-            encrypted_image_path = store_folder.joinpath(pseudo_image_data_name, '')
-
-            # check exist path
-            if os.path.exists(encrypted_image_path) is False:
-                raise Exception(f"{prefix_error}Can not find the label in store")
-
-            # get image data of encrypted label
-            with open(encrypted_image_path, "rb") as lif:
-                data = lif.read()
-
-            fernet = Fernet(key)
-            try:
-                # decrypt data to get origin data
-                decrypted_data = fernet.decrypt(data)
-                decrypted_data = json.loads(decrypted_data.decode('utf-8'))
-                decrypted_data["data"] = bytes(decrypted_data["data"])
-                return decrypted_data
-            except InvalidToken:
-                raise Exception("Key is invalid")
-
+            # binary record, the records saved as JSON by older versions can still be read
+            return su.unpack_image_record(self.read_record_in_store(key, pseudo_image_data_name, store))
         except Exception as e:
             raise Exception(f"{prefix_error}Can not decrypt image in store: {str(e)}") from None
 
-    def save_metadata_to_store(self, file_path, key, metadata, prefix_error=""):
+    def save_metadata_to_store(self, store, metadata, prefix_error=""):
         """
-            Save an associated image data to store
-            :param file_path: file path in the store
-            :param key: key to encrypt
+            Save metadata of an image to store
+            :param store: store (store_utils.Store)
             :param metadata: image metadata
             :param prefix_error: prefix message
-            :return: path of file in the store, filename, encrypt key
+            :return: name of metadata in the store, encrypt key
         """
         try:
-            # get image data
             # we need following data to back up later
             data = json.dumps(metadata).encode('utf-8')
 
-            # create encrypt generator
-            fernet = Fernet(key)
-
-            # encrypt data
-            encrypted_bytes = fernet.encrypt(data)
-
-            # generate a path in the store
-
-            # write encrypted data to store
-            with open(file_path, "wb") as lif:
-                lif.write(encrypted_bytes)
-
-            return True
+            # write data encrypted in chunks to store (or reuse the record of equal metadata)
+            return store.write_record(lambda f: f.write(data), codec=su.choose_codec(data),
+                                      create_name=lambda: create_name_in_store(store))
         except Exception as e:
             raise Exception(f"{prefix_error}Can not save metadata in store: {str(e)}") from None
 
-        return False
-
-    def get_metadata_in_store(self, key, filename, store_folder, prefix_error=""):
+    def get_metadata_in_store(self, key, filename, store, prefix_error=""):
         """
             Decrypt an associated image data in store
             :param key: key to decrypt
             :param filename: name of file in store
-            :param store_folder: store folder path
+            :param store: store (store_utils.Store)
             :param prefix_error: prefix message
-            :return: path of label in the store, name, encrypt key
+            :return: metadata
         """
         try:
-            # get path of encrypted data in the store
-            encrypted_path = store_folder.joinpath(filename, '')
-
-            # check exist path
-            if os.path.exists(encrypted_path) is False:
-                raise Exception(f"{prefix_error}Can not find metadata in store")
-
-            # get image data of encrypted label
-            with open(encrypted_path, "rb") as lif:
-                data = lif.read()
-
-            fernet = Fernet(key)
-            try:
-                # decrypt data to get origin data
-                decrypted_data = fernet.decrypt(data)
-                decrypted_data = json.loads(decrypted_data.decode('utf-8'))
-                return decrypted_data
-            except InvalidToken:
-                raise Exception("Key is invalid")
-
+            return json.loads(self.read_record_in_store(key, filename, store))
         except Exception as e:
             raise Exception(f"{prefix_error}Can not decrypt data in store: {str(e)}") from None
 
     def generate_metadata_svs(self, file_path, new_data, prefix_error=""):
         """
         generate metadata for each IFD in an Aperio file
-        :param file_path: path of file
+        :param file_path: path of file (or an open SlideHandle)
         :param new_data: new data of metadata contains fields that need to be replaced
         :param prefix_error: prefix of message/error
         :return: original metadata, new metadata
         """
         # read file
-        tif = tifffile.TiffFile(file_path)
+        with slide_handle(file_path) as handle:
+            tif = handle.tiff
 
-        # origin metadata to save for backup
-        origin_data = []
+            # origin metadata to save for backup
+            origin_data = []
 
-        # new metadata
-        new_metadata = []
+            # new metadata
+            new_metadata = []
 
-        try:
-            # read each image file directory to find metadata in the description tag
-            for page in tif.pages:
+            try:
+                # read each image file directory to find metadata in the description tag
+                for page in tif.ifds:
 
-                # get description of idf
-                description = page.description
+                    # get description of idf
+                    description = page.description
 
-                if description is not None:
-                    have_data = False  # does the idf have identifier in metadata?
-                    for key in new_data.keys():
-                        if key in description:
-                            have_data = True
-                            break
+                    if description is not None:
+                        have_data = False  # does the idf have identifier in metadata?
+                        for key in new_data.keys():
+                            if key in description:
+                                have_data = True
+                                break
 
-                    if have_data is False:
-                        continue
+                        if have_data is False:
+                            continue
 
-                    # if identifier was found
-                    data = description.split("|")
+                        # if identifier was found
+                        data = description.split("|")
 
-                    # contains index of metadata-info will be deleted because of no corresponding value
-                    removing_index = []
+                        # contains index of metadata-info will be deleted because of no corresponding value
+                        removing_index = []
 
-                    for idx, info in enumerate(data):
-                        separator = "="
-                        if separator in info:
-                            if " = " in info:
-                                separator = " = "
+                        for idx, info in enumerate(data):
+                            separator = "="
+                            if separator in info:
+                                if " = " in info:
+                                    separator = " = "
 
-                            key_val = info.split(separator)
+                                key_val = info.split(separator)
 
-                            if len(key_val) == 2:
-                                key, val = key_val[0], key_val[1]
+                                if len(key_val) == 2:
+                                    key, val = key_val[0], key_val[1]
 
-                                if key in new_data:
-                                    if new_data[key] is None:
-                                        # value is None => will be deleted
-                                        removing_index.append(idx)
-                                    else:
-                                        data[idx] = f"{key}{separator}{new_data[key]}"
+                                    if key in new_data:
+                                        if new_data[key] is None:
+                                            # value is None => will be deleted
+                                            removing_index.append(idx)
+                                        else:
+                                            data[idx] = f"{key}{separator}{new_data[key]}"
 
-                    # remove unnecessary info in metadata
-                    data = np.delete(data, removing_index)
+                        # remove unnecessary info in metadata
+                        data = np.delete(data, removing_index)
 
-                    # create new metadata
-                    new_description = "|".join(data)
-                    new_metadata.append((page.index, new_description))
+                        # create new metadata
+                        new_description = "|".join(data)
+                        new_metadata.append((page.index, new_description))
 
-                    # save origin metadata
-                    description_tag = page.tags.get(270)
-                    origin_data.append({
-                        "page_index": page.index,
-                        "shape": page.shape,
-                        "count": description_tag.count,
-                        "value_offset": description_tag.valueoffset,
-                        "value": description_tag.value,  # description
-                    })
+                        # save origin metadata
+                        description_tag = page.tags.get(270)
+                        origin_data.append({
+                            "page_index": page.index,
+                            "shape": page.shape,
+                            "count": description_tag.count,
+                            "value_offset": description_tag.valueoffset,
+                            "value": description_tag.value,  # description
+                        })
 
-        except Exception as e:
-            print(str(e))
-            raise Exception(f"{prefix_error}Can not generate new metadata") from None
-        finally:
-            tif.close()
+            except Exception as e:
+                print(str(e))
+                raise Exception(f"{prefix_error}Can not generate new metadata") from None
 
         return origin_data, new_metadata
 
-    def replace_metadata_svs(self, file_path, new_data, prefix_error=""):
+    def plan_metadata_replacement_svs(self, file_path, new_data, plan: pa.PatchPlan, prefix_error=""):
         """
-        replace metadata for each IFD in an Aperio file
-        :param file_path: path of file
+        compute the patches to replace metadata for each IFD in an Aperio file
+        :param file_path: path of file (the original file or a clone of it) or an open SlideHandle
         :param new_data: new data of metadata contains fields that need to be replaced
+        :param plan: patch plan of the file, the patches will be added into it
         :param prefix_error: prefix of message/error
         :return: original metadata
         """
         # read file
-        tif = tifffile.TiffFile(file_path)
+        with slide_handle(file_path) as handle:
+            tif = handle.tiff
 
-        try:
-            # generate new metadata for each IFD and save the original metadata for de-pseudonymization
-            origin_data, new_metadata = self.generate_metadata_svs(file_path, new_data, prefix_error)
+            try:
+                # generate new metadata for each IFD and save the original metadata for de-pseudonymization
+                origin_data, new_metadata = self.generate_metadata_svs(handle, new_data, prefix_error)
 
-            # replace in file
-            with open(file_path, "r+b") as f:
-                # get endian order of bytes
-                big_endian = True if f.read(2) == b"MM" else False  # b"II" is litle-endian
                 for idx, metadata in new_metadata:
-                    page = tif.pages[idx]
+                    page = tif.ifds[idx]
                     description_tag = page.tags.get(270)
+                    metadata_bytes = metadata.encode()
+
                     # write length of new metadata to file
-                    f.seek(description_tag.offset + 4)  # offset + 4 to move to length-offset
-                    f.write(cu.int_to_bytes(len(metadata), length=4, is_big_endian=big_endian))
+                    # (count and value-offset of an entry are 4 bytes in TIFF, 8 bytes in BigTIFF)
+                    plan.write(description_tag.count_offset, tif.pack_offset(len(metadata_bytes)))
 
                     if len(page.description) > len(metadata):
                         # pad new metadata to a fixed length of old metadata with spaces
                         # this helps wipe all original data too
-                        metadata = metadata.ljust(description_tag.count)
-
-                        # write data
-                        f.seek(description_tag.valueoffset)
-                        f.write(metadata.encode())
+                        plan.write(description_tag.valueoffset, metadata_bytes.ljust(description_tag.count))
                     else:
                         # the memory space of the original description data is not enough for pseudonymous data
-                        # therefore, the new metadata will be written in end of the file
-                        # and the original data will be removed out the file also
-                        f.seek(description_tag.valueoffset)
-                        f.write("".ljust(description_tag.count).encode())
+                        # therefore, the new metadata will be written into another wiped range (e.g. the place of
+                        # the old label) or in end of the file, and the original data will be removed out the file also
+                        plan.wipe(description_tag.valueoffset, description_tag.count, fill=b" ")
 
-                        f.seek(0, 2)  # go to eof to avoid conflict
+                        # write new metadata into the wiped space (or to the end of the file)
+                        offset = plan.allocate(metadata_bytes)
 
-                        offset = f.tell()   # save value offset
+                        # write new value offset
+                        plan.write(description_tag.value_field_offset, tif.pack_offset(offset))
 
-                        # write new metadata to the file
-                        f.write(metadata.encode())
+            except Exception as e:
+                print(str(e))
+                raise Exception(f"{prefix_error}Can not replace metadata") from None
 
-                        # write new value offset
-                        f.seek(description_tag.offset + 8)  # offset + 8 to move to value-offset
-                        f.write(cu.int_to_bytes(offset, length=4, is_big_endian=big_endian))
+        return origin_data
 
-                    f.flush()
+    def replace_metadata_svs(self, file_path, new_data, prefix_error=""):
+        """
+        replace metadata for each IFD in an Aperio file
+        :param file_path: path of file (or an open, writable SlideHandle)
+        :param new_data: new data of metadata contains fields that need to be replaced
+        :param prefix_error: prefix of message/error
+        :return: original metadata
+        """
+        with slide_handle(file_path, writable=True) as handle:
+            plan = pa.PatchPlan.for_file(handle.file)
+            origin_data = self.plan_metadata_replacement_svs(handle, new_data, plan, prefix_error)
 
-        except Exception as e:
-            print(str(e))
-            raise Exception(f"{prefix_error}Can not replace metadata") from None
-        finally:
-            tif.close()
+            try:
+                # replace in file
+                handle.apply(plan)
+            except Exception as e:
+                print(str(e))
+                raise Exception(f"{prefix_error}Can not replace metadata") from None
 
         return origin_data
 
     def back_up_metadata_svs(self, file_path, origin_metadata_data, prefix_error=""):
         """
         back up original metadata for an Aperio file
-        :param file_path: path of file
+        :param file_path: path of file (or an open, writable SlideHandle)
         :param origin_metadata_data: original metadata
         :param prefix_error: prefix of message/error
         :return: No return
@@ -1424,19 +1606,18 @@ class Pseudonymization:
                     raise Exception(f"{prefix_error}{key} is not found")
 
         # check exist path
-        if os.path.exists(file_path) is False:
+        if not isinstance(file_path, SlideHandle) and os.path.exists(file_path) is False:
             raise Exception(f"{prefix_error}Can not find the file in store")
 
         # read file
-        tif = tifffile.TiffFile(file_path)
+        with slide_handle(file_path, writable=True) as handle:
+            tif = handle.tiff
 
-        # replace in file
-        try:
-            with open(file_path, "r+b") as f:
-                # get endian order of bytes
-                big_endian = True if f.read(2) == b"MM" else False  # b"II" is litle-endian
+            # replace in file
+            try:
+                plan = pa.PatchPlan.for_file(handle.file)
                 for metadata in origin_metadata_data:
-                    page = tif.pages[metadata["page_index"]]
+                    page = tif.ifds[metadata["page_index"]]
 
                     if page.shape != tuple(metadata["shape"]):
                         raise Exception("Shape image does not match")
@@ -1444,32 +1625,32 @@ class Pseudonymization:
                     description_tag = page.tags.get(270)
 
                     # wipe pseudo metadata
-                    f.seek(description_tag.valueoffset)
-                    f.write("".ljust(description_tag.count).encode())
+                    # a pseudo metadata can be placed into the original place of another metadata
+                    # (see plan_metadata_replacement_svs), the original data written later wins in the plan
+                    plan.wipe(description_tag.valueoffset, description_tag.count, fill=b" ")
 
                     # write length of metadata to file
-                    f.seek(description_tag.offset + 4)  # offset + 4 to move to length-offset
-                    f.write(cu.int_to_bytes(metadata["count"], length=4, is_big_endian=big_endian))
+                    # (count and value-offset of an entry are 4 bytes in TIFF, 8 bytes in BigTIFF)
+                    plan.write(description_tag.count_offset, tif.pack_offset(metadata["count"]))
 
                     # write new value offset
-                    f.write(cu.int_to_bytes(metadata["value_offset"], length=4, is_big_endian=big_endian))
+                    plan.write(description_tag.value_field_offset, tif.pack_offset(metadata["value_offset"]))
 
+                for metadata in origin_metadata_data:
                     # write data
-                    f.seek(metadata["value_offset"])
-                    f.write(metadata["value"].encode())
+                    plan.write(metadata["value_offset"], metadata["value"].encode())
 
-                    f.flush()
-        except Exception as e:
-            print(str(e))
-            raise Exception(f"{prefix_error}Can not replace metadata") from None
-        finally:
-            tif.close()
+                handle.apply(plan)
+            except Exception as e:
+                print(str(e))
+                raise Exception(f"{prefix_error}Can not replace metadata") from None
 
-    async def perform_single_wsi(self, dest_folder=None) -> list:
+    async def perform_single_wsi(self, dest_folder=None, write_mode=WriteMode.CLONE) -> list:
         """
             perform pseudonymisation for a single slide (WSI)
             :parameter:
                 dest_folder: path of folder the output pseudo-file will be saved
+                write_mode: how the pseudo-file is written (WriteMode), default is CLONE
             :return:
                 pseudo-data JSON
         """
@@ -1482,8 +1663,8 @@ class Pseudonymization:
             return None
 
         # validate store folder path
-        store_folder = self.check_store_path()
-        if store_folder is None:
+        store = self.check_store_path()
+        if store is None:
             return None
 
         # validate destination folder path
@@ -1500,7 +1681,7 @@ class Pseudonymization:
         # check vendor of the slide
         match self.pseudo_data.vendor:
             case Vendor.APERIO:
-                encrypted_label_path = None
+                encrypted_label_name = None
                 try:
                     slide_data = self.pseudo_data.slide_data
 
@@ -1512,22 +1693,21 @@ class Pseudonymization:
                         print(f"Can not find the label of the Slide")
                         return None
 
-                    # copy clone of slide
-                    pseudo_file_path = self.copy_clone(self.pseudo_data, dest_folder)
-
-                    copied_clone_flag = True
-                    self.pseudo_data.pseudo_file_path = pseudo_file_path
-
                     # create pseudonym
                     pseudo_label = self.create_pseudonym(self.pseudo_data)
 
-                    try:
-                        # replace pseudonym with label
-                        rs = pu.replace_label_with_pseudonym_svs(pseudo_file_path, pseudo_label, label.ifd)
-                        if rs is False:  # failed
-                            raise Exception("Can not replace pseudonym with label")
-                    except Exception as e:
-                        raise Exception(f"Can not replace label with pseudo-label: {str(e)}") from None
+                    # create pseudo metadata
+                    pseudo_metadata = {"Filename": self.pseudo_data.pseudo_id,
+                                       "Title": self.pseudo_data.pseudo_id,
+                                       "Date": None, "Time": None,  "Time Zone": None, "User": None}
+
+                    # write pseudo-file (label replaced with pseudonym, metadata replaced with pseudo metadata)
+                    pseudo_file_path, origin_metadata = self.write_pseudonym_file(self.pseudo_data, dest_folder,
+                                                                                  pseudo_label, pseudo_metadata,
+                                                                                  write_mode=write_mode)
+
+                    copied_clone_flag = True
+                    self.pseudo_data.pseudo_file_path = pseudo_file_path
 
                     # create pseudo-json
                     rs_json = self.create_json(InputType.SINGLE_WSI, self.pseudo_data,
@@ -1537,35 +1717,18 @@ class Pseudonymization:
                     if rs_json is None:
                         raise Exception("Something wrong, can not create data of JSON")
 
-                    # create pseudo metadata
-                    pseudo_metadata = {"Filename": self.pseudo_data.pseudo_id,
-                                       "Title": self.pseudo_data.pseudo_id,
-                                       "Date": None, "Time": None,  "Time Zone": None, "User": None}
-
-                    # replace metadata with pseudo metadata
-                    origin_metadata = self.replace_metadata_svs(pseudo_file_path, pseudo_metadata)
-
                     # if pseudo-data is not retrieved from DB
                     # it means that new pseudo-data has just been created
                     # therefore, this data has to be added to the store and database also
                     if self.pseudo_data.get_from_database is False:
 
-                        # create key to encrypt metadata
-                        encrypt_meta_key = Fernet.generate_key()
-
-                        # generate a path in the store
-                        encrypt_meta_name, encrypt_meta_path = create_file_path_in_store(store_folder)
-
-                        # save metadata to store
-                        saved_encrypted_metadata_flag = self.save_metadata_to_store(encrypt_meta_path,
-                                                                                    encrypt_meta_key,
-                                                                                    origin_metadata)
-                        if saved_encrypted_metadata_flag is False:
-                            raise Exception("Can not save metadata in the store")
+                        # save metadata to store, encrypted with a new key under a new name
+                        encrypt_meta_name, encrypt_meta_key = self.save_metadata_to_store(store, origin_metadata)
+                        saved_encrypted_metadata_flag = True
 
                         # save label to store
-                        rs_saved_to_store = self.save_image_data_to_store(label, store_folder)
-                        encrypted_label_path, encrypted_label_name, encrypted_label_key = rs_saved_to_store
+                        rs_saved_to_store = self.save_image_data_to_store(label, store)
+                        encrypted_label_name, encrypted_label_key = rs_saved_to_store
                         print("Saved label in store")
 
                         # successful flag
@@ -1619,22 +1782,34 @@ class Pseudonymization:
                                 await session.rollback()
                                 print(str(ex))
                                 raise Exception("Can not save data in DB") from None
+
+                    # finish pseudo-file (in-place mode: commit the journal)
+                    self.commit_pseudonym_file(self.pseudo_data)
+
                     return rs_json
                 except Exception as ex:
                     print(str(ex))
                     print("Rollback....")
 
-                    # remove clone file
+                    # remove clone file (in-place mode: restore the original slide)
                     if copied_clone_flag:
-                        Path(pseudo_file_path).unlink()
+                        self.remove_pseudonym_file(self.pseudo_data, pseudo_file_path)
 
                     # remove metadata file
                     if saved_encrypted_metadata_flag:
-                        Path(encrypt_meta_path).unlink()
+                        try:
+                            store.release(encrypt_meta_name)
+                        except Exception as e:
+                            self.error_messages.append(f"Can not remove the metadata in store: {str(e)}")
+                            print(self.error_messages[-1])
 
                     # remove encrypted label in the store
                     if saved_encrypted_label_flag:
-                        Path(encrypted_label_path).unlink()
+                        try:
+                            store.release(encrypted_label_name)
+                        except Exception as e:
+                            self.error_messages.append(f"Can not remove the label in store: {str(e)}")
+                            print(self.error_messages[-1])
                 pass
             # case Vendor.HAMAMATSU:
             # case Vendor.MIRAX:
@@ -1661,8 +1836,8 @@ class Pseudonymization:
             return None
 
         # validate store folder path
-        store_folder = self.check_store_path()
-        if store_folder is None:
+        store = self.check_store_path()
+        if store is None:
             return None
 
         # validate destination folder path
@@ -1691,7 +1866,7 @@ class Pseudonymization:
                     # decrypt label to get origin label
                     decrypted_label_data = self.get_image_data_in_store(self.pseudo_data.pseudo_label_key,
                                                                         self.pseudo_data.pseudo_label_name,
-                                                                        store_folder)
+                                                                        store)
 
                     # copy clone
                     origin_file_path = self.copy_clone(self.pseudo_data, dest_folder)
@@ -1702,18 +1877,21 @@ class Pseudonymization:
                     # restore metadata
                     metadata_in_store = self.get_metadata_in_store(self.pseudo_data.pseudo_metadata_key,
                                                                    self.pseudo_data.pseudo_metadata_name,
-                                                                   store_folder)
+                                                                   store)
 
-                    self.back_up_metadata_svs(origin_file_path, metadata_in_store)
+                    # the clone is opened once for both restores (the IFDs of the pseudo-file are reused)
+                    with SlideHandle(origin_file_path, writable=True, tiff=slide_data.slide,
+                                     stats=self.pseudo_data.write_stats) as handle:
+                        self.back_up_metadata_svs(handle, metadata_in_store)
 
-                    try:
-                        # replace pseudonym with origin label
-                        rs = pu.back_up_image_svs(self.pseudo_data.path, decrypted_label_data, label.ifd)
+                        try:
+                            # replace pseudonym with origin label
+                            rs = pu.back_up_image_svs(handle, decrypted_label_data, label.ifd)
 
-                        if rs is False:  # failed
-                            raise Exception("Can not write label to pseudo-file")
-                    except Exception as e:
-                        raise Exception(f"Can not replace pseudo-label with label: {str(e)}") from None
+                            if rs is False:  # failed
+                                raise Exception("Can not write label to pseudo-file")
+                        except Exception as e:
+                            raise Exception(f"Can not replace pseudo-label with label: {str(e)}") from None
 
                     # create json
                     rs_json = self.create_json(InputType.SINGLE_WSI, self.pseudo_data, self.input_data.basic_json)
@@ -1740,11 +1918,12 @@ class Pseudonymization:
 
         return None
 
-    async def perform_case(self, dest_folder=None) -> list:
+    async def perform_case(self, dest_folder=None, write_mode=WriteMode.CLONE) -> list:
         """
             perform pseudonymisation for a Case
             :parameter:
                 dest_folder: path of folder the output clone file will be saved
+                write_mode: how the pseudo-file is written (WriteMode), default is CLONE
             :return:
                 pseudo-data JSON
         """
@@ -1756,8 +1935,8 @@ class Pseudonymization:
             return None
 
         # validate store folder path
-        store_folder = self.check_store_path()
-        if store_folder is None:
+        store = self.check_store_path()
+        if store is None:
             return None
 
         # validate destination folder path
@@ -1767,9 +1946,9 @@ class Pseudonymization:
                 print("Destination path must be a directory")
                 return None
 
-        clone_paths = []  # slide's clone paths
-        file_in_store_paths = []  # encrypted images paths in the store
-        metadata_in_store_paths = []  # encrypted metadata paths in the store
+        pseudo_files = []  # slide and path of its pseudo-file
+        store_writer = su.StoreWriter(store)  # writes the labels and metadata of the slides at the same time
+        store_jobs = []  # database-slide, writing of its metadata and label to store
         db_wsis = []  # list of slide will be inserted to DB
         db_update_wsis = []  # list of slide will be updated in DB
         try:
@@ -1789,62 +1968,35 @@ class Pseudonymization:
                             print(f"{prefix_message}Can not find the label of the Slide")
                             continue
 
-                        # copy clone of slide
-                        pseudo_file_path = self.copy_clone(slide, dest_folder, prefix_error=prefix_message)
-
-                        clone_paths.append(pseudo_file_path)
-                        self.pseudo_data.slides[idx].pseudo_file_path = pseudo_file_path
-
                         # create pseudonym
                         pseudo_label = self.create_pseudonym(slide, case=self.pseudo_data, prefix_error=prefix_message)
 
-                        try:
-                            # replace pseudonym with label
-                            rs = pu.replace_label_with_pseudonym_svs(pseudo_file_path, pseudo_label, label.ifd)
-                            if rs is False:  # failed
-                                raise Exception("Can not replace pseudonym with label")
-                        except Exception as e:
-                            raise Exception(f"{prefix_message}Can not replace label with "
-                                            f"pseudo-label: {str(e)}") from None
-
                         # create pseudo metadata
                         pseudo_metadata = {"Filename": slide.pseudo_id,
                                            "Title": slide.pseudo_id,
                                            "Date": None, "Time": None, "Time Zone": None, "User": None}
 
-                        # replace metadata with pseudo metadata
-                        origin_metadata = self.replace_metadata_svs(pseudo_file_path, pseudo_metadata)
+                        # write pseudo-file (label replaced with pseudonym, metadata replaced with pseudo metadata)
+                        pseudo_file_path, origin_metadata = self.write_pseudonym_file(slide, dest_folder,
+                                                                                      pseudo_label, pseudo_metadata,
+                                                                                      write_mode=write_mode,
+                                                                                      prefix_error=prefix_message)
+
+                        pseudo_files.append((slide, pseudo_file_path))
+                        self.pseudo_data.slides[idx].pseudo_file_path = pseudo_file_path
 
                         # if pseudo-data of the slide is not retrieved from DB
                         # it means that new pseudo-data has just been created
                         # therefore, this data has to be added to the store and database also
                         if slide.get_from_database is False:
 
-                            # create key to encrypt metadata
-                            encrypt_meta_key = Fernet.generate_key()
-
-                            # generate a path in the store
-                            encrypt_meta_name, encrypt_meta_path = create_file_path_in_store(store_folder)
-
-                            # save metadata to store
-                            saved_rs = self.save_metadata_to_store(encrypt_meta_path,
-                                                                   encrypt_meta_key,
-                                                                   origin_metadata)
-
-                            metadata_in_store_paths.append(encrypt_meta_path)
-
-                            if saved_rs is False:
-                                raise Exception(f"{prefix_message}Can not save metadata in the store")
-
-                            # save label to store
-                            rs_saved = self.save_image_data_to_store(label, store_folder, prefix_error=prefix_message)
-
-                            encrypted_label_path, encrypted_label_name, encrypted_label_key = rs_saved
-                            print(f"{prefix_message}Saved label in store")
-
-                            # add path to list of path in store,
-                            # when something wrong appears, all files in this list will be removed
-                            file_in_store_paths.append(encrypted_label_path)
+                            # save metadata and label to store, encrypted with new keys under new names
+                            # the records are written in the background, while the next slides are processed
+                            # (when something wrong appears, all written records will be removed)
+                            metadata_job = store_writer.submit(self.save_metadata_to_store, store, origin_metadata,
+                                                               prefix_error=prefix_message)
+                            label_job = store_writer.submit(self.save_image_data_to_store, label, store,
+                                                            prefix_error=prefix_message)
 
                             # create database-slide
                             wsi = model.WSI()
@@ -1856,12 +2008,9 @@ class Pseudonymization:
                             wsi.pseudo_id = slide.pseudo_id
                             wsi.pseudo_name = slide.pseudo_name
                             wsi.pseudo_acquired_at = slide.pseudo_acquired_at
-                            wsi.pseudo_metadata_name = encrypt_meta_name
-                            wsi.pseudo_metadata_key = encrypt_meta_key
-                            wsi.pseudo_label_name = encrypted_label_name
-                            wsi.pseudo_label_key = encrypted_label_key
 
                             db_wsis.append(wsi)
+                            store_jobs.append((wsi, metadata_job, label_job, prefix_message))
                         elif slide.need_to_be_updated:
                             db_update_wsis.append(slide)
 
@@ -1872,6 +2021,12 @@ class Pseudonymization:
                         print(f"{prefix_message}Vendor of Slide is still not supported!")
                         continue
 
+            # wait for the store, the names and keys of the records are saved in DB
+            for wsi, metadata_job, label_job, prefix_message in store_jobs:
+                wsi.pseudo_metadata_name, wsi.pseudo_metadata_key = await metadata_job
+                wsi.pseudo_label_name, wsi.pseudo_label_key = await label_job
+                print(f"{prefix_message}Saved label in store")
+
             # create json
             rs_json = self.create_json(InputType.CASE, self.pseudo_data, self.input_data.basic_json)
 
@@ -1951,25 +2106,30 @@ class Pseudonymization:
                     await session.rollback()
                     raise Exception("Can not save data in DB: ", str(ex))
 
+            # finish pseudo-files (in-place mode: commit the journals)
+            for slide, _ in pseudo_files:
+                self.commit_pseudonym_file(slide)
+
             return rs_json
 
         except Exception as e:
             print(str(e))
             print("Rollback...")
 
-            # remove clones
-            for clone_path in clone_paths:
-                Path(clone_path).unlink()
-
-            # remove encrypted images in store
-            for file_path in file_in_store_paths:
-                Path(file_path).unlink()
+            # remove clones (in-place mode: restore the original slides)
+            for slide, pseudo_file_path in pseudo_files:
+                self.remove_pseudonym_file(slide, pseudo_file_path)
 
-            # remove encrypted metadata in store
-            for metadata_path in metadata_in_store_paths:
-                Path(metadata_path).unlink()
+            # remove encrypted images and metadata in store
+            try:
+                await store_writer.rollback()
+            except Exception as ex:
+                self.error_messages.append(f"Can not remove the records in store: {str(ex)}")
+                print(self.error_messages[-1])
 
             return None
+        finally:
+            store_writer.close()
 
         return None
 
@@ -1989,8 +2149,8 @@ class Pseudonymization:
             return None
 
         # validate store folder path
-        store_folder = self.check_store_path()
-        if store_folder is None:
+        store = self.check_store_path()
+        if store is None:
             return None
 
         # validate destination folder path
@@ -2028,7 +2188,7 @@ class Pseudonymization:
                         # decrypt label to get origin label
                         decrypted_label_data = self.get_image_data_in_store(slide.pseudo_label_key,
                                                                             slide.pseudo_label_name,
-                                                                            store_folder,
+                                                                            store,
                                                                             prefix_error=prefix_message)
                         # copy clone
                         origin_file_path = self.copy_clone(slide, dest_folder, prefix_error=prefix_message)
@@ -2039,20 +2199,23 @@ class Pseudonymization:
                         # restore metadata
                         metadata_in_store = self.get_metadata_in_store(slide.pseudo_metadata_key,
                                                                        slide.pseudo_metadata_name,
-                                                                       store_folder,
+                                                                       store,
                                                                        prefix_error=prefix_message)
 
-                        self.back_up_metadata_svs(origin_file_path, metadata_in_store, prefix_error=prefix_message)
+                        # the clone is opened once for both restores (the IFDs of the pseudo-file are reused)
+                        with SlideHandle(origin_file_path, writable=True, tiff=slide.slide_data.slide,
+                                         stats=slide.write_stats) as handle:
+                            self.back_up_metadata_svs(handle, metadata_in_store, prefix_error=prefix_message)
 
-                        try:
-                            # replace pseudonym with origin label
-                            rs = pu.back_up_image_svs(origin_file_path, decrypted_label_data, label.ifd)
+                            try:
+                                # replace pseudonym with origin label
+                                rs = pu.back_up_image_svs(handle, decrypted_label_data, label.ifd)
 
-                            if rs is False:  # failed
-                                raise Exception("Something wrong")
-                        except Exception as e:
-                            raise Exception(f"{prefix_message}Can not replace the label of the Slide:"
-                                            f" {str(e)}") from None
+                                if rs is False:  # failed
+                                    raise Exception("Something wrong")
+                            except Exception as e:
+                                raise Exception(f"{prefix_message}Can not replace the label of the Slide:"
+                                                f" {str(e)}") from None
 
                     # case Vendor.HAMAMATSU:
                     # case Vendor.MIRAX:
@@ -2079,11 +2242,12 @@ class Pseudonymization:
 
         return None
 
-    async def perform_study(self, dest_folder=None) -> list:
+    async def perform_study(self, dest_folder=None, write_mode=WriteMode.CLONE) -> list:
         """
             perform pseudonymisation for Study
             :parameter:
                 dest_folder: path of folder the output clone file will be saved
+                write_mode: how the pseudo-file is written (WriteMode), default is CLONE
             :return:
                 pseudo-data JSON
         """
@@ -2095,8 +2259,8 @@ class Pseudonymization:
             return None
 
         # validate store folder path
-        store_folder = self.check_store_path()
-        if store_folder is None:
+        store = self.check_store_path()
+        if store is None:
             return None
 
         # validate destination folder path
@@ -2106,9 +2270,9 @@ class Pseudonymization:
                 print("Destination path must be a directory")
                 return None
 
-        clone_paths = []  # slide's clone paths
-        file_in_store_paths = []  # encrypted images paths in the store
-        metadata_in_store_paths = []  # encrypted metadata paths in the store
+        pseudo_files = []  # slide and path of its pseudo-file
+        store_writer = su.StoreWriter(store)  # writes the labels and metadata of the slides at the same time
+        store_jobs = []  # database-slide, writing of its metadata and label to store
         patient_slides = []  # list of patient will be inserted to DB
         db_update_wsis = []  # list of slide will be updated in DB
 
@@ -2134,64 +2298,38 @@ class Pseudonymization:
                                 print(f"{prefix_message}Can not find the label of the Slide")
                                 continue
 
-                            # copy clone of slide
-                            pseudo_file_path = self.copy_clone(slide, dest_folder, prefix_error=prefix_message)
-
-                            clone_paths.append(pseudo_file_path)
-                            self.pseudo_data.patients[patient_idx].slides[idx].pseudo_file_path = pseudo_file_path
-
                             # create pseudonym
                             pseudo_label = self.create_pseudonym(slide, patient=patient, study=self.pseudo_data,
                                                                  prefix_error=prefix_message)
 
-                            try:
-                                # replace origin label with the pseudonym-label
-                                rs = pu.replace_label_with_pseudonym_svs(pseudo_file_path, pseudo_label, label.ifd)
-
-                                if rs is False:  # failed
-                                    raise Exception("Can not replace pseudonym with label")
-                            except Exception as e:
-                                raise Exception(f"{prefix_message}Can not replace label with "
-                                                f"pseudo-label: {str(e)}") from None
-
                             # create pseudo metadata
                             pseudo_metadata = {"Filename": slide.pseudo_id,
                                                "Title": slide.pseudo_id,
                                                "Date": None, "Time": None, "Time Zone": None, "User": None}
 
-                            # replace metadata with pseudo metadata
-                            origin_metadata = self.replace_metadata_svs(pseudo_file_path, pseudo_metadata)
+                            # write pseudo-file (origin label replaced with the pseudonym-label,
+                            # metadata replaced with pseudo metadata)
+                            pseudo_file_path, origin_metadata = self.write_pseudonym_file(slide, dest_folder,
+                                                                                          pseudo_label,
+                                                                                          pseudo_metadata,
+                                                                                          write_mode=write_mode,
+                                                                                          prefix_error=prefix_message)
+
+                            pseudo_files.append((slide, pseudo_file_path))
+                            self.pseudo_data.patients[patient_idx].slides[idx].pseudo_file_path = pseudo_file_path
 
                             # if pseudo-data of the slide is not retrieved from DB
                             # it means that new pseudo-data has just been created
                             # therefore, this data has to be added to the store and database also
                             if slide.get_from_database is False:
 
-                                # create key to encrypt metadata
-                                encrypt_meta_key = Fernet.generate_key()
-
-                                # generate a path in the store
-                                encrypt_meta_name, encrypt_meta_path = create_file_path_in_store(store_folder)
-
-                                # save metadata to store
-                                saved_rs = self.save_metadata_to_store(encrypt_meta_path,
-                                                                       encrypt_meta_key,
-                                                                       origin_metadata)
-
-                                metadata_in_store_paths.append(encrypt_meta_path)
-
-                                if saved_rs is False:
-                                    raise Exception(f"{prefix_message}Can not save metadata in the store")
-
-                                # save label to store
-                                rs_saved = self.save_image_data_to_store(label, store_folder, prefix_error=prefix_message)
-
-                                encrypted_label_path, encrypted_label_name, encrypted_label_key = rs_saved
-                                print(f"{prefix_message}Saved label in store")
-
-                                # add path to list of path in store,
-                                # when something wrong appears, all files in this list will be removed
-                                file_in_store_paths.append(encrypted_label_path)
+                                # save metadata and label to store, encrypted with new keys under new names
+                                # the records are written in the background, while the next slides are processed
+                                # (when something wrong appears, all written records will be removed)
+                                metadata_job = store_writer.submit(self.save_metadata_to_store, store, origin_metadata,
+                                                                   prefix_error=prefix_message)
+                                label_job = store_writer.submit(self.save_image_data_to_store, label, store,
+                                                                prefix_error=prefix_message)
 
                                 # create database-slide
                                 wsi = model.WSI()
@@ -2203,12 +2341,9 @@ class Pseudonymization:
                                 wsi.pseudo_id = slide.pseudo_id
                                 wsi.pseudo_name = slide.pseudo_name
                                 wsi.pseudo_acquired_at = slide.pseudo_acquired_at
-                                wsi.pseudo_metadata_name = encrypt_meta_name
-                                wsi.pseudo_metadata_key = encrypt_meta_key
-                                wsi.pseudo_label_name = encrypted_label_name
-                                wsi.pseudo_label_key = encrypted_label_key
 
                                 db_wsis.append(wsi)
+                                store_jobs.append((wsi, metadata_job, label_job, prefix_message))
                             elif slide.need_to_be_updated:
                                 db_update_wsis.append(slide)
 
@@ -2222,6 +2357,12 @@ class Pseudonymization:
                 # add patient and its slides
                 patient_slides.append((patient, db_wsis))
 
+            # wait for the store, the names and keys of the records are saved in DB
+            for wsi, metadata_job, label_job, prefix_message in store_jobs:
+                wsi.pseudo_metadata_name, wsi.pseudo_metadata_key = await metadata_job
+                wsi.pseudo_label_name, wsi.pseudo_label_key = await label_job
+                print(f"{prefix_message}Saved label in store")
+
             # create json
             rs_json = self.create_json(InputType.STUDY, self.pseudo_data, self.input_data.basic_json)
 
@@ -2337,25 +2478,30 @@ class Pseudonymization:
                 await session.rollback()
                 raise Exception("Can not save data in DB: ", str(ex))
 
+            # finish pseudo-files (in-place mode: commit the journals)
+            for slide, _ in pseudo_files:
+                self.commit_pseudonym_file(slide)
+
             return rs_json
 
         except Exception as e:
             print(str(e))
             print("Rollback...")
 
-            # remove clones
-            for clone_path in clone_paths:
-                Path(clone_path).unlink()
+            # remove clones (in-place mode: restore the original slides)
+            for slide, pseudo_file_path in pseudo_files:
+                self.remove_pseudonym_file(slide, pseudo_file_path)
 
-            # remove encrypted images in store
-            for file_path in file_in_store_paths:
-                Path(file_path).unlink()
-
-            # remove encrypted metadata in store
-            for metadata_path in metadata_in_store_paths:
-                Path(metadata_path).unlink()
+            # remove encrypted images and metadata in store
+            try:
+                await store_writer.rollback()
+            except Exception as ex:
+                self.error_messages.append(f"Can not remove the records in store: {str(ex)}")
+                print(self.error_messages[-1])
 
             return None
+        finally:
+            store_writer.close()
 
         return None
 
@@ -2375,8 +2521,8 @@ class Pseudonymization:
             return None
 
         # validate store folder path
-        store_folder = self.check_store_path()
-        if store_folder is None:
+        store = self.check_store_path()
+        if store is None:
             return None
 
         # validate destination folder path
@@ -2416,7 +2562,7 @@ class Pseudonymization:
                             # decrypt label to get origin label
                             decrypted_label_data = self.get_image_data_in_store(slide.pseudo_label_key,
                                                                                 slide.pseudo_label_name,
-                                                                                store_folder,
+                                                                                store,
                                                                                 prefix_error=prefix_message)
                             # copy clone
                             origin_file_path = self.copy_clone(slide, dest_folder, prefix_error=prefix_message)
@@ -2427,20 +2573,23 @@ class Pseudonymization:
                             # restore metadata
                             metadata_in_store = self.get_metadata_in_store(slide.pseudo_metadata_key,
                                                                            slide.pseudo_metadata_name,
-                                                                           store_folder,
+                                                                           store,
                                                                            prefix_error=prefix_message)
 
-                            self.back_up_metadata_svs(origin_file_path, metadata_in_store, prefix_error=prefix_message)
+                            # the clone is opened once for both restores (the IFDs of the pseudo-file are reused)
+                            with SlideHandle(origin_file_path, writable=True, tiff=slide.slide_data.slide,
+                                             stats=slide.write_stats) as handle:
+                                self.back_up_metadata_svs(handle, metadata_in_store, prefix_error=prefix_message)
 
-                            try:
-                                # replace pseudonym with origin label
-                                rs = pu.back_up_image_svs(origin_file_path, decrypted_label_data, label.ifd)
+                                try:
+                                    # replace pseudonym with origin label
+                                    rs = pu.back_up_image_svs(handle, decrypted_label_data, label.ifd)
 
-                                if rs is False:  # Replaced label fail
-                                    raise Exception("Something wrong")
-                            except Exception as e:
-                                raise Exception(f"{prefix_message}Can not replace the label of the Slide:"
-                                                f" {str(e)}") from None
+                                    if rs is False:  # Replaced label fail
+                                        raise Exception("Something wrong")
+                                except Exception as e:
+                                    raise Exception(f"{prefix_message}Can not replace the label of the Slide:"
+                                                    f" {str(e)}") from None
 
                         # case Vendor.HAMAMATSU:
                         # case Vendor.MIRAX:
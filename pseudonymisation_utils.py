@@ -7,7 +7,8 @@ import cv2
 import numpy as np
 import math
 import compression_utils as cu
-from tifffile import TiffPage
+from patch_utils import PatchPlan
+from input_handler import TiffIfd, slide_handle
 
 
 class EFieldFont(Enum):
@@ -414,75 +415,84 @@ def create_pseudo_label(img_width, img_height, schema: Schema):
     return img
 
 
-def replace_label_with_pseudonym_svs(wsi_path, pseudo_label, ifd: TiffPage):
-    """ Replace the current label image with another label in an Aperio WSI
-        by deleting all the image data of the current label, then adding the new label's image data
-        at the end of the file (this helps to avoid memory conflicts in the file, but it makes the file size a
-        bit larger compared to the original file).
+def plan_label_replacement_svs(plan: PatchPlan, pseudo_label, ifd: TiffIfd):
+    """ Compute the patches to replace the current label image with another label in an Aperio WSI:
+        all the image data of the current label is wiped, then each strip of the new label is placed into
+        a wiped range, which is large enough (e.g. the place of the old label). Only the strips that do not fit
+        anywhere are added at the end of the file, so the file size stays the same in most cases.
+        Tiled labels (TileOffsets/TileByteCounts) are split into tiles of the same size as the current label.
 
         Parameters:
-            wsi_path:
-                path of SLIDE file
+            plan:
+                patch plan of the SLIDE file, the patches will be added into it
             pseudo_label:
                 image will be replaced with the current label of the slide
             ifd:
                 image file directory of label
     """
-    try:
-        with open(wsi_path, "r+b") as f:
-
-            # get endian order of bytes
-            big_endian = True if f.read(2) == b"MM" else False  # b"II" is litle-endian
-
-            # get compression of current label
-            compression = ifd.compression
-
-            # if the compression is still not supported, uses Adobe deflate instead
-            if compression not in cu.COMPRESSION.values():
-                compression = cu.COMPRESSION.ADOBE_DEFLATE
+    # get compression of current label
+    compression = ifd.compression
+
+    # if the compression is still not supported, uses Adobe deflate instead
+    if compression not in cu.COMPRESSION.values():
+        compression = cu.COMPRESSION.ADOBE_DEFLATE
+
+    # perform compression
+    if ifd.is_tiled:
+        # tiles are stored in TileOffsets/TileByteCounts
+        img_data = cu.compression_image_tiled(pseudo_label, ifd.tilewidth, ifd.tilelength, predictor=ifd.predictor,
+                                              compression=compression)
+        offsets_code, byte_counts_code = 324, 325
+    else:
+        img_data = cu.compression_image(pseudo_label, ifd.rowsperstrip, predictor=ifd.predictor,
+                                        compression=compression)
+        offsets_code, byte_counts_code = 273, 279
 
-            # perform compression
-            img_data = cu.compression_image(pseudo_label, ifd.rowsperstrip, predictor=ifd.predictor,
-                                            compression=compression)
+    """ wipe data of old img """
+    for old_offset, old_count in zip(ifd.dataoffsets, ifd.databytecounts):
+        plan.wipe(old_offset, old_count)
 
-            # Inject the new image to current image data place
+    """ write data of new img """
+    # the values are written with the data types of the tags (SHORT, LONG or LONG8 in BigTIFF)
+    # write compression value
+    if compression.value != ifd.compression:
+        comp = ifd.tags.get(259)
 
-            """ wipe data of old img """
-            old_img_data_byte_count = sum(ifd.databytecounts)
-            old_img_data_first_offset = ifd.dataoffsets[0]
-            f.seek(old_img_data_first_offset)
-            f.write(b'\x00' * old_img_data_byte_count)
-
-            """ write data of new img """
-            # write compression value
-            if compression.value != ifd.compression:
-                comp = ifd.tags.get(259)
-                f.seek(comp.valueoffset)
+        # ADOBE_DEFLATE
+        plan.write(comp.valueoffset, comp.pack_values([compression.value]))
 
-                # ADOBE_DEFLATE
-                f.write(cu.int_to_bytes(compression.value, length=4, is_big_endian=big_endian))
+    # write new strip (tile) byte count
+    new_strip_byte_counts = [strip.count for strip in img_data]
+    strip_byte_counts_tag = ifd.tags.get(byte_counts_code)
+    if len(new_strip_byte_counts) != strip_byte_counts_tag.count:
+        raise Exception("Number of strips of the pseudonym does not match the label")
+    plan.write(strip_byte_counts_tag.valueoffset, strip_byte_counts_tag.pack_values(new_strip_byte_counts))
 
-            # write new strip byte count
-            new_strip_byte_counts = [strip.count for strip in img_data]
-            f.seek(ifd.tags.get(279).valueoffset)
-            for strip_count in new_strip_byte_counts:
-                f.write(cu.int_to_bytes(strip_count, length=4, is_big_endian=big_endian))
+    # write img data into the wiped space (or at the end of the file, if it does not fit)
+    new_strip_offsets = [plan.allocate(bytes(strip_byte.data)) for strip_byte in img_data]
 
-            new_strip_offsets = []      # to save trip offset values
+    # write trip (tile) offsets
+    strip_offsets_tag = ifd.tags.get(offsets_code)
+    plan.write(strip_offsets_tag.valueoffset, strip_offsets_tag.pack_values(new_strip_offsets))
 
-            # write img data
-            f.seek(0, 2)  # go to eof to avoid conflict
-            for idx, strip_byte in enumerate(img_data):
-                new_strip_offsets.append(f.tell())
-                f.write(bytes(strip_byte.data))
 
-            # write trip offsets
-            f.seek(ifd.tags.get(273).valueoffset)
-            for strip_offset in new_strip_offsets:
-                f.write(cu.int_to_bytes(strip_offset, length=4, is_big_endian=big_endian))
+def replace_label_with_pseudonym_svs(wsi_path, pseudo_label, ifd: TiffIfd):
+    """ Replace the current label image with another label in an Aperio WSI
+        (see plan_label_replacement_svs)
 
-            f.flush()
-            f.close()
+        Parameters:
+            wsi_path:
+                path of SLIDE file (or an open, writable SlideHandle)
+            pseudo_label:
+                image will be replaced with the current label of the slide
+            ifd:
+                image file directory of label
+    """
+    try:
+        with slide_handle(wsi_path, writable=True) as handle:
+            plan = PatchPlan.for_file(handle.file)
+            plan_label_replacement_svs(plan, pseudo_label, ifd)
+            handle.apply(plan)
 
     except Exception as e:
         print("Can not replace label with pseudonym:", str(e))
@@ -491,12 +501,12 @@ def replace_label_with_pseudonym_svs(wsi_path, pseudo_label, ifd: TiffPage):
     return True
 
 
-def back_up_image_svs(wsi_path, image_data, ifd: TiffPage):
+def back_up_image_svs(wsi_path, image_data, ifd: TiffIfd):
     """ Replace the pseudonym with original label in an Aperio WSI
 
         Parameters:
             wsi_path:
-                path of SLIDE file
+                path of SLIDE file (or an open, writable SlideHandle)
             image_data:
                 image data is a dict and contains data_byte_counts, data_offsets, compression and image data(bytes)
             ifd:
@@ -510,39 +520,42 @@ def back_up_image_svs(wsi_path, image_data, ifd: TiffPage):
             return False
 
     try:
-        with open(wsi_path, "r+b") as f:
-
-            # get endian order of bytes
-            big_endian = True if f.read(2) == b"MM" else False  # b"II" is litle-endian
+        with slide_handle(wsi_path, writable=True) as handle:
+            plan = PatchPlan.for_file(handle.file)
 
             # Inject the new image to current image data place
 
             """ wipe pseudonym data """
-            old_img_data_byte_count = sum(ifd.databytecounts)
-            old_img_data_first_offset = ifd.dataoffsets[0]
-            f.seek(old_img_data_first_offset)
-            f.write(b'\x00' * old_img_data_byte_count)
+            # the strips of the pseudonym are not always contiguous (see plan_label_replacement_svs)
+            for old_offset, old_count in zip(ifd.dataoffsets, ifd.databytecounts):
+                plan.wipe(old_offset, old_count)
 
             """ write data of origin img """
+            # the values are written with the data types of the tags (SHORT, LONG or LONG8 in BigTIFF)
             # write compression value
             comp = ifd.tags.get(259)
-            f.seek(comp.valueoffset)
-            f.write(cu.int_to_bytes(image_data["compression"], length=4, is_big_endian=big_endian))
-
-            # write new strip byte count
-            f.seek(ifd.tags.get(279).valueoffset)
-            for strip_count in image_data["data_byte_counts"]:
-                f.write(cu.int_to_bytes(strip_count, length=4, is_big_endian=big_endian))
-
-            # write trip offsets
-            f.seek(ifd.tags.get(273).valueoffset)
-            for strip_offset in image_data["data_offsets"]:
-                f.write(cu.int_to_bytes(strip_offset, length=4, is_big_endian=big_endian))
-
-            # write img data
-            f.seek(image_data["data_offsets"][0])
-            f.write(image_data["data"])
-            f.flush()
+            plan.write(comp.valueoffset, comp.pack_values([int(image_data["compression"])]))
+
+            # write new strip (tile) byte count
+            offsets_code, byte_counts_code = (324, 325) if ifd.is_tiled else (273, 279)
+            strip_byte_counts_tag = ifd.tags.get(byte_counts_code)
+            if len(image_data["data_byte_counts"]) != strip_byte_counts_tag.count:
+                raise Exception("Number of strips of the label does not match the pseudonym")
+            plan.write(strip_byte_counts_tag.valueoffset,
+                       strip_byte_counts_tag.pack_values(image_data["data_byte_counts"]))
+
+            # write trip (tile) offsets
+            strip_offsets_tag = ifd.tags.get(offsets_code)
+            plan.write(strip_offsets_tag.valueoffset, strip_offsets_tag.pack_values(image_data["data_offsets"]))
+
+            # write img data, each strip at its original offset
+            data = memoryview(image_data["data"])
+            position = 0
+            for strip_offset, strip_count in zip(image_data["data_offsets"], image_data["data_byte_counts"]):
+                plan.write(strip_offset, bytes(data[position:position + strip_count]))
+                position += strip_count
+
+            handle.apply(plan)
 
     except Exception as e:
         print("Can not replace label with pseudonym:", str(e))
@@ -0,0 +1,416 @@
+import argparse
+import asyncio
+import json
+import os
+import platform
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import db.db as db
+import db.model as model
+import store_utils as su
+from pseudonymisation import STORE_PATH, STORE_BACKEND, STORE_DEDUP_SECRET, STORE_S3_ENDPOINT, STORE_INDEX_PATH, \
+    create_name_in_store
+
+# Windows has a problem with EventLoopPolicy
+# It can make an async function "Asyncio Event Loop is Closed" when getting loop
+if platform.system() == 'Windows':
+    asyncio.set_event_loop_policy(asyncio.WindowsSelectorEventLoopPolicy())
+
+PROGRESS_INTERVAL = 5  # seconds between the progress messages
+ROTATION_CHECKPOINT = "data/key_rotation.json"  # progress of the key rotation, to resume it
+ROTATED_COLUMNS = [("pseudo_label_name", "pseudo_label_key"),
+                   ("pseudo_macro_name", "pseudo_macro_key"),
+                   ("pseudo_metadata_name", "pseudo_metadata_key")]
+
+worker_store = None  # store of a worker of the key rotation
+
+
+class RateLimiter:
+    """
+        Spread the records evenly over time, so the store is not overloaded
+        (e.g. the key rotation runs next to the pseudonymisation, the appends to a packfile store
+        are locked across the processes, see PackStore)
+
+        :parameter
+            rate: records per second, 0: no limit
+    """
+
+    def __init__(self, rate=0):
+        self.interval = 1 / rate if rate > 0 else 0
+        self.next = time.monotonic()
+
+    async def wait(self):
+        if self.interval == 0:
+            return
+        # the slot is taken before sleeping, so concurrent callers get consecutive slots
+        now = time.monotonic()
+        slot = max(self.next, now)
+        self.next = slot + self.interval
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+
+async def get_live_names():
+    """ Get the names of all records in the store, which are used in DB
+        :return
+            Counter of names and number of slides, which use them
+    """
+    async with model.Session() as session:
+        return await db.WSIDAO(session).get_store_names()
+
+
+async def get_references():
+    """ Get the name and the key of all records in the store, which are used in DB (read with a server-side cursor)
+        :return
+            dict of name and key
+    """
+    references = {}
+    async with model.Session() as session:
+        async for name, key in db.WSIDAO(session).stream_store_records():
+            references.setdefault(name, key)
+    return references
+
+
+def migrate(store_folder, max_workers=su.MIGRATION_WORKERS):
+    """ Move the files of a flat store into the sharded layout
+        the names of the files stay the same, so nothing is changed in DB
+
+        :parameter:
+            store_folder:
+                path of the store
+            max_workers:
+                number of threads
+        :return
+            True: all files were moved
+    """
+    print(f"Migrate store {store_folder}")
+    moved, errors = su.migrate_flat_store(store_folder, max_workers=max_workers)
+
+    for name, error in errors:
+        print(f"Can not move {name}: {error}")
+    print(f"Moved {moved} files, {len(errors)} failed")
+
+    return len(errors) == 0
+
+
+def compact(store_folder, ratio=su.PACK_COMPACTION_RATIO):
+    """ Reclaim the space of the records in a packfile store, whose slides were deleted from DB
+
+        :parameter:
+            store_folder:
+                path of the store
+            ratio:
+                a segment is compacted, when less than this part of it is still used
+        :return
+            True: successful
+    """
+    live_names = asyncio.run(get_live_names())
+    print(f"Compact store {store_folder} ({len(live_names)} records are used in DB)")
+
+    store = su.PackStore(store_folder)
+    try:
+        removed, reclaimed = store.compact(live_names, ratio=ratio)
+    finally:
+        store.close()
+    print(f"Removed {removed} segments, reclaimed {reclaimed} bytes")
+
+    return True
+
+
+def gc(store_folder, backend=STORE_BACKEND, secret=STORE_DEDUP_SECRET):
+    """ Delete the deduplicated records, which are not used by any slide in DB anymore,
+        and correct the reference counts of the others
+
+        :parameter:
+            store_folder:
+                path of the store
+            backend:
+                StoreBackend of the store
+            secret:
+                secret of the deduplication
+        :return
+            True: successful
+    """
+    if secret is None:
+        print("Store is not deduplicated (WSI_STORE_DEDUP_SECRET is not set)")
+        return False
+
+    references = asyncio.run(get_live_names())
+    print(f"Collect garbage in store {store_folder} ({len(references)} records are used in DB)")
+
+    store = su.open_store(store_folder, backend, dedup_secret=secret, endpoint_url=STORE_S3_ENDPOINT,
+                          index_folder=STORE_INDEX_PATH)
+    try:
+        deleted = store.gc(references)
+    finally:
+        store.close()
+    print(f"Deleted {deleted} records")
+
+    return True
+
+
+def scrub(store_folder, backend=STORE_BACKEND, verify=False, delete_orphans=False, max_workers=su.SCRUB_WORKERS,
+          grace=su.PACK_COMPACTION_GRACE):
+    """ Check the store against DB: records, which are not used in DB (orphans, e.g. left by a crashed run),
+        and records used in DB, which are missing in the store
+
+        :parameter:
+            store_folder:
+                path of the store
+            backend:
+                StoreBackend of the store
+            verify:
+                decrypt every used record with its key
+            delete_orphans:
+                delete the orphans, which are older than "grace" seconds (newer ones can belong to a running job)
+            max_workers:
+                number of threads to decrypt the records
+        :return
+            True: no missing or corrupted records
+    """
+    references = asyncio.run(get_references())
+    print(f"Scrub store {store_folder} ({len(references)} records are used in DB)")
+
+    last_progress = time.monotonic()
+
+    def progress(report):
+        nonlocal last_progress
+        if time.monotonic() - last_progress >= PROGRESS_INTERVAL:
+            last_progress = time.monotonic()
+            print(report)
+
+    store = su.open_store(store_folder, backend, endpoint_url=STORE_S3_ENDPOINT)
+    try:
+        report = su.scrub_store(store, references, verify=verify, max_workers=max_workers, progress=progress)
+
+        for name in report.orphans:
+            print(f"Orphan: {name}")
+        for name in report.missing:
+            print(f"Missing: {name}")
+        for name, error in report.corrupted:
+            print(f"Corrupted: {name}: {error}")
+        print(report)
+
+        if delete_orphans:
+            deleted = 0
+            for name in report.orphans:
+                if store.created(name) < time.time() - grace:
+                    store.delete(name)
+                    deleted += 1
+            print(f"Deleted {deleted} orphans")
+    finally:
+        store.close()
+
+    return len(report.missing) == 0 and len(report.corrupted) == 0
+
+
+def open_worker_store(store_folder, backend):
+    """ Open the store in a worker process of the key rotation (the new records are not deduplicated) """
+    global worker_store
+    worker_store = su.open_store(store_folder, backend, endpoint_url=STORE_S3_ENDPOINT)
+
+
+def rotate_record(name, key):
+    """ Re-encrypt a record with a new key under a new name (in a worker)
+        :return
+            name, new name, new key, error
+    """
+    new_name = None
+    new_key = su.generate_key()
+    try:
+        new_name = create_name_in_store(worker_store)
+        su.reencrypt_record(worker_store, name, key, new_name, new_key)
+    except Exception as e:
+        if new_name is not None:
+            worker_store.delete(new_name)
+        return name, None, None, str(e)
+    return name, new_name, new_key, None
+
+
+def read_checkpoint(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {"last_id": "", "rotated": 0, "failed": 0}
+
+
+def write_checkpoint(path, checkpoint):
+    """ Replace the checkpoint atomically, so it is complete after a crash """
+    temp_path = f"{path}.tmp"
+    with open(temp_path, "w") as f:
+        json.dump(checkpoint, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_path, path)
+
+
+async def rotate_keys(store_folder, backend=STORE_BACKEND, checkpoint_path=ROTATION_CHECKPOINT,
+                      max_workers=su.ROTATION_WORKERS, batch_size=su.ROTATION_BATCH_SIZE, rate=0):
+    """ Rotate the keys of all records in the store: every record is re-encrypted with a new key under a new name
+        in a pool of processes, then the names and keys of a batch of slides are replaced in one DB transaction,
+        and the old records are deleted. A crash leaves at most orphans (see scrub), never a record without its key.
+        The slides are walked in the order of their ids, the last finished batch is saved in a checkpoint,
+        a rotation started again continues after it.
+
+        :parameter:
+            store_folder:
+                path of the store
+            backend:
+                StoreBackend of the store
+            checkpoint_path:
+                file of the checkpoint
+            max_workers:
+                number of processes
+            batch_size:
+                slides per batch (DB transaction)
+            rate:
+                maximum records per second, 0: no limit
+        :return
+            True: all records were rotated
+    """
+    global worker_store
+
+    checkpoint = read_checkpoint(checkpoint_path)
+    print(f"Rotate keys of store {store_folder}, after slide '{checkpoint['last_id']}'")
+
+    # the old records are released, a deduplicated record is deleted when its last slide is rotated
+    store = su.open_store(store_folder, backend, dedup_secret=STORE_DEDUP_SECRET, endpoint_url=STORE_S3_ENDPOINT,
+                          index_folder=STORE_INDEX_PATH)
+    if isinstance(store, su.PackStore):
+        # the threads share the store and its index, the appends are locked against
+        # other processes using the store (e.g. a running pseudonymisation)
+        worker_store = store
+        executor = ThreadPoolExecutor(max_workers=max_workers)
+    else:
+        executor = ProcessPoolExecutor(max_workers=max_workers, initializer=open_worker_store,
+                                       initargs=(store_folder, backend))
+
+    loop = asyncio.get_running_loop()
+    limiter = RateLimiter(rate)
+    started = time.monotonic()
+
+    async def rotate(name, key):
+        await limiter.wait()
+        try:
+            return await loop.run_in_executor(executor, rotate_record, name, key)
+        except Exception as e:
+            # e.g. a worker process died, the other records of the batch are still discarded or replaced
+            return name, None, None, str(e)
+
+    try:
+        while True:
+            async with model.Session() as session:
+                slides = await db.WSIDAO(session).get_batch_after(checkpoint["last_id"], batch_size)
+            if len(slides) == 0:
+                break
+
+            # re-encrypt the records of the batch
+            jobs = [(slide, name_column, key_column) for slide in slides for name_column, key_column in ROTATED_COLUMNS
+                    if getattr(slide, name_column) is not None]
+            results = await asyncio.gather(*[rotate(getattr(slide, name_column), getattr(slide, key_column))
+                                             for slide, name_column, key_column in jobs])
+
+            changes = {}  # slide id -> old values, new values, new names, errors
+            for (slide, name_column, key_column), (name, new_name, new_key, error) in zip(jobs, results):
+                old_values, new_values, new_names, errors = changes.setdefault(slide.id, ({}, {}, [], []))
+                old_values[name_column] = name
+                new_values[name_column] = new_name
+                new_values[key_column] = new_key
+                if error is None:
+                    new_names.append(new_name)
+                else:
+                    errors.append(f"{name}: {error}")
+
+            # replace the names and keys of the batch in one transaction
+            replaced = []
+            discarded = []
+            async with model.Session() as session:
+                async with session.begin():
+                    wsiDAO = db.WSIDAO(session, auto_commit=False)
+                    for slide_id, (old_values, new_values, new_names, errors) in changes.items():
+                        if len(errors) == 0 and await wsiDAO.replace_store_records(slide_id, old_values, new_values):
+                            replaced += old_values.values()
+                            checkpoint["rotated"] += len(old_values)
+                        else:
+                            # a record could not be re-encrypted, or the slide was changed in the meantime
+                            for error in errors:
+                                print(f"Slide[id = {slide_id}]: can not rotate {error}")
+                            if len(errors) == 0:
+                                print(f"Slide[id = {slide_id}]: was changed during the rotation, it is not rotated")
+                            discarded += new_names
+                            checkpoint["failed"] += len(old_values)
+
+            # the old records are not used anymore
+            for name in replaced:
+                store.release(name)
+            for name in discarded:
+                store.delete(name)
+
+            checkpoint["last_id"] = slides[-1].id
+            write_checkpoint(checkpoint_path, checkpoint)
+
+            elapsed = time.monotonic() - started
+            print(f"{checkpoint['rotated']} records rotated, {checkpoint['failed']} failed, "
+                  f"last slide '{checkpoint['last_id']}' ({len(results) / max(elapsed, 1e-9):.0f} records/s)")
+            started = time.monotonic()
+    finally:
+        executor.shutdown(wait=True)
+        store.close()
+        worker_store = None
+
+    print(f"Finished: {checkpoint['rotated']} records rotated, {checkpoint['failed']} failed")
+    return checkpoint["failed"] == 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Maintenance of the store of the pseudonymisation")
+    parser.add_argument("--store", default=STORE_PATH, help="path of the store")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    migrate_parser = commands.add_parser("migrate", help="move a flat store into the sharded layout")
+    migrate_parser.add_argument("--workers", type=int, default=su.MIGRATION_WORKERS, help="number of threads")
+
+    compact_parser = commands.add_parser("compact", help="reclaim the space of deleted records of a packfile store")
+    compact_parser.add_argument("--ratio", type=float, default=su.PACK_COMPACTION_RATIO,
+                                help="a segment is compacted, when less than this part of it is used")
+
+    gc_parser = commands.add_parser("gc", help="delete deduplicated records, which are not used in DB anymore")
+    gc_parser.add_argument("--backend", default=STORE_BACKEND.value, choices=[b.value for b in su.StoreBackend],
+                           help="backend of the store")
+
+    scrub_parser = commands.add_parser("scrub", help="find orphaned and missing records, verify the records")
+    scrub_parser.add_argument("--backend", default=STORE_BACKEND.value, choices=[b.value for b in su.StoreBackend],
+                              help="backend of the store")
+    scrub_parser.add_argument("--verify", action="store_true", help="decrypt every record used in DB with its key")
+    scrub_parser.add_argument("--delete-orphans", action="store_true",
+                              help="delete the orphans, which are older than 24 hours")
+    scrub_parser.add_argument("--workers", type=int, default=su.SCRUB_WORKERS, help="number of threads")
+
+    rotate_parser = commands.add_parser("rotate-keys", help="re-encrypt all records with new keys")
+    rotate_parser.add_argument("--backend", default=STORE_BACKEND.value, choices=[b.value for b in su.StoreBackend],
+                               help="backend of the store")
+    rotate_parser.add_argument("--checkpoint", default=ROTATION_CHECKPOINT,
+                               help="file of the checkpoint, a rotation started again continues after it")
+    rotate_parser.add_argument("--workers", type=int, default=su.ROTATION_WORKERS, help="number of processes")
+    rotate_parser.add_argument("--batch-size", type=int, default=su.ROTATION_BATCH_SIZE,
+                               help="slides updated in one DB transaction")
+    rotate_parser.add_argument("--rate", type=float, default=0, help="maximum records per second, 0: no limit")
+
+    args = parser.parse_args()
+
+    match args.command:
+        case "migrate":
+            raise SystemExit(0 if migrate(args.store, max_workers=args.workers) else 1)
+        case "compact":
+            raise SystemExit(0 if compact(args.store, ratio=args.ratio) else 1)
+        case "gc":
+            raise SystemExit(0 if gc(args.store, backend=args.backend) else 1)
+        case "scrub":
+            raise SystemExit(0 if scrub(args.store, backend=args.backend, verify=args.verify,
+                                        delete_orphans=args.delete_orphans, max_workers=args.workers) else 1)
+        case "rotate-keys":
+            raise SystemExit(0 if asyncio.run(rotate_keys(args.store, backend=args.backend,
+                                                          checkpoint_path=args.checkpoint, max_workers=args.workers,
+                                                          batch_size=args.batch_size, rate=args.rate)) else 1)
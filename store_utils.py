@@ -0,0 +1,1686 @@
+import asyncio
+import base64
+import hashlib
+import hmac
+import io
+import json
+import os
+import shutil
+import sqlite3
+import struct
+import tempfile
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from enum import Enum, IntEnum
+from pathlib import Path
+from urllib.parse import urlparse
+
+import numpy as np
+
+from cryptography.exceptions import InvalidTag
+from cryptography.fernet import Fernet, InvalidToken
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+
+import compression_utils as cu
+import file_utils as fu
+
+try:
+    import boto3
+    from botocore.config import Config as BotoConfig
+    from botocore.exceptions import ClientError
+except ImportError:  # only needed for the S3 backend
+    boto3 = None
+
+RECORD_MAGIC = b"WSIREC"
+RECORD_VERSION = 1  # version of the binary record format
+RECORD_HEADER = struct.Struct("<6sBBIQ")  # magic, version, kind, length of metadata block, length of payload
+IMAGE_INFO = struct.Struct("<HI")  # compression, number of strips (tiles)
+
+STREAM_MAGIC = b"WSIAEAD"
+STREAM_VERSION = 2  # version of the encrypted stream format
+STREAM_NONCE_PREFIX = 8  # random part of the nonce of a chunk, the last 4 bytes are the index of the chunk
+STREAM_HEADERS = {
+    1: struct.Struct(f"<7sBI{STREAM_NONCE_PREFIX}s"),  # magic, version, chunk size, nonce prefix
+    2: struct.Struct(f"<7sBI{STREAM_NONCE_PREFIX}sB"),  # ..., codec of the plaintext (StoreCodec)
+}
+STREAM_HEADER = STREAM_HEADERS[STREAM_VERSION]
+STREAM_CHUNK_SIZE = 1024 * 1024  # size of the plaintext of a chunk
+STREAM_TAG_SIZE = 16  # authentication tag of AES-GCM
+STREAM_MAX_CHUNKS = 2 ** 32
+CHUNK_INDEX = struct.Struct(">I")
+CHUNK_AAD = struct.Struct("<I?")  # index of the chunk, last chunk
+PROBE_SIZE = 64 * 1024  # bytes sampled by the entropy probe
+PROBE_SLICES = 16  # the sample is taken from slices spread over the payload
+PROBE_MIN_SIZE = 256  # smaller payloads are not compressed
+PROBE_MAX_ENTROPY = 7.0  # bits per byte, above it (e.g. LZW/deflate strips) compression gains too little
+DEFLATE_LEVEL = 6
+STORE_FANOUT_LEVELS = 2  # levels of directories of the store, each level has 256 directories (00 - ff)
+MIGRATION_WORKERS = min(32, 4 * (os.cpu_count() or 1))  # threads to move the files of a flat store
+MIGRATION_BATCH_SIZE = 10000  # files submitted to the threads at once (the store can have millions of files)
+SCRUB_WORKERS = min(32, 4 * (os.cpu_count() or 1))  # threads to decrypt the records, when the store is verified
+SCRUB_BATCH_SIZE = 1000  # records submitted to the threads at once
+ROTATION_WORKERS = os.cpu_count() or 1  # processes to re-encrypt the records, when the keys are rotated
+ROTATION_BATCH_SIZE = 500  # slides read from DB and updated in one transaction
+PACK_SEGMENT_SIZE = 1024 * 1024 * 1024  # a new segment is started, when the active segment is larger
+PACK_SEGMENT_SUFFIX = ".pack"
+PACK_INDEX_NAME = "pack_index.sqlite"  # index of the packfile store, in the folder of the store
+PACK_LOCK_NAME = "pack.lock"  # lock of the appends to the segments, shared by the processes using the store
+PACK_COMPACTION_RATIO = 0.5  # a segment is compacted, when less than this part of it is still used
+PACK_COMPACTION_GRACE = 24 * 60 * 60  # seconds, newer records are kept even if they are not in DB (yet)
+PACK_SPOOL_SIZE = 64 * 1024 * 1024  # a record is spooled in memory before it is appended, a larger one in a temp file
+DEDUP_INDEX_NAME = "dedup_index.sqlite"  # index of the deduplicated records, in the folder of the store
+RECORD_CACHE_SIZE = 256 * 1024 * 1024  # bytes of decrypted records kept in memory, 0: no cache
+STORE_WRITERS = min(8, os.cpu_count() or 1)  # threads to encrypt and write the records of the slides of a case/study
+S3_PART_SIZE = 8 * 1024 * 1024  # larger records are uploaded in parts of this size (multipart upload, min. 5 MiB)
+S3_READ_SIZE = 8 * 1024 * 1024  # bytes fetched by a ranged GET
+S3_MAX_CONNECTIONS = 32  # pooled HTTP connections of a store, shared by the threads
+S3_MAX_ATTEMPTS = 5  # attempts of a request (throttling, connection errors)
+
+
+class StoreBackend(Enum):
+    """
+        How the records of the store are saved
+    """
+    FILES = "files"  # one file per record, in directories derived from its name (FileStore)
+    PACK = "pack"  # records are appended to large segment files, with an index (PackStore)
+    S3 = "s3"  # one object per record in an S3-compatible object store (S3Store)
+
+
+class StoreCodec(IntEnum):
+    """
+        Compression of the plaintext of a stream, it is applied before the encryption
+    """
+    NONE = 0
+    DEFLATE = 1
+
+
+class RecordKind(IntEnum):
+    """
+        Kind of the data in a record of the store
+    """
+    IMAGE = 1  # data of an associated image (strips/tiles) with its offsets, byte counts and compression
+
+
+def write_image_record(f, data_offsets, data_byte_counts, compression, data):
+    """
+        Write the data of an associated image as a binary record:
+        fixed header | metadata block (compression, number of strips, offsets, byte counts) | raw data of the strips
+        :param f: file object (binary), e.g. StreamWriter
+        :param data_offsets: offsets of the strips (tiles) in the slide
+        :param data_byte_counts: byte counts of the strips (tiles)
+        :param compression: value of the compression tag
+        :param data: data of all strips (bytes-like), in the order of the strips
+    """
+    if len(data_offsets) != len(data_byte_counts):
+        raise Exception("Number of strip offsets and byte counts does not match")
+
+    metadata = b"".join([IMAGE_INFO.pack(int(compression), len(data_offsets)),
+                         cu.ints_to_bytes(data_offsets, 16, is_big_endian=False),
+                         cu.ints_to_bytes(data_byte_counts, 16, is_big_endian=False)])
+    data = memoryview(data).cast("B")
+
+    f.write(RECORD_HEADER.pack(RECORD_MAGIC, RECORD_VERSION, RecordKind.IMAGE, len(metadata), len(data)))
+    f.write(metadata)
+    f.write(data)
+
+
+def read_image_record(f) -> dict:
+    """
+        Read a record of an associated image (see write_image_record), the payload is read into one buffer
+        :param f: file object (binary), e.g. StreamReader
+        :return: dict of data_offsets, data_byte_counts, compression and data (bytearray)
+    """
+    header = read_exactly(f, min(RECORD_HEADER.size, len(RECORD_MAGIC)))
+    if header != RECORD_MAGIC:
+        # legacy JSON record
+        return unpack_image_record(header + f.read())
+
+    header += read_exactly(f, RECORD_HEADER.size - len(header))
+    magic, version, kind, metadata_length, data_length = RECORD_HEADER.unpack(header)
+    _check_record(version, kind)
+
+    compression, count = IMAGE_INFO.unpack(read_exactly(f, IMAGE_INFO.size))
+    if metadata_length != IMAGE_INFO.size + 16 * count:
+        raise Exception("Metadata block of the record is invalid")
+    tables = read_exactly(f, 16 * count)
+
+    return {
+        "data_offsets": cu.ints_from_bytes(tables[:8 * count], 16, is_big_endian=False),
+        "data_byte_counts": cu.ints_from_bytes(tables[8 * count:], 16, is_big_endian=False),
+        "compression": compression,
+        "data": read_exactly(f, data_length),
+    }
+
+
+def unpack_image_record(record) -> dict:
+    """
+        Decode a record of an associated image, the legacy JSON records are still supported
+        :param record: decrypted record (bytes)
+        :return: dict of data_offsets, data_byte_counts, compression and data (bytes-like, not copied)
+    """
+    if not is_binary_record(record):
+        # legacy: {"data_byte_counts": [...], "data_offsets": [...], "compression": int, "data": [int, ...]}
+        image_data = json.loads(bytes(record).decode("utf-8"))
+        image_data["data"] = bytes(image_data["data"])
+        return image_data
+
+    view = memoryview(record)
+    magic, version, kind, metadata_length, data_length = RECORD_HEADER.unpack_from(view)
+    _check_record(version, kind)
+    if len(view) != RECORD_HEADER.size + metadata_length + data_length:
+        raise Exception("Record is truncated")
+
+    metadata = view[RECORD_HEADER.size:RECORD_HEADER.size + metadata_length]
+    compression, count = IMAGE_INFO.unpack_from(metadata)
+    tables = metadata[IMAGE_INFO.size:]
+    if len(tables) != 16 * count:
+        raise Exception("Metadata block of the record is invalid")
+
+    return {
+        "data_offsets": cu.ints_from_bytes(tables[:8 * count], 16, is_big_endian=False),
+        "data_byte_counts": cu.ints_from_bytes(tables[8 * count:], 16, is_big_endian=False),
+        "compression": compression,
+        "data": view[RECORD_HEADER.size + metadata_length:],
+    }
+
+
+def is_binary_record(record):
+    """
+        check whether a decrypted record has the binary format (otherwise it is a legacy JSON record)
+    """
+    return len(record) >= RECORD_HEADER.size and bytes(record[:len(RECORD_MAGIC)]) == RECORD_MAGIC
+
+
+def _check_record(version, kind):
+    if version > RECORD_VERSION:
+        raise Exception(f"Version of the record is not supported: {version}")
+    if kind != RecordKind.IMAGE:
+        raise Exception(f"Record does not contain an image (kind {kind})")
+
+
+def read_exactly(f, length):
+    """
+        read exactly "length" bytes from a file object (raw file objects can return less bytes)
+        :return: bytearray
+    """
+    buffer = bytearray(length)
+    view = memoryview(buffer)
+    position = 0
+    while position < length:
+        read = f.readinto(view[position:])
+        if not read:
+            raise Exception("Record is truncated")
+        position += read
+
+    return buffer
+
+
+def read_all(f) -> bytearray:
+    """
+        read a file object until its end into a bytearray (unlike read(), the plaintext can be wiped later)
+    """
+    buffer = bytearray()
+    chunk = bytearray(STREAM_CHUNK_SIZE)
+    view = memoryview(chunk)
+    while True:
+        read = f.readinto(view)
+        if not read:
+            break
+        buffer += view[:read]
+    view[:] = bytes(len(chunk))
+
+    return buffer
+
+
+def generate_key() -> bytes:
+    """
+        generate a random key of the store (256 bits, URL-safe base64 like the Fernet keys)
+    """
+    return base64.urlsafe_b64encode(os.urandom(32))
+
+
+def _aead(key):
+    raw_key = base64.urlsafe_b64decode(key)
+    if len(raw_key) != 32:
+        raise Exception("Key is invalid")
+    return AESGCM(raw_key)
+
+
+def is_encrypted_stream(f):
+    """
+        check whether a file of the store is an encrypted stream (otherwise it is a legacy Fernet token),
+        the position of the file is not changed
+        :param f: file object (binary, seekable)
+    """
+    position = f.tell()
+    magic = f.read(len(STREAM_MAGIC))
+    f.seek(position)
+    return magic == STREAM_MAGIC
+
+
+def choose_codec(data) -> StoreCodec:
+    """
+        pick the compression of a payload by a fast entropy probe of a sample of the payload,
+        data with a high entropy (e.g. compressed strips) is not compressed again
+        :param data: bytes-like
+        :return: StoreCodec
+    """
+    view = memoryview(data).cast("B")
+    if len(view) < PROBE_MIN_SIZE:
+        return StoreCodec.NONE
+
+    if len(view) <= PROBE_SIZE:
+        sample = np.frombuffer(view, dtype=np.uint8)
+    else:
+        slice_size = PROBE_SIZE // PROBE_SLICES
+        step = (len(view) - slice_size) // (PROBE_SLICES - 1)
+        sample = np.concatenate([np.frombuffer(view[i * step:i * step + slice_size], dtype=np.uint8)
+                                 for i in range(PROBE_SLICES)])
+
+    counts = np.bincount(sample, minlength=256)
+    probabilities = counts[counts > 0] / len(sample)
+    entropy = -float(np.sum(probabilities * np.log2(probabilities)))
+
+    return StoreCodec.DEFLATE if entropy <= PROBE_MAX_ENTROPY else StoreCodec.NONE
+
+
+class StreamWriter(io.RawIOBase):
+    """
+        Encrypt data for the store in chunks with AES-GCM, so the memory does not depend on the size of the data.
+        The data can be compressed before the encryption (compress-then-encrypt).
+        Stream: header (magic, version, chunk size, nonce prefix, codec) | chunks (ciphertext + tag)
+        Every chunk has its own nonce (nonce prefix + index of the chunk), its index and a "last chunk" flag
+        are authenticated together with the header, so reordered, dropped or truncated chunks are detected.
+        The stream is only complete when it is finished (at the end of "with" without an error).
+
+        :parameter
+            f: file object (binary), it is not closed here
+            key: key of the store (see generate_key)
+            chunk_size: size of the plaintext of a chunk
+            codec: compression of the data (StoreCodec), see choose_codec
+    """
+
+    def __init__(self, f, key, chunk_size=STREAM_CHUNK_SIZE, codec=StoreCodec.NONE):
+        super().__init__()
+        self.file = f
+        self.aead = _aead(key)
+        self.chunk_size = chunk_size
+        self.codec = StoreCodec(codec)
+        self.compressor = zlib.compressobj(DEFLATE_LEVEL) if self.codec is StoreCodec.DEFLATE else None
+        self.nonce_prefix = os.urandom(STREAM_NONCE_PREFIX)
+        self.header = STREAM_HEADER.pack(STREAM_MAGIC, STREAM_VERSION, chunk_size, self.nonce_prefix, self.codec)
+        self.buffer = bytearray()
+        self.index = 0
+        self.finished = False
+        self.file.write(self.header)
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.finish()
+        self.close()
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        view = memoryview(data).cast("B")
+        written = len(view)
+        if self.compressor is not None:
+            view = memoryview(self.compressor.compress(view))
+
+        self._append(view)
+        return written
+
+    def _append(self, view):
+        while len(view) > 0:
+            # a full chunk is only encrypted when more data follows, the last chunk is encrypted by finish
+            if len(self.buffer) == self.chunk_size:
+                self._write_chunk(last=False)
+
+            size = min(self.chunk_size - len(self.buffer), len(view))
+            self.buffer += view[:size]
+            view = view[size:]
+
+    def finish(self):
+        """
+            encrypt the last chunk (it can be empty)
+        """
+        if not self.finished:
+            if self.compressor is not None:
+                self._append(memoryview(self.compressor.flush()))
+            self._write_chunk(last=True)
+            self.file.flush()
+            self.finished = True
+
+    def _write_chunk(self, last):
+        if self.index >= STREAM_MAX_CHUNKS:
+            raise Exception("Stream is too large")
+
+        nonce = self.nonce_prefix + CHUNK_INDEX.pack(self.index)
+        self.file.write(self.aead.encrypt(nonce, bytes(self.buffer), self.header + CHUNK_AAD.pack(self.index, last)))
+        self.buffer.clear()
+        self.index += 1
+
+
+class StreamReader(io.RawIOBase):
+    """
+        Decrypt a stream of the store (see StreamWriter) chunk by chunk
+
+        :parameter
+            f: file object (binary), it is not closed here
+            key: key of the store
+    """
+
+    def __init__(self, f, key):
+        super().__init__()
+        self.file = f
+        self.aead = _aead(key)
+        self.header = f.read(len(STREAM_MAGIC) + 1)
+        if len(self.header) != len(STREAM_MAGIC) + 1 or self.header[:len(STREAM_MAGIC)] != STREAM_MAGIC:
+            raise Exception("File is not an encrypted stream")
+
+        version = self.header[-1]
+        if version not in STREAM_HEADERS:
+            raise Exception(f"Version of the stream is not supported: {version}")
+
+        header_struct = STREAM_HEADERS[version]
+        self.header += f.read(header_struct.size - len(self.header))
+        if len(self.header) != header_struct.size:
+            raise Exception("Stream is truncated")
+
+        magic, version, self.chunk_size, self.nonce_prefix, *codec = header_struct.unpack(self.header)
+        self.codec = StoreCodec(codec[0]) if codec else StoreCodec.NONE
+        self.decompressor = zlib.decompressobj() if self.codec is StoreCodec.DEFLATE else None
+
+        self.index = 0
+        self.plaintext = memoryview(b"")
+        self.compressed = b""  # decrypted data, which is not decompressed yet
+        self.last = False
+        self.next_chunk = self.file.read(self.chunk_size + STREAM_TAG_SIZE)  # read ahead to find the last chunk
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while len(self.plaintext) == 0:
+            if len(self.compressed) > 0:
+                # the output is limited to a chunk, so a highly compressed chunk does not need much memory
+                self.plaintext = memoryview(self.decompressor.decompress(self.compressed, self.chunk_size))
+                self.compressed = self.decompressor.unconsumed_tail
+            elif not self.last:
+                data = self._read_chunk()
+                if self.decompressor is None:
+                    self.plaintext = memoryview(data)
+                else:
+                    self.compressed = data
+            elif self.decompressor is not None and not self.decompressor.eof:
+                # output, which is still buffered in the decompressor
+                self.plaintext = memoryview(self.decompressor.flush())
+                if not self.decompressor.eof:
+                    raise Exception("Compressed data of the stream is incomplete")
+            else:
+                break
+
+        size = min(len(buffer), len(self.plaintext))
+        memoryview(buffer).cast("B")[:size] = self.plaintext[:size]
+        self.plaintext = self.plaintext[size:]
+        return size
+
+    def _read_chunk(self):
+        chunk = self.next_chunk
+        if len(chunk) < STREAM_TAG_SIZE:
+            raise Exception("Stream is truncated")
+
+        self.next_chunk = self.file.read(self.chunk_size + STREAM_TAG_SIZE)
+        self.last = len(self.next_chunk) == 0
+
+        nonce = self.nonce_prefix + CHUNK_INDEX.pack(self.index)
+        try:
+            data = self.aead.decrypt(nonce, chunk, self.header + CHUNK_AAD.pack(self.index, self.last))
+        except InvalidTag:
+            raise Exception("Key is invalid or the stream is corrupted") from None
+
+        self.index += 1
+        return data
+
+
+def shard_of(name):
+    """
+        directories of a file of the store, derived from a hash of its name
+        (the names are random, but the hash also spreads names with a common prefix or suffix)
+        :param name: name of the file in the store
+        :return: list of hex-prefix directories, e.g. ["3f", "a0"]
+    """
+    digest = hashlib.blake2b(name.encode("utf-8"), digest_size=STORE_FANOUT_LEVELS).hexdigest()
+    return [digest[2 * level:2 * level + 2] for level in range(STORE_FANOUT_LEVELS)]
+
+
+def store_file_path(store_folder, name) -> Path:
+    """
+        path of a file in the sharded store: <store>/<xx>/<yy>/<name>
+        :param store_folder: store folder path
+        :param name: name of the file in the store (it is saved in DB)
+    """
+    return Path(store_folder).joinpath(*shard_of(name), name)
+
+
+def find_store_file(store_folder, name) -> Path:
+    """
+        path of an existing file of the store, the files of a flat store, which is not migrated yet, are found too
+        :param store_folder: store folder path
+        :param name: name of the file in the store
+        :return: path (the sharded path, if the file does not exist)
+    """
+    path = store_file_path(store_folder, name)
+    if not path.exists():
+        flat_path = Path(store_folder).joinpath(name)
+        if flat_path.is_file():
+            return flat_path
+
+    return path
+
+
+def migrate_flat_store(store_folder, max_workers=MIGRATION_WORKERS):
+    """
+        move the files of a flat store into the sharded layout (see store_file_path) in parallel,
+        the names of the files do not change, so nothing has to be updated in DB.
+        The files are renamed (atomic), a file is readable during the migration at the old or the new path.
+        :param store_folder: store folder path
+        :param max_workers: number of threads
+        :return: number of moved files, list of (name, error) of the files, which could not be moved
+    """
+    store_folder = Path(store_folder)
+
+    def move(name):
+        path = store_file_path(store_folder, name)
+        try:
+            os.makedirs(path.parent, exist_ok=True)
+            if path.exists():
+                raise Exception("File exists already in the sharded store")
+            os.rename(store_folder.joinpath(name), path)
+            return name, None
+        except Exception as e:
+            return name, str(e)
+
+    moved = 0
+    errors = []
+    with ThreadPoolExecutor(max_workers=max_workers) as executor, os.scandir(store_folder) as entries:
+        batch = []
+        for entry in entries:
+            # the shard directories, hidden files and indexes are not moved
+            if not entry.is_file(follow_symlinks=False) or entry.name.startswith(".") or is_index_file(entry.name):
+                continue
+
+            batch.append(entry.name)
+            if len(batch) >= MIGRATION_BATCH_SIZE:
+                moved += _collect(executor.map(move, batch), errors)
+                batch = []
+
+        moved += _collect(executor.map(move, batch), errors)
+
+    # make the renames durable
+    for directory in store_folder.glob("/".join(["??"] * STORE_FANOUT_LEVELS)):
+        fu.fsync_directory(directory)
+    fu.fsync_directory(store_folder)
+
+    return moved, errors
+
+
+def _collect(results, errors):
+    moved = 0
+    for name, error in results:
+        if error is None:
+            moved += 1
+        else:
+            errors.append((name, error))
+    return moved
+
+
+def _scan_shard(path):
+    """
+        names of the files in a shard directory and its sub-directories
+    """
+    names = []
+    with os.scandir(path) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                names += _scan_shard(entry.path)
+            elif entry.is_file(follow_symlinks=False):
+                names.append(entry.name)
+    return names
+
+
+def verify_record(store, name, key):
+    """
+        decrypt a record completely (every chunk is authenticated), the plaintext is discarded
+        :param store: Store
+        :param name: name of the record
+        :param key: key of the record (from DB)
+        :return: size of the plaintext
+    """
+    with store.reader(name) as f:
+        if is_encrypted_stream(f):
+            with StreamReader(f, key) as reader:
+                buffer = bytearray(STREAM_CHUNK_SIZE)
+                size = 0
+                while read := reader.readinto(buffer):
+                    size += read
+                return size
+
+        # Fernet token of older versions
+        data = f.read()
+
+    try:
+        return len(Fernet(key).decrypt(data))
+    except InvalidToken:
+        raise Exception("Key is invalid") from None
+
+
+def reencrypt_record(store, name, key, new_name, new_key):
+    """
+        decrypt a record and encrypt it with a new key under a new name, chunk by chunk
+        (the record itself is not changed, it can be deleted, when the new name and key are saved in DB)
+        :param store: Store
+        :param name: name of the record
+        :param key: key of the record
+        :param new_name: reserved name of the new record
+        :param new_key: key of the new record (see generate_key)
+        :return: size of the plaintext
+    """
+    with store.reader(name) as f:
+        if is_encrypted_stream(f):
+            with StreamReader(f, key) as reader, store.writer(new_name) as new_file, \
+                    StreamWriter(new_file, new_key, codec=reader.codec) as writer:
+                buffer = bytearray(STREAM_CHUNK_SIZE)
+                view = memoryview(buffer)
+                size = 0
+                while read := reader.readinto(buffer):
+                    writer.write(view[:read])
+                    size += read
+                return size
+
+        # Fernet token of older versions, the new record is an encrypted stream
+        data = f.read()
+
+    try:
+        plaintext = Fernet(key).decrypt(data)
+    except InvalidToken:
+        raise Exception("Key is invalid") from None
+
+    with store.writer(new_name) as new_file, \
+            StreamWriter(new_file, new_key, codec=choose_codec(plaintext)) as writer:
+        writer.write(plaintext)
+    return len(plaintext)
+
+
+class ScrubReport:
+    """
+        Result of scrub_store, it is updated while the store is scanned (progress)
+    """
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self.scanned = 0  # records found in the store
+        self.verified = 0  # records decrypted
+        self.bytes_verified = 0  # plaintext of the decrypted records
+        self.orphans = []  # names of the records, which are not used in DB
+        self.missing = []  # names used in DB, which are not in the store
+        self.corrupted = []  # (name, error) of the records, which can not be decrypted
+
+    def __str__(self):
+        elapsed = max(time.monotonic() - self.started, 1e-9)
+        return (f"{self.scanned} records scanned ({self.scanned / elapsed:.0f}/s), "
+                f"{self.verified} verified ({self.bytes_verified / elapsed / 1024 / 1024:.1f} MiB/s), "
+                f"{len(self.orphans)} orphans, {len(self.missing)} missing, {len(self.corrupted)} corrupted")
+
+
+def scrub_store(store, references, verify=False, max_workers=SCRUB_WORKERS, progress=None):
+    """
+        compare the records of a store with the records used in DB: records, which are not used in DB (orphans,
+        e.g. left by a crash) and records used in DB, which are missing in the store.
+        Optionally every used record is decrypted with its key in parallel.
+        :param store: Store
+        :param references: dict of name and key of the records used in DB
+        :param verify: decrypt the used records with their keys
+        :param max_workers: threads to decrypt the records
+        :param progress: function, which is called with the ScrubReport, while the store is scanned
+        :return: ScrubReport
+    """
+    report = ScrubReport()
+    remaining = set(references)
+
+    def check(name):
+        try:
+            return name, verify_record(store, name, references[name]), None
+        except Exception as e:
+            return name, 0, str(e)
+
+    def verify_batch(batch):
+        for name, size, error in executor.map(check, batch):
+            if error is None:
+                report.verified += 1
+                report.bytes_verified += size
+            else:
+                report.corrupted.append((name, error))
+
+        if progress is not None:
+            progress(report)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        batch = []
+        for name in store.names():
+            report.scanned += 1
+            if name not in references:
+                report.orphans.append(name)
+            else:
+                remaining.discard(name)
+                if verify:
+                    batch.append(name)
+
+            if len(batch) >= SCRUB_BATCH_SIZE:
+                verify_batch(batch)
+                batch = []
+            elif progress is not None and report.scanned % SCRUB_BATCH_SIZE == 0:
+                progress(report)
+
+        verify_batch(batch)
+
+    report.missing = sorted(remaining)
+    return report
+
+
+def open_store(folder, backend=StoreBackend.FILES, dedup_secret=None, endpoint_url=None, index_folder=None,
+               cache=None):
+    """
+        open the store of the encrypted labels and metadata
+        :param folder: store folder path, for StoreBackend.S3 an url: s3://bucket/prefix
+        :param backend: StoreBackend
+        :param dedup_secret: secret of the deduplication (see DedupIndex), None: records are not deduplicated
+        :param endpoint_url: url of an S3-compatible server (StoreBackend.S3), None: AWS S3
+        :param index_folder: local folder of the dedup index, default the store folder (required for StoreBackend.S3)
+        :param cache: RecordCache of the decrypted records, the records released by the store are removed from it
+        :return: FileStore, PackStore or S3Store
+    """
+    match StoreBackend(backend):
+        case StoreBackend.PACK:
+            store = PackStore(folder)
+        case StoreBackend.S3:
+            store = S3Store(folder, endpoint_url=endpoint_url)
+        case _:
+            store = FileStore(folder)
+
+    if dedup_secret is not None:
+        if index_folder is None:
+            if isinstance(store, S3Store):
+                raise Exception("The dedup index of an object store needs a local index folder")
+            index_folder = folder
+        os.makedirs(index_folder, exist_ok=True)
+        store.dedup = DedupIndex(index_folder, dedup_secret)
+
+    store.cache = cache
+    return store
+
+
+def is_index_file(name):
+    """
+        check whether a file in the store folder is an index (SQLite database or its journal), not a record
+    """
+    return name in (PACK_INDEX_NAME, PACK_LOCK_NAME, DEDUP_INDEX_NAME) or name.startswith((f"{PACK_INDEX_NAME}-",
+                                                                          f"{DEDUP_INDEX_NAME}-"))
+
+
+class ContentHasher:
+    """
+        Keyed hash of the plaintext of a record (HMAC-SHA256), the plaintext is written into it like into a file.
+        Without the secret, equal records can not be recognised in the store.
+
+        :parameter
+            secret: secret of the deduplication (bytes)
+    """
+
+    def __init__(self, secret):
+        self.id_hash = hmac.new(hmac.digest(secret, b"content-id", "sha256"), digestmod="sha256")
+        self.key_hash = hmac.new(hmac.digest(secret, b"content-key", "sha256"), digestmod="sha256")
+
+    def write(self, data):
+        self.id_hash.update(data)
+        self.key_hash.update(data)
+        return len(data)
+
+    def content_id(self):
+        """
+            id of the plaintext in the dedup index
+        """
+        return self.id_hash.hexdigest()
+
+    def key(self):
+        """
+            key of the record derived from the plaintext, so a deduplicated record can be decrypted
+            with the key of each slide (same format as generate_key)
+        """
+        return base64.urlsafe_b64encode(self.key_hash.digest())
+
+
+class DedupIndex:
+    """
+        Index of the content-addressed records of a store: keyed hash of the plaintext -> name of the record,
+        number of references (slides in DB). A record with the same plaintext is written only once.
+
+        :parameter
+            folder: store folder path
+            secret: secret of the deduplication (bytes or str)
+    """
+
+    def __init__(self, folder, secret):
+        self.secret = secret.encode("utf-8") if isinstance(secret, str) else bytes(secret)
+        self.lock = threading.Lock()
+        self.index = sqlite3.connect(Path(folder).joinpath(DEDUP_INDEX_NAME), check_same_thread=False)
+        self.index.execute("CREATE TABLE IF NOT EXISTS blobs (content_id TEXT PRIMARY KEY, name TEXT UNIQUE, "
+                           "refs INTEGER, created REAL)")
+        self.index.commit()
+
+    def hasher(self):
+        return ContentHasher(self.secret)
+
+    def acquire(self, content_id):
+        """
+            add a reference to the record of a plaintext, if it exists
+            :return: name of the record, None if there is no record with the plaintext
+        """
+        with self.lock, self.index:
+            cursor = self.index.execute("UPDATE blobs SET refs = refs + 1 WHERE content_id = ?", (content_id,))
+            if cursor.rowcount == 0:
+                return None
+            return self.index.execute("SELECT name FROM blobs WHERE content_id = ?", (content_id,)).fetchone()[0]
+
+    def add(self, content_id, name):
+        """
+            add a new record with one reference
+            (if another record with the plaintext was added in the meantime, the record is not deduplicated)
+        """
+        with self.lock, self.index:
+            self.index.execute("INSERT OR IGNORE INTO blobs VALUES (?, ?, 1, ?)", (content_id, name, time.time()))
+
+    def forget(self, content_id):
+        """
+            remove the entry of a plaintext (e.g. its record is missing in the store)
+        """
+        with self.lock, self.index:
+            self.index.execute("DELETE FROM blobs WHERE content_id = ?", (content_id,))
+
+    def release(self, name):
+        """
+            remove a reference to a record
+            :return: True if the record is not referenced anymore (it can be deleted)
+        """
+        with self.lock, self.index:
+            cursor = self.index.execute("UPDATE blobs SET refs = refs - 1 WHERE name = ?", (name,))
+            if cursor.rowcount == 0:
+                return True  # not deduplicated
+            if self.index.execute("SELECT refs FROM blobs WHERE name = ?", (name,)).fetchone()[0] > 0:
+                return False
+            self.index.execute("DELETE FROM blobs WHERE name = ?", (name,))
+            return True
+
+    def gc(self, references, grace=PACK_COMPACTION_GRACE):
+        """
+            set the number of references of every record to the number of slides in DB, which use it
+            :param references: dict of name and number of slides, which use it (from DB)
+            :param grace: seconds, newer records are kept (their slides can still be on the way to DB)
+            :return: names of the records, which are not referenced anymore (they have to be deleted)
+        """
+        dead = []
+        with self.lock, self.index:
+            for name, created in self.index.execute("SELECT name, created FROM blobs").fetchall():
+                count = references.get(name, 0)
+                if count > 0:
+                    self.index.execute("UPDATE blobs SET refs = ? WHERE name = ?", (count, name))
+                elif created is None or created < time.time() - grace:
+                    self.index.execute("DELETE FROM blobs WHERE name = ?", (name,))
+                    dead.append(name)
+        return dead
+
+    def close(self):
+        with self.lock:
+            self.index.close()
+
+
+class RecordCache:
+    """
+        LRU cache of decrypted records (plaintext) by name in the store, limited by their size in bytes.
+        A record is only returned for the key it was decrypted with, the plaintext is wiped when it is evicted.
+
+        :parameter
+            max_bytes: maximum size of the cached plaintext, 0: nothing is cached
+    """
+
+    def __init__(self, max_bytes=RECORD_CACHE_SIZE):
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()  # name -> (digest of the key, plaintext), the least recently used first
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, name, key):
+        """
+            get the plaintext of a record
+            :param name: name in the store
+            :param key: key of the record
+            :return: copy of the plaintext (bytearray), None if it is not cached
+        """
+        with self.lock:
+            entry = self.entries.get(name)
+            if entry is None or not hmac.compare_digest(entry[0], self._digest(key)):
+                self.misses += 1
+                return None
+
+            self.entries.move_to_end(name)
+            self.hits += 1
+            return bytearray(entry[1])
+
+    def put(self, name, key, plaintext):
+        """
+            add the plaintext of a record (a copy is cached), the least recently used records are evicted
+        """
+        if len(plaintext) > self.max_bytes:
+            return
+
+        with self.lock:
+            self._remove(name)
+            self.entries[name] = (self._digest(key), bytearray(plaintext))
+            self.size += len(plaintext)
+
+            while self.size > self.max_bytes:
+                self._remove(next(iter(self.entries)))
+                self.evictions += 1
+
+    def discard(self, name):
+        with self.lock:
+            self._remove(name)
+
+    def clear(self):
+        with self.lock:
+            for name in list(self.entries):
+                self._remove(name)
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions,
+                    "records": len(self.entries), "bytes": self.size}
+
+    def __str__(self):
+        stats = self.stats()
+        return (f"{stats['hits']} hits, {stats['misses']} misses, {stats['evictions']} evictions, "
+                f"{stats['records']} records ({stats['bytes']} bytes) cached")
+
+    def _remove(self, name):
+        entry = self.entries.pop(name, None)
+        if entry is not None:
+            plaintext = entry[1]
+            self.size -= len(plaintext)
+            plaintext[:] = bytes(len(plaintext))  # wipe
+
+    @staticmethod
+    def _digest(key):
+        return hashlib.sha256(key.encode("utf-8") if isinstance(key, str) else bytes(key)).digest()
+
+
+class StoreWriter:
+    """
+        Writes records into a store in a pool of threads, so the records of the slides of a case/study are written
+        at the same time (the encryption, compression and hashing release the GIL).
+        The names of all written records are kept, so they can be released together, when something goes wrong
+        (a failed job deletes its reserved name and its incomplete record itself, see Store.write_record).
+
+        :parameter
+            store: Store (FileStore, PackStore or S3Store)
+            max_workers: number of threads
+    """
+
+    def __init__(self, store, max_workers=STORE_WRITERS):
+        self.store = store
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="store-writer")
+        self.lock = threading.Lock()
+        self.jobs = []
+        self.names = []  # names of the written records
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def submit(self, save, *args, **kwargs):
+        """
+            run a job, which writes a record into the store (e.g. Pseudonymization.save_image_data_to_store)
+            :param save: function, which writes the record and returns its name and key
+            :return: awaitable of the name and the key of the record
+        """
+        def job():
+            name, key = save(*args, **kwargs)
+            with self.lock:
+                self.names.append(name)
+            return name, key
+
+        handle = asyncio.wrap_future(self.executor.submit(job))
+        self.jobs.append(handle)
+        return handle
+
+    async def rollback(self):
+        """
+            wait for all jobs and release the records they have written
+        """
+        await asyncio.gather(*self.jobs, return_exceptions=True)
+        for name in self.names:
+            self.store.release(name)
+        self.names = []
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+
+
+class Store:
+    """
+        Interface of the stores (FileStore, PackStore, S3Store), the records are read and written as streams.
+        Common part of the stores: the records can be deduplicated (see DedupIndex),
+        the plaintext of a released record is removed from the cache of the decrypted records (see RecordCache)
+    """
+
+    dedup = None
+    cache = None
+
+    def reserve(self, name):
+        """
+            reserve a name for a new record (atomic)
+            :return: False if the name is used already
+        """
+        raise NotImplementedError
+
+    def exists(self, name):
+        raise NotImplementedError
+
+    def writer(self, name):
+        """
+            write a record (context manager), the record is complete when the context is left without an error
+            :return: file object (binary)
+        """
+        raise NotImplementedError
+
+    def reader(self, name):
+        """
+            read a record (context manager)
+            :return: file object (binary, seekable)
+        """
+        raise NotImplementedError
+
+    def delete(self, name):
+        raise NotImplementedError
+
+    def names(self):
+        """
+            names of all records in the store
+            :return: iterator of names
+        """
+        raise NotImplementedError
+
+    def created(self, name):
+        """
+            time of the last write of a record
+            :return: seconds since the epoch
+        """
+        raise NotImplementedError
+
+    def write_record(self, write, codec=StoreCodec.NONE, create_name=None):
+        """
+            encrypt a record into the store,
+            with deduplication, a record with the same plaintext is reused instead of written again.
+            If the record can not be written, its reserved name is deleted again
+            :param write: function, which writes the plaintext of the record into a file object
+            :param codec: compression of the record (StoreCodec)
+            :param create_name: function, which creates and reserves a new name in the store
+            :return: name of the record, key
+        """
+        content_id = None
+        if self.dedup is None:
+            key = generate_key()
+        else:
+            hasher = self.dedup.hasher()
+            write(hasher)
+            content_id, key = hasher.content_id(), hasher.key()
+
+            name = self.dedup.acquire(content_id)
+            if name is not None:
+                if self.exists(name):
+                    return name, key
+                self.dedup.forget(content_id)  # the record was removed from the store
+
+        name = create_name()
+        try:
+            with self.writer(name) as f, StreamWriter(f, key, codec=codec) as writer:
+                write(writer)
+
+            if content_id is not None:
+                self.dedup.add(content_id, name)
+        except BaseException:
+            # the reserved name and the incomplete record are not used by anybody
+            try:
+                self.delete(name)
+            except Exception as e:
+                # the error of the write is raised, the name is left for scrub (orphan)
+                print(f"Can not delete the reserved name {name} in store: {str(e)}")
+            raise
+
+        return name, key
+
+    def release(self, name):
+        """
+            remove a reference to a record, the record is deleted when nothing references it anymore
+        """
+        if self.cache is not None:
+            self.cache.discard(name)
+        if self.dedup is None or self.dedup.release(name):
+            self.delete(name)
+
+    def gc(self, references, grace=PACK_COMPACTION_GRACE):
+        """
+            delete the deduplicated records, which are not used in DB anymore
+            :param references: dict of name and number of slides, which use it (from DB)
+            :param grace: seconds, see DedupIndex.gc
+            :return: number of deleted records
+        """
+        if self.dedup is None:
+            return 0
+
+        dead = self.dedup.gc(references, grace=grace)
+        for name in dead:
+            if self.cache is not None:
+                self.cache.discard(name)
+            self.delete(name)
+        return len(dead)
+
+    def close(self):
+        if self.dedup is not None:
+            self.dedup.close()
+
+
+class FileStore(Store):
+    """
+        Store with one file per record, in the sharded layout (see store_file_path)
+
+        :parameter
+            folder: store folder path
+    """
+
+    def __init__(self, folder):
+        self.folder = Path(folder)
+        os.makedirs(self.folder, exist_ok=True)
+
+    def reserve(self, name):
+        """
+            reserve a name for a new record (atomic)
+            :return: False if the name is used already
+        """
+        path = store_file_path(self.folder, name)
+        os.makedirs(path.parent, exist_ok=True)
+        try:
+            with open(path, "xb"):
+                pass
+        except FileExistsError:
+            return False
+        return True
+
+    def exists(self, name):
+        return find_store_file(self.folder, name).is_file()
+
+    @contextmanager
+    def writer(self, name):
+        """
+            write a record, it is on the disk, when the context is left (before its name is saved in DB)
+            :return: file object (binary)
+        """
+        path = store_file_path(self.folder, name)
+        with open(path, "wb") as f:
+            yield f
+            f.flush()
+            os.fsync(f.fileno())
+        fu.fsync_directory(path.parent)
+
+    @contextmanager
+    def reader(self, name):
+        """
+            read a record
+            :return: file object (binary, seekable)
+        """
+        with open(find_store_file(self.folder, name), "rb") as f:
+            yield f
+
+    def delete(self, name):
+        find_store_file(self.folder, name).unlink(missing_ok=True)
+
+    def names(self, max_workers=MIGRATION_WORKERS):
+        """
+            names of all records, in the shard directories and in the folder (flat store, not migrated yet),
+            the shard directories are scanned in parallel
+            :param max_workers: number of threads
+        """
+        with os.scandir(self.folder) as entries:
+            shards = []
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    if len(entry.name) == 2:
+                        shards.append(entry.path)
+                elif entry.is_file(follow_symlinks=False) and not entry.name.startswith(".") \
+                        and not is_index_file(entry.name):
+                    yield entry.name
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            for names in executor.map(_scan_shard, shards):
+                yield from names
+
+    def created(self, name):
+        return find_store_file(self.folder, name).stat().st_mtime
+
+
+class PackStore(Store):
+    """
+        Store, which appends the records to large segment files (append-only), instead of a file per record.
+        An index (SQLite) maps the name of a record (saved in DB) to its segment, offset and length,
+        a record is read with a single pread.
+        Deleted records are removed from the index, their space is reclaimed by compact.
+        The appends are locked across processes (PACK_LOCK_NAME), so e.g. store_tool.py can run next to
+        a pseudonymisation.
+
+        :parameter
+            folder: store folder path
+            segment_size: a new segment is started, when the active segment is larger
+    """
+
+    def __init__(self, folder, segment_size=PACK_SEGMENT_SIZE):
+        self.folder = Path(folder)
+        self.segment_size = segment_size
+        os.makedirs(self.folder, exist_ok=True)
+
+        self.lock = threading.RLock()  # the index and the active segment are shared by threads
+        self.index = sqlite3.connect(self.folder.joinpath(PACK_INDEX_NAME), check_same_thread=False)
+        self.index.execute("CREATE TABLE IF NOT EXISTS records (name TEXT PRIMARY KEY, segment INTEGER, "
+                           "offset INTEGER, length INTEGER, created REAL)")
+        self.index.execute("CREATE INDEX IF NOT EXISTS records_segment ON records (segment)")
+        self.index.commit()
+        self.lock_file = open(self.folder.joinpath(PACK_LOCK_NAME), "a+b")
+
+        self.fds = {}  # read-only file descriptors of the segments
+        self.retired_fds = []  # descriptors of removed segments, a reader can still use them
+        segments = self.segments()
+        self.active = segments[-1] if segments else 1
+        self.compaction = None
+
+    def segment_path(self, segment):
+        return self.folder.joinpath(f"{segment:08d}{PACK_SEGMENT_SUFFIX}")
+
+    def segments(self):
+        """
+            ids of the segment files, sorted
+        """
+        return sorted(int(path.stem) for path in self.folder.glob(f"*{PACK_SEGMENT_SUFFIX}") if path.stem.isdigit())
+
+    def reserve(self, name):
+        """
+            reserve a name for a new record (atomic)
+            :return: False if the name is used already
+        """
+        with self.lock:
+            try:
+                with self.index:
+                    self.index.execute("INSERT INTO records (name, created) VALUES (?, ?)", (name, time.time()))
+            except sqlite3.IntegrityError:
+                return False
+        return True
+
+    def exists(self, name):
+        return self._locate(name) is not None
+
+    @contextmanager
+    def writer(self, name):
+        """
+            append a record to the active segment, it is added to the index, when it is written completely.
+            The record is spooled first (in memory, larger records in a temporary file), so the encryption
+            runs without the lock, only the append to the segment is done under the lock.
+            :return: file object (binary)
+        """
+        with tempfile.SpooledTemporaryFile(max_size=PACK_SPOOL_SIZE) as spool:
+            yield spool
+            spool.seek(0)
+            self._append(name, spool)
+
+    @contextmanager
+    def reader(self, name):
+        """
+            read a record with a single pread
+            :return: file object (binary, seekable)
+        """
+        for attempt in range(2):
+            location = self._locate(name)
+            if location is None:
+                raise FileNotFoundError(f"Record {name} is not in the store")
+
+            segment, offset, length = location
+            try:
+                data = os.pread(self._segment_fd(segment), length, offset)
+                break
+            except FileNotFoundError:
+                # the segment was removed by a compaction in the meantime, the record has been moved
+                if attempt > 0:
+                    raise
+
+        if len(data) != length:
+            raise Exception(f"Record {name} is truncated")
+
+        yield io.BytesIO(data)
+
+    def delete(self, name):
+        with self.lock, self.index:
+            self.index.execute("DELETE FROM records WHERE name = ?", (name,))
+
+    def names(self):
+        with self.lock:
+            names = self.index.execute("SELECT name FROM records WHERE segment IS NOT NULL").fetchall()
+        return (name for name, in names)
+
+    def created(self, name):
+        with self.lock:
+            row = self.index.execute("SELECT created FROM records WHERE name = ?", (name,)).fetchone()
+        if row is None:
+            raise FileNotFoundError(f"Record {name} is not in the store")
+        return row[0]
+
+    def compact(self, live_names=None, ratio=PACK_COMPACTION_RATIO, grace=PACK_COMPACTION_GRACE):
+        """
+            reclaim the space of deleted records: the still used records of a sparsely used segment
+            are appended to the active segment, then the segment is removed
+            :param live_names: names, which are used in DB, the other records are deleted first
+                (only if they are older than "grace" seconds, so records of running jobs are kept)
+            :param ratio: a segment is compacted, when less than this part of it is used
+            :param grace: seconds
+            :return: number of removed segments, number of reclaimed bytes
+        """
+        if live_names is not None:
+            live_names = set(live_names)
+            with self.lock:
+                dead = [name for name, created in self.index.execute("SELECT name, created FROM records")
+                        if name not in live_names and (created is None or created < time.time() - grace)]
+                with self.index:
+                    self.index.executemany("DELETE FROM records WHERE name = ?", [(name,) for name in dead])
+
+        removed = 0
+        reclaimed = 0
+        for segment in self.segments():
+            with self.lock:
+                if segment >= self.active:
+                    continue
+                used = self.index.execute("SELECT COALESCE(SUM(length), 0) FROM records WHERE segment = ?",
+                                          (segment,)).fetchone()[0]
+            size = os.path.getsize(self.segment_path(segment))
+            if size > 0 and used >= size * ratio:
+                continue
+
+            # move the used records, a record is moved in one step (other threads can write in between)
+            with self.lock:
+                records = self.index.execute("SELECT name, offset, length FROM records WHERE segment = ?",
+                                             (segment,)).fetchall()
+            for name, offset, length in records:
+                data = os.pread(self._segment_fd(segment), length, offset)
+                # not moved, if it was deleted or replaced in the meantime
+                self._append(name, io.BytesIO(data), location=(segment, offset, length))
+
+            with self.lock, fu.locked_file(self.lock_file):
+                if segment >= self._active_segment():
+                    continue  # another process appends to the segment
+                if self.index.execute("SELECT 1 FROM records WHERE segment = ? LIMIT 1", (segment,)).fetchone():
+                    continue  # a record was written into the segment in the meantime
+                fd = self.fds.pop(segment, None)
+                if fd is not None:
+                    self.retired_fds.append(fd)
+                self.segment_path(segment).unlink()
+
+            fu.fsync_directory(self.folder)
+            removed += 1
+            reclaimed += size - sum(record[2] for record in records)
+
+        return removed, reclaimed
+
+    def start_compaction(self, live_names=None, **kwargs):
+        """
+            compact in a background thread (see compact)
+            :return: threading.Thread
+        """
+        with self.lock:
+            if self.compaction is None or not self.compaction.is_alive():
+                self.compaction = threading.Thread(target=self.compact, args=(live_names,), kwargs=kwargs,
+                                                   name="pack-store-compaction", daemon=True)
+                self.compaction.start()
+            return self.compaction
+
+    def close(self):
+        if self.compaction is not None:
+            self.compaction.join()
+        with self.lock:
+            for fd in list(self.fds.values()) + self.retired_fds:
+                os.close(fd)
+            self.fds = {}
+            self.retired_fds = []
+            self.index.close()
+            self.lock_file.close()
+        super().close()
+
+    def _active_segment(self):
+        """
+            the active segment, another process can have started a new one (under the lock of the store file)
+        """
+        self.active = max([self.active] + self.segments()[-1:])
+        return self.active
+
+    def _append(self, name, data, location=None):
+        """
+            append a record to the active segment and add it to the index, under the lock of the threads
+            and the lock of the store file (other processes append to the same segment)
+            :param data: file object of the record
+            :param location: segment, offset, length: the record is only appended, if it is still there (compaction)
+            :return: False if the record was not at the location anymore
+        """
+        with self.lock, fu.locked_file(self.lock_file):
+            if location is not None and self._locate(name) != location:
+                return False
+
+            segment = self._active_segment()
+            if self.segment_path(segment).exists() and \
+                    os.path.getsize(self.segment_path(segment)) >= self.segment_size:
+                segment = self.active = segment + 1
+
+            with open(self.segment_path(segment), "ab") as f:
+                offset = f.seek(0, os.SEEK_END)
+                try:
+                    shutil.copyfileobj(data, f)
+                    f.flush()
+                    os.fsync(f.fileno())
+                    length = f.tell() - offset
+                except BaseException:
+                    # cut the incomplete record
+                    f.flush()
+                    f.truncate(offset)
+                    raise
+
+            with self.index:
+                self.index.execute("INSERT OR REPLACE INTO records VALUES (?, ?, ?, ?, ?)",
+                                   (name, segment, offset, length, time.time()))
+        return True
+
+    def _locate(self, name):
+        with self.lock:
+            row = self.index.execute("SELECT segment, offset, length FROM records WHERE name = ?",
+                                     (name,)).fetchone()
+        if row is None or row[0] is None:  # not written yet (only reserved)
+            return None
+        return row
+
+    def _segment_fd(self, segment):
+        with self.lock:
+            fd = self.fds.get(segment)
+            if fd is None:
+                fd = os.open(self.segment_path(segment), os.O_RDONLY | getattr(os, "O_BINARY", 0))
+                self.fds[segment] = fd
+            return fd
+
+
+class S3Store(Store):
+    """
+        Store in an S3-compatible object store (AWS S3, MinIO, Ceph, ...), one object per record under a prefix.
+        Larger records are uploaded in parts (multipart upload), the records are read with ranged GETs.
+        The client pools its HTTP connections, it is shared by the threads (see StoreWriter).
+        The credentials are found by boto3 (environment variables, ~/.aws/credentials, ...).
+
+        :parameter
+            url: s3://bucket/prefix
+            endpoint_url: url of an S3-compatible server, None: AWS S3
+            part_size: size of the parts of a multipart upload
+            read_size: bytes fetched by a ranged GET
+            max_connections: size of the connection pool
+    """
+
+    def __init__(self, url, endpoint_url=None, part_size=S3_PART_SIZE, read_size=S3_READ_SIZE,
+                 max_connections=S3_MAX_CONNECTIONS):
+        if boto3 is None:
+            raise Exception("The S3 store needs the package boto3")
+
+        location = urlparse(str(url))
+        if location.scheme != "s3" or not location.netloc:
+            raise Exception(f"Url of the S3 store is invalid (s3://bucket/prefix): {url}")
+
+        self.bucket = location.netloc
+        self.prefix = location.path.strip("/") + "/" if location.path.strip("/") else ""
+        self.part_size = part_size
+        self.read_size = read_size
+        self.client = boto3.client("s3", endpoint_url=endpoint_url,
+                                   config=BotoConfig(max_pool_connections=max_connections,
+                                                     retries={"max_attempts": S3_MAX_ATTEMPTS, "mode": "standard"}))
+
+    def key_of(self, name):
+        return self.prefix + name
+
+    def reserve(self, name):
+        """
+            reserve a name for a new record (atomic, conditional PUT of an empty object)
+            :return: False if the name is used already
+        """
+        try:
+            self.client.put_object(Bucket=self.bucket, Key=self.key_of(name), Body=b"", IfNoneMatch="*")
+        except ClientError as e:
+            if _error_code(e) in ("PreconditionFailed", "ConditionalRequestConflict", "412", "409"):
+                return False
+            raise
+        return True
+
+    def exists(self, name):
+        """
+            :return: False if there is no object, or only the empty object of a reserved name (not written yet)
+        """
+        try:
+            response = self.client.head_object(Bucket=self.bucket, Key=self.key_of(name))
+        except ClientError as e:
+            if _error_code(e) in ("NoSuchKey", "NotFound", "404"):
+                return False
+            raise
+        return response.get("ContentLength", 0) > 0
+
+    @contextmanager
+    def writer(self, name):
+        """
+            upload a record, it is visible in the store, when it is uploaded completely
+            :return: file object (binary)
+        """
+        upload = S3Upload(self.client, self.bucket, self.key_of(name), part_size=self.part_size)
+        try:
+            yield upload
+            upload.finish()
+        except BaseException:
+            upload.abort()
+            raise
+
+    @contextmanager
+    def reader(self, name):
+        """
+            read a record with ranged GETs
+            :return: file object (binary, seekable)
+        """
+        with S3Object(self.client, self.bucket, self.key_of(name), read_size=self.read_size) as f:
+            yield f
+
+    def delete(self, name):
+        self.client.delete_object(Bucket=self.bucket, Key=self.key_of(name))
+
+    def names(self):
+        """
+            names of the written records, the empty objects of reserved names are skipped (see PackStore.names)
+        """
+        for page in self.client.get_paginator("list_objects_v2").paginate(Bucket=self.bucket, Prefix=self.prefix):
+            for item in page.get("Contents", []):
+                name = item["Key"][len(self.prefix):]
+                if name and "/" not in name and item.get("Size", 0) > 0:
+                    yield name
+
+    def created(self, name):
+        return self.client.head_object(Bucket=self.bucket, Key=self.key_of(name))["LastModified"].timestamp()
+
+    def close(self):
+        self.client.close()
+        super().close()
+
+
+class S3Upload(io.RawIOBase):
+    """
+        File object, which uploads an object: a small object with a single PUT,
+        a larger object in parts of "part_size" bytes (multipart upload), only one part is kept in memory.
+    """
+
+    def __init__(self, client, bucket, key, part_size=S3_PART_SIZE):
+        super().__init__()
+        self.client = client
+        self.bucket = bucket
+        self.key = key
+        self.part_size = part_size
+        self.buffer = bytearray()
+        self.upload_id = None
+        self.parts = []
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.buffer += data
+        while len(self.buffer) >= self.part_size:
+            self._upload_part(self.buffer[:self.part_size])
+            del self.buffer[:self.part_size]
+        return len(data)
+
+    def finish(self):
+        """
+            upload the rest of the data and complete the object
+        """
+        if self.upload_id is None:
+            self.client.put_object(Bucket=self.bucket, Key=self.key, Body=bytes(self.buffer))
+        else:
+            if self.buffer:
+                self._upload_part(self.buffer)
+            self.client.complete_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id,
+                                                  MultipartUpload={"Parts": self.parts})
+        self.buffer = bytearray()
+
+    def abort(self):
+        """
+            discard the uploaded parts (the object is not changed)
+        """
+        if self.upload_id is not None:
+            self.client.abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id)
+            self.upload_id = None
+
+    def _upload_part(self, data):
+        if self.upload_id is None:
+            self.upload_id = self.client.create_multipart_upload(Bucket=self.bucket, Key=self.key)["UploadId"]
+
+        number = len(self.parts) + 1
+        response = self.client.upload_part(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id,
+                                           PartNumber=number, Body=bytes(data))
+        self.parts.append({"PartNumber": number, "ETag": response["ETag"]})
+
+
+class S3Object(io.RawIOBase):
+    """
+        Seekable file object of an object, the data is fetched with ranged GETs of "read_size" bytes
+        (a small object is read with one request)
+    """
+
+    def __init__(self, client, bucket, key, read_size=S3_READ_SIZE):
+        super().__init__()
+        self.client = client
+        self.bucket = bucket
+        self.key = key
+        self.read_size = read_size
+        self.position = 0
+        self.block_offset = 0
+        self.block = b""
+        self.size = None
+        self._fetch(0)  # the size of the object is in the first response
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        match whence:
+            case io.SEEK_CUR:
+                offset += self.position
+            case io.SEEK_END:
+                offset += self.size
+        if offset < 0:
+            raise ValueError("Negative seek position")
+        self.position = offset
+        return self.position
+
+    def readinto(self, buffer):
+        """
+            read like a local file: the buffer is filled completely, unless the end of the object is reached
+        """
+        view = memoryview(buffer).cast("B")
+        read = 0
+        while read < len(view) and self.position < self.size:
+            if not self.block_offset <= self.position < self.block_offset + len(self.block):
+                self._fetch(self.position)
+
+            start = self.position - self.block_offset
+            length = min(len(view) - read, len(self.block) - start)
+            view[read:read + length] = self.block[start:start + length]
+            self.position += length
+            read += length
+
+        return read
+
+    def _fetch(self, offset):
+        try:
+            response = self.client.get_object(Bucket=self.bucket, Key=self.key,
+                                              Range=f"bytes={offset}-{offset + self.read_size - 1}")
+        except ClientError as e:
+            match _error_code(e):
+                case "NoSuchKey" | "NotFound" | "404":
+                    raise FileNotFoundError(f"Object {self.key} is not in the store") from None
+                case "InvalidRange" | "416" if offset == 0:
+                    self.size = 0  # empty object
+                    return
+            raise
+
+        with response["Body"] as body:
+            block = body.read()
+
+        content_range = response.get("ContentRange")
+        if content_range:
+            # bytes <first>-<last>/<size>
+            self.size = int(content_range.rsplit("/", 1)[1])
+            self.block_offset = offset
+        else:
+            # the server sent the whole object
+            self.size = len(block)
+            self.block_offset = 0
+        self.block = block
+
+
+def _error_code(error):
+    return str(error.response.get("Error", {}).get("Code"))
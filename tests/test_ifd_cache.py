@@ -0,0 +1,66 @@
+import numpy as np
+import tifffile
+
+import input_handler as ih
+
+DESCRIPTION = ("Aperio Image Library v10.0.51\r\n768x512 [0,0 768x512] (256x256) JPEG/RGB Q=30"
+               "|AppMag = 20|Filename = CMU-1|Date = 12/29/09|User = b414003d-95c6-48b0-9369-8010ed517ba7")
+
+
+def make_svs(path):
+    """
+        small slide like an Aperio SVS: base image, thumbnail, label and macro
+    """
+    base = np.zeros((512, 768, 3), np.uint8)
+    with tifffile.TiffWriter(path) as tw:
+        tw.write(base, tile=(256, 256), compression="zlib", description=DESCRIPTION, photometric="rgb",
+                 metadata=None)
+        tw.write(base[::4, ::4], description="Aperio Image Library v10.0.51\r\n192x128 -> 96x64 |User = xyz",
+                 photometric="rgb", metadata=None, rowsperstrip=16)
+        tw.write(np.full((120, 200, 3), 200, np.uint8), description="Aperio Image Library v10.0.51\r\nlabel 200x120",
+                 photometric="rgb", metadata=None, compression="zlib", subfiletype=1, rowsperstrip=16)
+        tw.write(np.full((100, 300, 3), 100, np.uint8), description="Aperio Image Library v10.0.51\r\nmacro 300x100",
+                 photometric="rgb", metadata=None, compression="zlib", subfiletype=9, rowsperstrip=16)
+
+
+def test_cache_hit_does_not_open_slide(tmp_path, monkeypatch):
+    path = str(tmp_path / "slide.svs")
+    make_svs(path)
+
+    cache = ih.IfdIndexCache(str(tmp_path / "ifd_index.sqlite"))
+    slide = ih.Slide(path)
+    assert ih.check_format_support(path, slide.slide)
+    cache.put(path, slide.slide)
+
+    opened = []
+
+    def counting_open(*args, **kwargs):
+        opened.append(args[0])
+        return open(*args, **kwargs)
+
+    monkeypatch.setattr(ih, "open", counting_open, raising=False)
+
+    cached = ih.Slide(path, tiff=cache.get(path))
+    assert ih.check_format_support(path, cached.slide)
+    assert cached.metadata.vendor is ih.Vendor.APERIO
+    for image, expected in ((cached.label, slide.label), (cached.macro, slide.macro)):
+        assert (image.width, image.height, image.compression, image.bits_per_sample) == \
+               (expected.width, expected.height, expected.compression, expected.bits_per_sample)
+        assert image.data_offsets == expected.data_offsets
+        assert image.data_byte_counts == expected.data_byte_counts
+    assert opened == []
+
+    cache.close()
+
+
+def test_cache_contains_no_description(tmp_path):
+    path = str(tmp_path / "slide.svs")
+    make_svs(path)
+
+    cache = ih.IfdIndexCache(str(tmp_path / "ifd_index.sqlite"))
+    slide = ih.Slide(path)
+    cache.put(path, slide.slide)
+    data = cache.connection.execute("SELECT data FROM ifd_index").fetchone()[0]
+    cache.close()
+
+    assert b"Aperio" not in data and b"b414003d" not in data and b"label" not in data
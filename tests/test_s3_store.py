@@ -0,0 +1,73 @@
+import os
+
+import pytest
+
+boto3 = pytest.importorskip("boto3")
+moto_server = pytest.importorskip("moto.server")
+
+import store_utils as su
+
+PORT = 5077
+
+
+@pytest.fixture(scope="module")
+def endpoint_url():
+    """
+        local S3-compatible server (moto)
+    """
+    os.environ.setdefault("AWS_ACCESS_KEY_ID", "test")
+    os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "test")
+    os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+
+    server = moto_server.ThreadedMotoServer(port=PORT, verbose=False)
+    server.start()
+    url = f"http://127.0.0.1:{PORT}"
+    boto3.client("s3", endpoint_url=url).create_bucket(Bucket="wsi")
+    yield url
+    server.stop()
+
+
+def test_round_trip(endpoint_url):
+    store = su.open_store("s3://wsi/store", su.StoreBackend.S3, endpoint_url=endpoint_url)
+    store.part_size = 5 * 1024 * 1024  # the smallest part of a multipart upload
+    store.read_size = 1024 * 1024
+
+    # a reserved name is not a record yet
+    assert store.reserve("big")
+    assert not store.reserve("big")
+    assert not store.exists("big")
+    assert list(store.names()) == []
+
+    # multipart upload, read with ranged GETs
+    plaintext = os.urandom(11 * 1024 * 1024 + 3)
+    key = su.generate_key()
+    with store.writer("big") as f, su.StreamWriter(f, key) as writer:
+        writer.write(plaintext)
+    assert store.exists("big")
+
+    with store.reader("big") as f, su.StreamReader(f, key) as reader:
+        assert bytes(su.read_all(reader)) == plaintext
+
+    # small record with a single PUT, a failed upload does not change it
+    assert store.reserve("small")
+    with store.writer("small") as f:
+        f.write(b"record")
+    with pytest.raises(RuntimeError):
+        with store.writer("small") as f:
+            f.write(os.urandom(6 * 1024 * 1024))
+            raise RuntimeError("upload is aborted")
+    with store.reader("small") as f:
+        assert f.read() == b"record"
+        f.seek(2)
+        assert f.read(3) == b"cor"
+
+    assert sorted(store.names()) == ["big", "small"]
+
+    store.delete("big")
+    assert not store.exists("big")
+    with pytest.raises(FileNotFoundError):
+        with store.reader("big"):
+            pass
+    assert list(store.names()) == ["small"]
+
+    store.close()